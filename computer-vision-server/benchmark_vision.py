@@ -0,0 +1,303 @@
+"""
+Benchmark reproducible del servidor de visión con imágenes sintéticas de frutas.
+
+Mide el análisis directo (`AgriculturalVisionAI.analyze_image`, por etapa y total) y los
+endpoints `/analyze-image` y `/analyze-batch` con un cliente ASGI en el mismo proceso.
+Las imágenes y el simulador de defectos usan semillas fijas; el resultado se guarda en JSON
+para comparar entre commits (`--compare benchmark_anterior.json`).
+
+    python benchmark_vision.py --output bench.json
+    python benchmark_vision.py --quick --compare bench.json
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from io import BytesIO
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+from PIL import Image
+
+DEFAULT_SIZES = "640x480,1280x960,1920x1080,4000x3000"
+QUICK_SIZES = "640x480,1280x960"
+DEFAULT_MODES = "L,RGB,RGBA"
+DEFAULT_FORMATS = "JPEG,PNG"
+# Color BGR de la fruta por tipo de producto (fondo gris neutro)
+FRUIT_COLORS = {
+    "Manzana": (40, 40, 190),
+    "Naranja": (30, 140, 240),
+    "Tomate": (35, 30, 210),
+    "Papa": (90, 150, 185)
+}
+
+def synthetic_fruit(width: int, height: int, mode: str = "RGB", image_format: str = "JPEG",
+                    product_type: str = "Manzana", seed: int = 0) -> bytes:
+    """Imagen sintética determinista: fruta elíptica con manchas sobre fondo gris, codificada en `image_format`"""
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 110, np.uint8)
+    center = (width // 2 + int(rng.integers(-width // 10, width // 10 + 1)),
+              height // 2 + int(rng.integers(-height // 10, height // 10 + 1)))
+    axes = (int(min(width, height) * rng.uniform(0.25, 0.35)), int(min(width, height) * rng.uniform(0.22, 0.32)))
+    angle = float(rng.uniform(0, 180))
+    cv2.ellipse(image, center, axes, angle, 0, 360, FRUIT_COLORS.get(product_type, (40, 40, 190)), -1)
+
+    # Manchas oscuras (defectos) dentro de la fruta
+    for _ in range(int(rng.integers(2, 6))):
+        radius = max(2, int(min(axes) * rng.uniform(0.04, 0.12)))
+        offset = (rng.uniform(-0.6, 0.6) * axes[0], rng.uniform(-0.6, 0.6) * axes[1])
+        blemish = (int(center[0] + offset[0]), int(center[1] + offset[1]))
+        cv2.circle(image, blemish, radius, tuple(int(v) for v in rng.integers(10, 60, 3)), -1)
+
+    # Ruido de sensor
+    noise = rng.integers(-6, 7, image.shape, dtype=np.int16)
+    image = np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+    rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    if mode == "L":
+        pil_image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), "L")
+    elif mode == "RGBA":
+        alpha = np.zeros((height, width), np.uint8)
+        cv2.ellipse(alpha, center, axes, angle, 0, 360, 255, -1)
+        pil_image = Image.fromarray(np.dstack([rgb, np.maximum(alpha, 64)]), "RGBA")
+    else:
+        pil_image = Image.fromarray(rgb, "RGB")
+
+    buffer = BytesIO()
+    pil_image.save(buffer, image_format, **({"quality": 90} if image_format == "JPEG" else {}))
+    return buffer.getvalue()
+
+def image_cases(sizes: str, modes: str, formats: str, seed: int) -> List[Dict]:
+    """Combinaciones tamaño × modo × formato (JPEG no admite RGBA)"""
+    cases = []
+    for size in sizes.split(","):
+        width, height = (int(v) for v in size.lower().split("x"))
+        for mode in modes.split(","):
+            for image_format in formats.split(","):
+                if image_format == "JPEG" and mode == "RGBA":
+                    continue
+                cases.append({
+                    "size": f"{width}x{height}",
+                    "megapixels": round(width * height / 1e6, 2),
+                    "mode": mode,
+                    "format": image_format,
+                    "image": synthetic_fruit(width, height, mode, image_format, seed=seed + len(cases))
+                })
+    return cases
+
+def summarize(samples_ms: List[float]) -> Dict:
+    """Estadísticas de latencia (ms)"""
+    ordered = sorted(samples_ms)
+
+    def percentile(p: float) -> float:
+        index = min(len(ordered) - 1, max(0, int(round(p / 100 * (len(ordered) - 1)))))
+        return ordered[index]
+
+    return {
+        "runs": len(ordered),
+        "mean_ms": statistics.fmean(ordered),
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "min_ms": ordered[0],
+        "max_ms": ordered[-1]
+    }
+
+def bench_direct(server, cases: List[Dict], repeat: int, warmup: int, seed: int) -> List[Dict]:
+    """Análisis directo por etapa (StageTimer del propio servidor) y total, sin HTTP ni pool"""
+    vision_ai = server.AgriculturalVisionAI()
+    results = []
+    for case in cases:
+        for _ in range(warmup):
+            vision_ai.analyze_image(case["image"], "Manzana", "warmup")
+
+        np.random.seed(seed)
+        totals, stages = [], {}
+        for run in range(repeat):
+            start = time.perf_counter()
+            result = vision_ai.analyze_image(case["image"], "Manzana", f"bench_{run}")
+            totals.append((time.perf_counter() - start) * 1000)
+            for stage, elapsed in result["timings"].items():
+                stages.setdefault(stage, []).append(elapsed)
+
+        summary = summarize(totals)
+        results.append({
+            "size": case["size"],
+            "megapixels": case["megapixels"],
+            "mode": case["mode"],
+            "format": case["format"],
+            "bytes": len(case["image"]),
+            **summary,
+            "images_per_second": 1000 / summary["mean_ms"],
+            "stages_ms": {stage: statistics.fmean(values) for stage, values in stages.items()},
+            # Huella del simulador con la semilla fija: cambia si cambia el resultado del análisis
+            "defects_last_run": len(result["defects"])
+        })
+        print(f"⏱️ directo {case['size']:>9} {case['mode']:<4} {case['format']:<4} "
+              f"p50 {summary['p50_ms']:8.1f} ms  ({results[-1]['images_per_second']:.1f} img/s)")
+    return results
+
+async def bench_endpoints(server, cases: List[Dict], repeat: int, warmup: int,
+                          concurrency: int, batch_size: int) -> List[Dict]:
+    """`/analyze-image` (JSON base64) y `/analyze-batch` (multipart, normal y vectorizado) en el mismo proceso"""
+    import httpx
+
+    results = []
+    # El modo vectorizado viene desactivado en el servidor; el benchmark lo compara igualmente
+    server.VISION_BATCH_VECTORIZED = True
+    server.analysis_executor.start()
+    try:
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+            for case in cases:
+                payload = {
+                    "image_data": "data:image/jpeg;base64," + base64.b64encode(case["image"]).decode("ascii"),
+                    "product_type": "Manzana",
+                    "analysis_id": "bench",
+                    "bypass_cache": True
+                }
+
+                async def post_image() -> float:
+                    start = time.perf_counter()
+                    response = await client.post("/analyze-image", json=payload)
+                    response.raise_for_status()
+                    return (time.perf_counter() - start) * 1000
+
+                for _ in range(warmup):
+                    await post_image()
+
+                # Secuencial: latencia de una petición aislada
+                samples = [await post_image() for _ in range(repeat)]
+                results.append({"endpoint": "/analyze-image", "size": case["size"], "mode": case["mode"],
+                                "format": case["format"], "concurrency": 1, **summarize(samples),
+                                "images_per_second": 1000 / statistics.fmean(samples)})
+
+                # Concurrente: throughput con el pool de workers y los micro-lotes
+                start = time.perf_counter()
+                samples = await asyncio.gather(*(post_image() for _ in range(repeat * concurrency)))
+                wall = time.perf_counter() - start
+                results.append({"endpoint": "/analyze-image", "size": case["size"], "mode": case["mode"],
+                                "format": case["format"], "concurrency": concurrency, **summarize(list(samples)),
+                                "images_per_second": len(samples) / wall})
+
+                extension = case["format"].lower()
+                files = [("images", (f"bench_{i}.{extension}", case["image"], f"image/{extension}"))
+                         for i in range(batch_size)]
+                for vectorized in (False, True):
+                    data = {"bypass_cache": "true", "vectorized": str(vectorized).lower()}
+                    samples = []
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        response = await client.post("/analyze-batch", files=files, data=data)
+                        response.raise_for_status()
+                        samples.append((time.perf_counter() - start) * 1000)
+                    results.append({"endpoint": "/analyze-batch" + ("?vectorized" if vectorized else ""),
+                                    "size": case["size"], "mode": case["mode"], "format": case["format"],
+                                    "batch_size": batch_size, **summarize(samples),
+                                    "images_per_second": batch_size * 1000 / statistics.fmean(samples)})
+
+                print(f"🌐 endpoints {case['size']:>9} {case['mode']:<4} {case['format']:<4} "
+                      + "  ".join(f"{r['endpoint']}: {r['images_per_second']:.1f} img/s" for r in results[-4:]))
+    finally:
+        server.analysis_executor.shutdown()
+    return results
+
+def case_key(result: Dict) -> str:
+    return "|".join(str(result.get(k, "")) for k in ("endpoint", "size", "mode", "format", "concurrency", "batch_size"))
+
+def compare(current: Dict, baseline_path: str, threshold: float) -> int:
+    """Comparar p50 con un benchmark anterior; retorna el número de regresiones"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    regressions = 0
+    print(f"\n📊 Comparación con {baseline_path} ({baseline['meta'].get('git_commit') or 'sin commit'})")
+    for section in ("direct", "endpoints"):
+        previous = {case_key(r): r for r in baseline.get(section, [])}
+        for result in current.get(section, []):
+            before = previous.get(case_key(result))
+            if before is None:
+                continue
+            change = (result["p50_ms"] - before["p50_ms"]) / before["p50_ms"]
+            flag = "⚠️" if change > threshold else "  "
+            regressions += change > threshold
+            print(f"{flag} {section:<9} {case_key(result):<55} {before['p50_ms']:8.1f} -> {result['p50_ms']:8.1f} ms "
+                  f"({change:+.1%})")
+    return regressions
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark reproducible del servidor de visión")
+    parser.add_argument("--sizes", default=None, help=f"Tamaños AnchoxAlto separados por coma (por defecto {DEFAULT_SIZES})")
+    parser.add_argument("--modes", default=DEFAULT_MODES, help="Modos PIL: L, RGB, RGBA")
+    parser.add_argument("--formats", default=DEFAULT_FORMATS, help="Formatos: JPEG, PNG")
+    parser.add_argument("--repeat", type=int, default=5, help="Repeticiones medidas por caso")
+    parser.add_argument("--warmup", type=int, default=1, help="Repeticiones de calentamiento por caso")
+    parser.add_argument("--seed", type=int, default=42, help="Semilla de imágenes y simulador")
+    parser.add_argument("--workers", type=int, default=None, help="VISION_WORKERS para los endpoints")
+    parser.add_argument("--concurrency", type=int, default=4, help="Peticiones simultáneas en /analyze-image")
+    parser.add_argument("--batch-size", type=int, default=8, help="Imágenes por petición en /analyze-batch")
+    parser.add_argument("--skip-endpoints", action="store_true", help="Medir solo el análisis directo")
+    parser.add_argument("--quick", action="store_true", help=f"Solo {QUICK_SIZES}, RGB y JPEG, 3 repeticiones")
+    parser.add_argument("--output", default="benchmark_results.json", help="Archivo JSON de salida")
+    parser.add_argument("--compare", default=None, help="JSON de un benchmark anterior para comparar p50")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Aumento de p50 que cuenta como regresión")
+    args = parser.parse_args()
+    if args.quick:
+        args.sizes = args.sizes or QUICK_SIZES
+        args.modes, args.formats, args.repeat = "RGB", "JPEG", 3
+    args.sizes = args.sizes or DEFAULT_SIZES
+
+    # El servidor lee su configuración al importarse: fijarla antes
+    os.environ["VISION_RANDOM_SEED"] = str(args.seed)
+    if args.workers is not None:
+        os.environ["VISION_WORKERS"] = str(args.workers)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import computer_vision_server as server
+
+    print(f"🧪 Generando imágenes sintéticas (semilla {args.seed})...")
+    cases = image_cases(args.sizes, args.modes, args.formats, args.seed)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "vision_workers": server.VISION_WORKERS,
+            "analysis_max_side": server.VISION_ANALYSIS_MAX_SIDE,
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")}
+        },
+        "direct": bench_direct(server, cases, args.repeat, args.warmup, args.seed)
+    }
+    if not args.skip_endpoints:
+        report["endpoints"] = asyncio.run(bench_endpoints(server, cases, args.repeat, args.warmup,
+                                                          args.concurrency, args.batch_size))
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"💾 Resultados guardados en {args.output}")
+
+    if args.compare:
+        regressions = compare(report, args.compare, args.threshold)
+        print(f"{'⚠️' if regressions else '✅'} {regressions} regresiones (umbral {args.threshold:.0%})")
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
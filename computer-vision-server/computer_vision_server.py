@@ -1,6 +1,7 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request, Query, Header, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, PlainTextResponse, FileResponse, JSONResponse
 from pydantic import BaseModel
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple, Union
 import numpy as np
 import cv2
 import base64
@@ -8,7 +9,36 @@ from io import BytesIO
 from PIL import Image
 import uvicorn
 import json
+import os
+import copy
+import hashlib
+import time
+import abc
+import asyncio
+import importlib
+import random
+import re
+import tempfile
+import cProfile
+import tracemalloc
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from contextlib import contextmanager
+import bisect
+import math
 from datetime import datetime
+from functools import cached_property, partial
+from quality_scoring import GRADE_THRESHOLDS, REJECTED_GRADE, QualityScorer, default_scorer, quality_grade
+
+try:
+    # Perfilador por muestreo (opcional); sin él se usa cProfile
+    from pyinstrument import Profiler as SamplingProfiler
+except ImportError:
+    SamplingProfiler = None
 
 app = FastAPI(
     title="Agricultural Computer Vision API",
@@ -20,6 +50,10 @@ class ImageAnalysisRequest(BaseModel):
     image_data: str  # base64
     product_type: str
     analysis_id: str
+    bypass_cache: bool = False
+    include_timings: bool = False
+    batch_id: Optional[str] = None  # suma el resultado a los agregados del lote
+    total_units: Optional[int] = None  # unidades esperadas en el lote
 
 class ImageAnalysisResponse(BaseModel):
     analysis_id: str
@@ -29,10 +63,518 @@ class ImageAnalysisResponse(BaseModel):
     confidence_score: float
     processing_time: float
     total_area: float
+    texture_analysis: Optional[Dict] = None
+    image_dimensions: Optional[Dict[str, int]] = None
+    analysis_resolution: Optional[Dict[str, int]] = None
+    tiling: Optional[Dict] = None
+    cache_hit: Optional[bool] = None
+    timings: Optional[Dict[str, float]] = None
+    memory: Optional[Dict[str, int]] = None
+    profile_file: Optional[str] = None
+    total_defects: Optional[int] = None
+    severe_defects: Optional[int] = None
+    size_category: Optional[str] = None
+    measured_diameter: Optional[float] = None
+    quality_score: Optional[float] = None
+    quality_grade: Optional[str] = None
+    lot: Optional[Dict] = None
+
+# Clases de prioridad (menor rango = antes): re-inspecciones críticas, tráfico normal, backfills masivos
+PRIORITY_CLASSES = {"critical": 0, "normal": 1, "bulk": 2}
+
+class BatchAnalysisRequest(BaseModel):
+    images: List[str]  # base64
+    product_type: str
+    batch_id: str
+    total_units: Optional[int] = None  # unidades declaradas por el operador
+    expected_images: Optional[int] = None  # imágenes de todo el lote (por defecto total_units)
+    start_index: int = 0  # posición de la primera imagen dentro del lote
+    analysis_id: Optional[str] = None  # prefijo de los IDs por imagen
+    max_concurrency: Optional[int] = None
+    bypass_cache: bool = False
+    include_timings: bool = False
+
+class JobRequest(BaseModel):
+    image_data: Optional[str] = None  # base64 de una imagen
+    images: List[str] = []  # o varias imágenes base64 (lote)
+    product_type: str
+    analysis_id: Optional[str] = None
+    mode: str = "image"  # "image" o "units"
+    priority: str = "normal"
+    callback_url: Optional[str] = None
+    bypass_cache: bool = False
+    batch_id: Optional[str] = None
+    total_units: Optional[int] = None
+
+def decode_image_data(image_data: str) -> bytes:
+    """Decodificar imagen base64 (con o sin prefijo data URI) a bytes crudos"""
+    # Compatibilidad con clientes que envían "data:image/jpeg;base64,..."
+    if ',' in image_data:
+        image_data = image_data.split(',', 1)[1]
+    return base64.b64decode(image_data)
+
+# Lado máximo (px) de la imagen de análisis; las imágenes mayores se reducen al decodificar (0 = resolución completa)
+VISION_ANALYSIS_MAX_SIDE = int(os.getenv("VISION_ANALYSIS_MAX_SIDE", "1024"))
+# Comentario JPEG con el tamaño de captura de una imagen reducida por el cliente
+SOURCE_SIZE_COMMENT = b"vision-source-size="
+
+# Presupuesto de memoria por petición (MB, 0 = sin límite) y acción al superarlo: "reject" (413) o "downsample"
+VISION_REQUEST_MEMORY_MB = float(os.getenv("VISION_REQUEST_MEMORY_MB", "0"))
+VISION_MEMORY_BUDGET_ACTION = os.getenv("VISION_MEMORY_BUDGET_ACTION", "reject")
+# Pico de memoria por etapa en los workers: "off", "tracemalloc" (asignaciones NumPy/Python) o "rss" (Linux)
+VISION_MEMORY_TRACKING = os.getenv("VISION_MEMORY_TRACKING", "off")
+# Bytes por pixel decodificado: PIL guarda RGB en 4 bytes por pixel
+DECODE_BYTES_PER_PIXEL = 4
+# Lado mínimo al reducir una imagen para que quepa en el presupuesto
+MEMORY_BUDGET_MIN_SIDE = 128
+# Tamaño máximo de un frame del stream de cámara (MB, 0 = sin límite); los mayores se rechazan sin decodificar
+VISION_STREAM_MAX_FRAME_MB = float(os.getenv("VISION_STREAM_MAX_FRAME_MB", "8"))
+
+# Modo por tiles (imágenes line-scan): presupuesto de memoria de trabajo y solape entre tiles
+VISION_TILE_MEMORY_MB = float(os.getenv("VISION_TILE_MEMORY_MB", "64"))
+VISION_TILE_OVERLAP = int(os.getenv("VISION_TILE_OVERLAP", "32"))
+# Bytes de trabajo por pixel de tile: RGB + BGR + HSV + gris + canal/máscaras + Laplaciano float32
+TILE_BYTES_PER_PIXEL = 20
+# Píxeles máximos del frame reducido usado para el umbral global y el contorno en modo tiles
+TILED_SEGMENTATION_PIXELS = 1_000_000
+
+# Backend de detección de defectos "modulo:Clase" (vacío = simulador)
+VISION_DETECTOR_BACKEND = os.getenv("VISION_DETECTOR_BACKEND", "")
+
+# Lote vectorizado: lado máximo de la forma común de análisis e imágenes por llamada al kernel
+VISION_BATCH_SIDE = int(os.getenv("VISION_BATCH_SIDE", "256"))
+VISION_BATCH_KERNEL_SIZE = max(1, int(os.getenv("VISION_BATCH_KERNEL_SIZE", "64")))
+# El kernel vectorizado no mejora al análisis por imagen en CPU (benchmark_vision.py): solo se usa si se habilita
+VISION_BATCH_VECTORIZED = os.getenv("VISION_BATCH_VECTORIZED", "").strip().lower() in ("1", "true", "yes", "on")
+
+def source_size(image: Image.Image) -> Tuple[int, int]:
+    """Tamaño de captura de la imagen (ancho, alto).
+    
+    Los clientes que reducen la imagen antes de enviarla (app de Streamlit) declaran el tamaño
+    original en un comentario JPEG `vision-source-size=AnchoxAlto`, para que las medidas en
+    píxeles y mm sigan referidas a la captura. Sin comentario válido es el tamaño de la imagen.
+    """
+    comment = image.info.get("comment")
+    if isinstance(comment, bytes) and comment.startswith(SOURCE_SIZE_COMMENT):
+        try:
+            width, height = (int(v) for v in comment[len(SOURCE_SIZE_COMMENT):].split(b"x"))
+        except ValueError:
+            return image.size
+        # Solo reducciones: nunca un tamaño de captura menor que la imagen recibida
+        if width >= image.size[0] and height >= image.size[1]:
+            return width, height
+    return image.size
+
+def describe_defect(defect_type: str, x: int, y: int, area_percentage: float) -> str:
+    """Texto descriptivo de un defecto"""
+    return f'{defect_type} detectado en posición ({x},{y}) con área {area_percentage:.1f}%'
+
+# Lado máximo (px) del frame reducido sobre el que se segmenta el producto
+SEGMENTATION_MAX_SIDE = 256
+# Fracción mínima del frame que debe ocupar un contorno para considerarse producto
+SEGMENTATION_MIN_AREA_RATIO = 0.01
+# En modo multi-unidad cada fruta ocupa una fracción menor del frame
+UNIT_MIN_AREA_RATIO = float(os.getenv("VISION_UNIT_MIN_AREA_RATIO", "0.002"))
+
+def foreground_channel(image: np.ndarray) -> np.ndarray:
+    """Canal usado para separar producto de cinta: saturación (o gris), suavizado"""
+    if len(image.shape) == 3:
+        channel = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)[:, :, 1]
+    else:
+        channel = image
+    return cv2.GaussianBlur(channel, (5, 5), 0)
+
+def foreground_threshold(image: np.ndarray) -> Tuple[float, bool]:
+    """Umbral de Otsu y polaridad (invertir o no) del primer plano.
+    
+    La cinta transportadora es poco saturada y ocupa los bordes del frame; si la
+    mayoría del borde queda como primer plano se invierte la máscara.
+    """
+    threshold, binary = cv2.threshold(foreground_channel(image), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    border = np.concatenate([binary[0, :], binary[-1, :], binary[:, 0], binary[:, -1]])
+    return float(threshold), bool(np.count_nonzero(border) > border.size / 2)
+
+def segment_foreground(image: np.ndarray, threshold: Optional[float] = None,
+                       invert: Optional[bool] = None) -> np.ndarray:
+    """Máscara binaria (0/255) de primer plano: umbral (Otsu si no se indica) + morfología"""
+    if threshold is None or invert is None:
+        threshold, invert = foreground_threshold(image)
+    _, binary = cv2.threshold(foreground_channel(image), threshold, 255, cv2.THRESH_BINARY)
+    if invert:
+        binary = cv2.bitwise_not(binary)
+    
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+    binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel)
+    return cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
+
+def foreground_contours(binary: np.ndarray, shape: Tuple[int, int], min_area_ratio: float) -> List[np.ndarray]:
+    """Contornos externos de una máscara reducida, filtrados por área y llevados a `shape` (alto, ancho)"""
+    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    min_area = min_area_ratio * binary.shape[0] * binary.shape[1]
+    contours = sorted((c for c in contours if cv2.contourArea(c) >= min_area), key=cv2.contourArea, reverse=True)
+    
+    # Contornos a coordenadas de la imagen de análisis
+    scale = np.array([shape[1] / binary.shape[1], shape[0] / binary.shape[0]])
+    return [(c.reshape(-1, 2) * scale).astype(np.int32).reshape(-1, 1, 2) for c in contours]
+
+def batch_histograms(values: np.ndarray, bins: int, mask: Optional[np.ndarray] = None,
+                     channel: int = 0) -> np.ndarray:
+    """Histograma (N, bins) de cada imagen de un lote (N, alto, ancho[, canales]).
+    
+    Cada imagen del lote apilado es una vista contigua: calcHist la recorre sin copias.
+    """
+    return np.stack([
+        cv2.calcHist([values[i]], [channel], None if mask is None else mask[i], [bins], [0, bins]).ravel()
+        for i in range(values.shape[0])
+    ]).astype(np.float64)
+
+# Filas de relleno por imagen en el lote apilado (cubre los kernels 5x5 de desenfoque y morfología)
+BATCH_ROW_PADDING = 2
+
+def pad_batch_rows(planes: np.ndarray, pad: int) -> np.ndarray:
+    """(N, alto, ancho) -> (N, alto + 2·pad, ancho) reflejando cada imagen como BORDER_REFLECT_101.
+    
+    Al apilar el resultado como una sola imagen, los filtros de hasta (2·pad+1) filas no mezclan
+    imágenes vecinas y sus filas interiores coinciden con filtrar cada imagen por separado.
+    """
+    return np.pad(planes, ((0, 0), (pad, pad), (0, 0)), mode='reflect')
+
+def batch_otsu_thresholds(hists: np.ndarray) -> np.ndarray:
+    """Umbral de Otsu de cada fila de un array (N, 256) de histogramas (equivalente a THRESH_OTSU)"""
+    totals = np.maximum(hists.sum(axis=1, keepdims=True), 1)
+    p = hists / totals
+    levels = np.arange(hists.shape[1])
+    omega = np.cumsum(p, axis=1)
+    mu = np.cumsum(p * levels, axis=1)
+    mu_total = mu[:, -1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (mu_total * omega - mu) ** 2 / (omega * (1 - omega))
+    between[~np.isfinite(between)] = -1
+    return np.argmax(between, axis=1).astype(np.float64)
+
+def batch_shape(shapes: List[Tuple[int, int]], max_side: int) -> Tuple[int, int]:
+    """Forma común (alto, ancho) de un lote: relación de aspecto y lado mayor medianos, acotado a max_side"""
+    aspect = float(np.median([w / h for h, w in shapes]))
+    side = min(max_side, int(np.median([max(h, w) for h, w in shapes])))
+    if aspect >= 1:
+        return max(1, int(round(side / aspect))), side
+    return side, max(1, int(round(side * aspect)))
+
+def merge_moments(a: Tuple[float, np.ndarray, np.ndarray], b: Tuple[float, np.ndarray, np.ndarray]):
+    """Combinar (n, media, M2) de dos particiones de forma exacta (Chan et al.)"""
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    if n == 0:
+        return a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / n)
+    m2 = m2_a + m2_b + delta ** 2 * (n_a * n_b / n)
+    return n, mean, m2
+
+def histogram_mean(hist: np.ndarray) -> float:
+    """Valor medio de los píxeles a partir de su histograma (un bin por nivel)"""
+    hist = hist.ravel()
+    total = hist.sum()
+    return float(np.dot(np.arange(hist.size), hist) / total) if total else 0.0
+
+def hue_circular_variance(h_hist: np.ndarray) -> float:
+    """Varianza del tono (unidades OpenCV², 0-180) tratando el tono como ángulo: 179 y 0 son vecinos"""
+    h_hist = h_hist.ravel()
+    total = h_hist.sum()
+    if not total:
+        return 0.0
+    angles = np.arange(h_hist.size) * (2 * np.pi / 180)
+    resultant = np.hypot(np.dot(np.cos(angles), h_hist), np.dot(np.sin(angles), h_hist)) / total
+    circular_std = np.sqrt(-2 * np.log(max(resultant, 1e-12))) * 180 / (2 * np.pi)
+    return float(circular_std ** 2)
+
+class ImageFeatures:
+    """Representaciones derivadas de una imagen, calculadas una sola vez y bajo demanda.
+    
+    El producto se segmenta sobre un frame reducido; las estadísticas de color,
+    textura y variación se calculan solo sobre los píxeles de la máscara dentro
+    de su bounding box (la región del producto). Si no se encuentra producto, la
+    región es el frame completo.
+    """
+    def __init__(self, image: Optional[np.ndarray], segment: bool = True,
+                 min_area_ratio: float = SEGMENTATION_MIN_AREA_RATIO):
+        self.image = image
+        self.shape = image.shape if image is not None else ()
+        self.segment = segment
+        self.min_area_ratio = min_area_ratio
+        self._parent: Optional['ImageFeatures'] = None
+
+    @classmethod
+    def of(cls, image: Union[np.ndarray, 'ImageFeatures']) -> 'ImageFeatures':
+        """Aceptar tanto un array como un contexto ya construido"""
+        return image if isinstance(image, ImageFeatures) else cls(image)
+
+    @classmethod
+    def from_statistics(cls, shape: Tuple[int, ...], **statistics) -> 'ImageFeatures':
+        """Contexto sin imagen, con estadísticas ya calculadas (p.ej. combinadas por tiles)"""
+        features = cls(None)
+        features.shape = shape
+        features.__dict__.update(statistics)
+        return features
+
+    @property
+    def is_color(self) -> bool:
+        return len(self.shape) == 3
+
+    @cached_property
+    def contours(self) -> List[np.ndarray]:
+        """Contornos de primer plano (coordenadas de análisis), de mayor a menor área"""
+        if not self.segment:
+            return []
+        height, width = self.image.shape[:2]
+        ratio = min(1.0, SEGMENTATION_MAX_SIDE / max(height, width))
+        if ratio < 1.0:
+            small = cv2.resize(self.image, (max(1, int(width * ratio)), max(1, int(height * ratio))),
+                               interpolation=cv2.INTER_AREA)
+        else:
+            small = self.image
+        
+        return foreground_contours(segment_foreground(small), (height, width), self.min_area_ratio)
+
+    def _segmentation_from_contour(self, contour: np.ndarray) -> Dict:
+        height, width = self.image.shape[:2]
+        x, y, w, h = cv2.boundingRect(contour)
+        x, y = max(0, x), max(0, y)
+        w, h = max(1, min(w, width - x)), max(1, min(h, height - y))
+        
+        mask = np.zeros((h, w), dtype=np.uint8)
+        cv2.drawContours(mask, [contour], -1, 255, thickness=-1, offset=(-x, -y))
+        _, radius = cv2.minEnclosingCircle(contour)
+        
+        return {
+            'found': True,
+            'bbox': (x, y, w, h),
+            'mask': mask,
+            'area_pixels': float(cv2.countNonZero(mask)),
+            'diameter_pixels': float(2 * radius)
+        }
+
+    @cached_property
+    def segmentation(self) -> Dict:
+        """Producto principal (mayor contorno) llevado a resolución de análisis"""
+        if self.contours:
+            return self._segmentation_from_contour(self.contours[0])
+        height, width = self.image.shape[:2]
+        return {'found': False, 'bbox': (0, 0, width, height), 'mask': None,
+                'area_pixels': float(width * height), 'diameter_pixels': float(min(width, height))}
+
+    def units(self) -> List['ImageFeatures']:
+        """Un contexto por unidad de producto en el frame (componentes conexas de la máscara).
+        
+        Cada unidad recorta el HSV y el gris del frame completo, que se calculan una sola vez.
+        """
+        units = []
+        for contour in self.contours:
+            unit = ImageFeatures(self.image)
+            unit._parent = self
+            unit.__dict__['segmentation'] = self._segmentation_from_contour(contour)
+            units.append(unit)
+        return units
+
+    @property
+    def mask(self) -> Optional[np.ndarray]:
+        """Máscara del producto recortada a su bounding box (None = región completa)"""
+        return self.segmentation['mask']
+
+    @cached_property
+    def region(self) -> np.ndarray:
+        """Vista (sin copia) de la imagen recortada al bounding box del producto"""
+        x, y, w, h = self.segmentation['bbox']
+        return self.image[y:y + h, x:x + w]
+
+    def _parent_crop(self, array: np.ndarray) -> np.ndarray:
+        # Las unidades recortan el array del frame; el padre cubre la imagen completa
+        x, y, w, h = self.segmentation['bbox']
+        return array[y:y + h, x:x + w]
+
+    @cached_property
+    def gray(self) -> np.ndarray:
+        if self._parent is not None:
+            return self._parent_crop(self._parent.full_gray)
+        if self.is_color:
+            return cv2.cvtColor(self.region, cv2.COLOR_BGR2GRAY)
+        return self.region
+
+    @cached_property
+    def hsv(self) -> np.ndarray:
+        if self._parent is not None:
+            return self._parent_crop(self._parent.full_hsv)
+        return cv2.cvtColor(self.region, cv2.COLOR_BGR2HSV)
+
+    @cached_property
+    def full_gray(self) -> np.ndarray:
+        """Gris del frame completo (compartido por las unidades)"""
+        if self.is_color:
+            return cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        return self.image
+
+    @cached_property
+    def full_hsv(self) -> np.ndarray:
+        """HSV del frame completo (compartido por las unidades)"""
+        return cv2.cvtColor(self.image, cv2.COLOR_BGR2HSV)
+
+    @cached_property
+    def h_hist(self) -> np.ndarray:
+        return cv2.calcHist([self.hsv], [0], self.mask, [180], [0, 180])
+
+    @cached_property
+    def s_hist(self) -> np.ndarray:
+        return cv2.calcHist([self.hsv], [1], self.mask, [256], [0, 256])
+
+    @cached_property
+    def v_hist(self) -> np.ndarray:
+        return cv2.calcHist([self.hsv], [2], self.mask, [256], [0, 256])
+
+    @cached_property
+    def channel_mean_std(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Media y desviación por canal (cv2.meanStdDev no crea copias float64 de la imagen)"""
+        mean, std = cv2.meanStdDev(self.region, mask=self.mask)
+        return mean.ravel(), std.ravel()
+
+    @cached_property
+    def mean(self) -> float:
+        return float(np.mean(self.channel_mean_std[0]))
+
+    @cached_property
+    def var(self) -> float:
+        # Varianza global combinando canales: E[x²] - E[x]²
+        means, stds = self.channel_mean_std
+        return float(max(0.0, np.mean(stds ** 2 + means ** 2) - self.mean ** 2))
+
+    @property
+    def std(self) -> float:
+        return float(np.sqrt(self.var))
+
+    @cached_property
+    def laplacian_var(self) -> float:
+        # CV_32F es exacto para el Laplaciano de uint8 y ocupa la mitad que CV_64F
+        laplacian = cv2.Laplacian(self.gray, cv2.CV_32F)
+        mask = self.mask
+        if mask is not None:
+            # Erosionar para excluir el salto producto/cinta del borde de la máscara
+            mask = cv2.erode(mask, np.ones((3, 3), np.uint8))
+            if not cv2.countNonZero(mask):
+                mask = self.mask
+        _, std = cv2.meanStdDev(laplacian, mask=mask)
+        return float(std[0][0] ** 2)
+
+def _proc_status_bytes(field: str) -> int:
+    """Campo en kB de /proc/self/status (VmRSS, VmHWM) en bytes"""
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+class StageMemory:
+    """Pico de memoria de una etapa sobre la memoria al empezarla (VISION_MEMORY_TRACKING)"""
+    def __init__(self, mode: str):
+        self.mode = mode
+        # Solo se mide dentro de los workers (_init_worker), donde corre un análisis a la vez
+        self.active = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.active and self.mode in ("tracemalloc", "rss")
+
+    def start(self) -> int:
+        if self.mode == "tracemalloc":
+            tracemalloc.reset_peak()
+            return tracemalloc.get_traced_memory()[0]
+        # Escribir "5" en clear_refs reinicia el pico de RSS (VmHWM) del proceso
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return _proc_status_bytes("VmRSS")
+
+    def peak_since(self, baseline: int) -> int:
+        if self.mode == "tracemalloc":
+            return max(0, tracemalloc.get_traced_memory()[1] - baseline)
+        return max(0, _proc_status_bytes("VmHWM") - baseline)
+
+stage_memory = StageMemory(VISION_MEMORY_TRACKING)
+
+class StageTimer:
+    """Duración acumulada (ms, time.perf_counter) y pico de memoria (bytes) de cada etapa de un análisis"""
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+        self.memory: Dict[str, int] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        baseline = stage_memory.start() if stage_memory.enabled else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000)
+            if baseline is not None:
+                self.add_memory(name, stage_memory.peak_since(baseline))
+
+    def add(self, name: str, elapsed_ms: float):
+        self.timings[name] = self.timings.get(name, 0.0) + elapsed_ms
+
+    def add_memory(self, name: str, peak_bytes: int):
+        self.memory[name] = max(self.memory.get(name, 0), peak_bytes)
+
+class DefectDetector(abc.ABC):
+    """Backend de detección de defectos que procesa lotes de imágenes preprocesadas.
+    
+    `detect_batch` recibe un `ImageFeatures` por imagen (imagen a resolución de análisis,
+    segmentación del producto y estadísticas compartidas) y su tipo de producto, y retorna por
+    imagen la lista de defectos en coordenadas de la imagen de análisis, con las claves type,
+    bbox [x, y, w, h], area, area_percentage (relativa a la región del producto), confidence,
+    severity y description. Un modelo real (ONNX, OpenVINO) hace una sola inferencia por lote.
+    
+    El backend se carga en cada worker con VISION_DETECTOR_BACKEND="paquete.modulo:Clase"; el
+    constructor recibe el `AgriculturalVisionAI` del worker (categorías y umbrales por producto).
+    """
+    name = "base"
+    
+    def __init__(self, vision_ai: 'AgriculturalVisionAI'):
+        self.vision_ai = vision_ai
+
+    @abc.abstractmethod
+    def detect_batch(self, images: List[ImageFeatures], product_types: List[str]) -> List[List[Dict]]:
+        ...
+
+class SimulatedDefectDetector(DefectDetector):
+    """Backend por defecto: defectos simulados a partir de la variación de color de cada imagen"""
+    name = "simulated"
+    
+    def detect_batch(self, images: List[ImageFeatures], product_types: List[str]) -> List[List[Dict]]:
+        return [self.vision_ai.simulate_defect_detection(features, product_type)
+                for features, product_type in zip(images, product_types)]
+
+def detector_class(spec: str) -> type:
+    """Clase del backend "modulo:Clase" (vacío = simulador); falla si no implementa `detect_batch`"""
+    if not spec:
+        return SimulatedDefectDetector
+    module_name, _, class_name = spec.partition(":")
+    if not class_name:
+        raise ValueError(f"VISION_DETECTOR_BACKEND debe tener el formato modulo:Clase, recibido {spec!r}")
+    backend = getattr(importlib.import_module(module_name), class_name)
+    if not (isinstance(backend, type) and issubclass(backend, DefectDetector)):
+        raise TypeError(f"VISION_DETECTOR_BACKEND {spec!r} no es una subclase de DefectDetector")
+    if backend.__abstractmethods__:
+        raise TypeError(f"VISION_DETECTOR_BACKEND {spec!r} no implementa {', '.join(sorted(backend.__abstractmethods__))}")
+    return backend
+
+def load_detector(spec: str, vision_ai: 'AgriculturalVisionAI') -> DefectDetector:
+    """Instanciar el backend "modulo:Clase" (vacío = simulador)"""
+    return detector_class(spec)(vision_ai)
 
 # Simulador de modelo de visión artificial
 class AgriculturalVisionAI:
-    def __init__(self):
+    def __init__(self, analysis_max_side: int = VISION_ANALYSIS_MAX_SIDE,
+                 detector_backend: str = VISION_DETECTOR_BACKEND):
+        self.analysis_max_side = analysis_max_side
+        self.detector_backend = detector_backend
         self.defect_categories = {
             'Manzana': ['Punto Negro', 'Golpe', 'Podredumbre', 'Corte', 'Mancha'],
             'Naranja': ['Mancha', 'Piel Dañada', 'Podredumbre', 'Golpe'],
@@ -54,58 +596,104 @@ class AgriculturalVisionAI:
             'Daño Mecánico': 0.8,
             'Defecto General': 0.6
         }
+        
+        # Factores de conversión mm por pixel (imagen original) por tipo de producto
+        self.pixel_to_mm = {
+            'Manzana': 0.15,
+            'Naranja': 0.18,
+            'Tomate': 0.12,
+            'Papa': 0.20
+        }
+
+    @cached_property
+    def detector(self) -> DefectDetector:
+        """Backend de detección, cargado al primer uso (solo en los procesos que analizan)"""
+        return load_detector(self.detector_backend, self)
 
-    def preprocess_image(self, image_data: str) -> np.ndarray:
-        """Preprocesar imagen base64 para análisis"""
+    @cached_property
+    def scorer(self) -> QualityScorer:
+        """Motor de puntuación de calidad (estándares cargados una vez por proceso)"""
+        return default_scorer()
+
+    def preprocess_image(self, image_data: Union[bytes, str],
+                         max_side: Optional[int] = None) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """Preprocesar imagen (bytes crudos o base64) a la resolución de análisis.
+        
+        Retorna el array BGR/gris y el tamaño original (ancho, alto) de la imagen.
+        `max_side` reemplaza el lado máximo de análisis configurado.
+        """
         try:
-            # Decodificar base64
-            if ',' in image_data:
-                image_data = image_data.split(',')[1]
+            # Los bytes crudos van directo al decodificador; base64 solo por compatibilidad
+            if isinstance(image_data, str):
+                image_bytes = decode_image_data(image_data)
+            else:
+                image_bytes = image_data
             
-            image_bytes = base64.b64decode(image_data)
+            # Image.open solo lee la cabecera; el decode ocurre al convertir a array
             image = Image.open(BytesIO(image_bytes))
+            original_size = source_size(image)
+            
+            max_side = max_side or self.analysis_max_side
+            if max_side and max(original_size) > max_side:
+                ratio = max_side / max(original_size)
+                target = (max(1, int(original_size[0] * ratio)), max(1, int(original_size[1] * ratio)))
+                # JPEG: libjpeg escala en el dominio DCT (1/2, 1/4, 1/8) sin decodificar a resolución completa
+                image.draft(image.mode, target)
+                image.thumbnail((max_side, max_side), Image.BILINEAR)
             
-            # Convertir a numpy array
+            if image.mode not in ('RGB', 'L'):
+                # RGBA, paleta, CMYK, 16 bits, etc.
+                image = image.convert('RGB')
+            
+            # Convertir a numpy array y liberar el buffer de PIL antes de seguir
             img_array = np.array(image)
+            image.close()
+            del image
             
-            # Convertir BGR a RGB si es necesario
+            # Convertir RGB a BGR en el mismo array (sin una segunda copia a resolución de análisis)
             if len(img_array.shape) == 3 and img_array.shape[2] == 3:
-                img_array = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
+                cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR, dst=img_array)
             
-            return img_array
+            return img_array, original_size
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Error procesando imagen: {str(e)}")
 
-    def simulate_defect_detection(self, image: np.ndarray, product_type: str) -> List[Dict]:
+    def simulate_defect_detection(self, image: Union[np.ndarray, ImageFeatures], product_type: str) -> List[Dict]:
         """Simular detección de defectos basada en características de la imagen"""
+        features = ImageFeatures.of(image)
         possible_defects = self.defect_categories.get(product_type, ['Defecto General'])
         
-        # Simular detección basada en características de la imagen
-        height, width = image.shape[:2]
+        # Simular detección dentro de la región del producto (o del frame si no se segmentó)
+        region_x, region_y, region_width, region_height = features.segmentation['bbox']
         
         # Número de defectos basado en complejidad de la imagen
-        if len(image.shape) == 3:
+        if features.is_color:
             # Imagen a color - analizar variaciones
-            std_dev = np.std(image)
+            std_dev = features.std
             num_defects = min(5, max(0, int(std_dev / 10)))  # 0-5 defectos basado en variación
         else:
             # Imagen escala de grises
             num_defects = np.random.randint(0, 3)
         
+        # Márgenes y tamaños acotados por la región (las unidades pueden ser pequeñas)
+        min_side = min(region_width, region_height)
+        margin = min(50, min_side // 8)
+        box_max = max(2, min(100, min_side // 6))
+        box_min = max(1, min(20, min_side // 20, box_max - 1))
+        
         defects = []
         for i in range(num_defects):
             defect_type = np.random.choice(possible_defects)
             
             # Simular coordenadas de bounding box (evitar bordes)
-            margin = 50
-            x = np.random.randint(margin, width - margin - 50)
-            y = np.random.randint(margin, height - margin - 50)
-            w = np.random.randint(20, min(100, width - x - 10))
-            h = np.random.randint(20, min(100, height - y - 10))
+            w = np.random.randint(box_min, box_max)
+            h = np.random.randint(box_min, box_max)
+            x = region_x + np.random.randint(margin, max(margin + 1, region_width - margin - w))
+            y = region_y + np.random.randint(margin, max(margin + 1, region_height - margin - h))
             
-            # Calcular área
+            # Calcular área relativa a la región del producto
             area = w * h
-            total_area = width * height
+            total_area = region_width * region_height
             area_percentage = (area / total_area) * 100
             
             # Confianza basada en tipo de defecto
@@ -124,32 +712,30 @@ class AgriculturalVisionAI:
                 'type': defect_type,
                 'bbox': [int(x), int(y), int(w), int(h)],
                 'area': int(area),
+                'area_percentage': float(area_percentage),
                 'confidence': float(confidence),
                 'severity': severity,
-                'description': f'{defect_type} detectado en posición ({x},{y}) con área {area_percentage:.1f}%'
+                'description': describe_defect(defect_type, x, y, area_percentage)
             })
         
         return defects
 
-    def measure_size(self, image: np.ndarray) -> Dict:
-        """Medir tamaño del producto en la imagen"""
-        height, width = image.shape[:2]
+    def measure_size(self, image: Union[np.ndarray, ImageFeatures], product_type: Optional[str] = None,
+                     original_size: Optional[Tuple[int, int]] = None) -> Dict:
+        """Medir tamaño del producto segmentado (en píxeles de la imagen original)"""
+        features = ImageFeatures.of(image)
+        analysis_height, analysis_width = features.shape[:2]
+        width, height = original_size if original_size is not None else (analysis_width, analysis_height)
+        sx, sy = width / analysis_width, height / analysis_height
         
-        # Simular detección del producto (en producción usaría segmentación)
-        # Asumimos que el producto ocupa aproximadamente el 60-80% del área
-        product_ratio = np.random.uniform(0.6, 0.8)
-        diameter_pixels = min(height, width) * product_ratio
+        segmentation = features.segmentation
+        diameter_pixels = segmentation['diameter_pixels'] * (sx + sy) / 2
+        product_area_pixels = segmentation['area_pixels'] * sx * sy
+        product_ratio = segmentation['area_pixels'] / (analysis_width * analysis_height)
+        x, y, w, h = segmentation['bbox']
         
-        # Convertir a mm (factores de conversión por tipo de producto)
-        conversion_factors = {
-            'Manzana': 0.15,  # mm por pixel
-            'Naranja': 0.18,
-            'Tomate': 0.12,
-            'Papa': 0.20
-        }
-        
-        # Factor de conversión simulado
-        pixel_to_mm = conversion_factors.get('Manzana', 0.15)
+        # Convertir a mm con el factor del tipo de producto solicitado
+        pixel_to_mm = self.pixel_to_mm.get(product_type, self.pixel_to_mm['Manzana'])
         diameter_mm = diameter_pixels * pixel_to_mm
         
         return {
@@ -158,38 +744,40 @@ class AgriculturalVisionAI:
             'width_pixels': int(width),
             'height_pixels': int(height),
             'total_area_pixels': int(height * width),
-            'product_area_ratio': float(product_ratio)
+            'product_area_ratio': float(product_ratio),
+            'product_area_pixels': float(product_area_pixels),
+            'product_area_mm2': float(product_area_pixels * pixel_to_mm ** 2),
+            'product_bbox': [int(round(x * sx)), int(round(y * sy)), int(round(w * sx)), int(round(h * sy))],
+            'segmentation_found': segmentation['found']
         }
 
-    def analyze_color(self, image: np.ndarray) -> Dict:
+    def analyze_color(self, image: Union[np.ndarray, ImageFeatures]) -> Dict:
         """Analizar distribución de colores del producto"""
-        if len(image.shape) != 3:
+        features = ImageFeatures.of(image)
+        if not features.is_color:
             # Imagen en escala de grises
             return {
                 'dominant_hue': 0,
                 'average_saturation': 0,
-                'average_value': float(np.mean(image)),
+                'average_value': features.mean,
                 'color_uniformity': 0.8,
-                'color_variance': float(np.var(image)),
+                'color_variance': features.var,
                 'is_grayscale': True
             }
         
         try:
-            # Convertir a HSV para mejor análisis de color
-            hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-            
-            # Calcular histogramas
-            h_hist = cv2.calcHist([hsv], [0], None, [180], [0, 180])
-            s_hist = cv2.calcHist([hsv], [1], None, [256], [0, 256])
-            v_hist = cv2.calcHist([hsv], [2], None, [256], [0, 256])
+            # Histogramas HSV compartidos con el resto de etapas
+            h_hist = features.h_hist
+            s_hist = features.s_hist
+            v_hist = features.v_hist
             
-            # Encontrar colores dominantes
+            # Encontrar colores dominantes (promedios por pixel del producto)
             dominant_hue = int(np.argmax(h_hist))
-            avg_saturation = float(np.mean(s_hist))
-            avg_value = float(np.mean(v_hist))
+            avg_saturation = histogram_mean(s_hist)
+            avg_value = histogram_mean(v_hist)
             
-            # Calcular uniformidad del color (inversa de la varianza)
-            hue_variance = float(np.var(h_hist))
+            # Calcular uniformidad del color (inversa de la varianza del tono)
+            hue_variance = hue_circular_variance(h_hist)
             color_uniformity = max(0.1, 1.0 - (hue_variance / 1000))
             
             # Determinar madurez basada en color (simulación)
@@ -214,22 +802,19 @@ class AgriculturalVisionAI:
             return {
                 'dominant_hue': 0,
                 'average_saturation': 0,
-                'average_value': float(np.mean(image)),
+                'average_value': features.mean,
                 'color_uniformity': 0.7,
                 'color_variance': 0,
                 'maturity_indicator': 'No determinado',
                 'is_grayscale': True
             }
 
-    def analyze_texture(self, image: np.ndarray) -> Dict:
+    def analyze_texture(self, image: Union[np.ndarray, ImageFeatures]) -> Dict:
         """Analizar textura del producto (simulación)"""
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = image
+        features = ImageFeatures.of(image)
         
         # Calcular características de textura simples
-        laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
+        laplacian_var = features.laplacian_var
         
         # Simular análisis de textura
         if laplacian_var < 100:
@@ -245,71 +830,2079 @@ class AgriculturalVisionAI:
             'laplacian_variance': float(laplacian_var)
         }
 
-    def analyze_image(self, image_data: str, product_type: str, analysis_id: str) -> Dict:
-        """Analizar imagen completa"""
-        start_time = datetime.now()
+    def scale_defects(self, defects: List[Dict], analysis_shape: Tuple[int, int], original_size: Tuple[int, int]) -> List[Dict]:
+        """Llevar bounding boxes y áreas de la resolución de análisis a píxeles originales"""
+        analysis_height, analysis_width = analysis_shape
+        original_width, original_height = original_size
+        if (analysis_width, analysis_height) == (original_width, original_height):
+            return defects
+        
+        sx = original_width / analysis_width
+        sy = original_height / analysis_height
+        for defect in defects:
+            x, y, w, h = defect['bbox']
+            x, y, w, h = int(round(x * sx)), int(round(y * sy)), int(round(w * sx)), int(round(h * sy))
+            defect['bbox'] = [x, y, w, h]
+            defect['area'] = w * h
+            # area_percentage es relativa a la región y no cambia con la escala
+            defect['description'] = describe_defect(defect['type'], x, y, defect['area_percentage'])
+        return defects
+
+    def analyze_region(self, features: ImageFeatures, product_type: str,
+                       original_size: Tuple[int, int], defects: Optional[List[Dict]] = None,
+                       timer: Optional[StageTimer] = None) -> Dict:
+        """Defectos, tamaño, color, textura y confianza de una región (producto o unidad).
+        
+        `defects` son los defectos ya detectados por lote; si se omite se detectan aquí.
+        `timer` acumula la duración de cada etapa.
+        """
+        timer = timer or StageTimer()
+        if defects is None:
+            with timer.stage('detection'):
+                defects = self.detector.detect_batch([features], [product_type])[0]
+        with timer.stage('size'):
+            defects = self.scale_defects(defects, features.shape[:2], original_size)
+            size_measurements = self.measure_size(features, product_type, original_size)
+        with timer.stage('color'):
+            color_analysis = self.analyze_color(features)
+        with timer.stage('texture'):
+            texture_analysis = self.analyze_texture(features)
+        
+        # Calcular confianza general basada en los análisis
+        base_confidence = 0.85
+        if defects:
+            # Ajustar confianza basada en defectos detectados
+            avg_defect_confidence = np.mean([d['confidence'] for d in defects])
+            base_confidence = (base_confidence + avg_defect_confidence) / 2
+        
+        return {
+            'defects': defects,
+            'size_measurements': size_measurements,
+            'color_analysis': color_analysis,
+            'texture_analysis': texture_analysis,
+            'confidence_score': float(base_confidence)
+        }
+
+    def image_result(self, features: ImageFeatures, product_type: str, analysis_id: str,
+                     original_size: Tuple[int, int], defects: Optional[List[Dict]] = None,
+                     timer: Optional[StageTimer] = None) -> Dict:
+        """Resultado completo de una imagen (formato de /analyze-image) a partir de su contexto"""
+        timer = timer or StageTimer()
+        region_result = self.analyze_region(features, product_type, original_size, defects, timer)
+        size_measurements = region_result['size_measurements']
+        
+        result = {
+            'analysis_id': analysis_id,
+            **region_result,
+            'processing_time': 0.0,
+            'total_area': size_measurements['total_area_pixels'],
+            'image_dimensions': {
+                'width': size_measurements['width_pixels'],
+                'height': size_measurements['height_pixels']
+            },
+            'analysis_resolution': {
+                'width': int(features.shape[1]),
+                'height': int(features.shape[0])
+            },
+            'product_type': product_type,
+            'analysis_timestamp': datetime.now().isoformat()
+        }
+        # Severidad, categoría de tamaño, score y grado según los estándares del producto
+        with timer.stage('scoring'):
+            result.update(self.scorer.score(result))
+        return result
+
+    def analyze_image(self, image_data: Union[bytes, str], product_type: str, analysis_id: str,
+                      max_side: Optional[int] = None) -> Dict:
+        """Analizar imagen completa (`max_side` reemplaza el lado máximo de análisis)"""
+        result = self.analyze_images([(image_data, product_type, analysis_id)], max_side)[0]
+        if isinstance(result, HTTPException):
+            raise result
+        return result
+
+    def analyze_images(self, items: List[Tuple[Union[bytes, str], str, str]],
+                       max_side: Optional[int] = None) -> List[Union[Dict, HTTPException]]:
+        """Analizar un micro-lote de (imagen, tipo de producto, analysis_id) independientes.
+        
+        Cada imagen se preprocesa y analiza a su propia resolución; la detección de defectos se
+        hace con una sola llamada al backend para todo el lote. Retorna, en orden, el resultado
+        o la HTTPException de cada imagen; cada resultado lleva `timings` por etapa (ms).
+        """
+        results: List[Union[Dict, HTTPException, None]] = [None] * len(items)
+        prepared = []
+        for i, (image_data, _, _) in enumerate(items):
+            timer = StageTimer()
+            try:
+                with timer.stage('image_decode'):
+                    image, original_size = self.preprocess_image(image_data, max_side)
+                # Contexto compartido: gris, HSV, histogramas, etc. se calculan una vez por imagen
+                features = ImageFeatures(image)
+                with timer.stage('segmentation'):
+                    features.segmentation
+                prepared.append((i, features, original_size, timer))
+            except HTTPException as e:
+                # Errores de preprocesamiento (400) se propagan tal cual
+                results[i] = e
+            except Exception as e:
+                results[i] = HTTPException(status_code=500, detail=f"Error en análisis de imagen: {str(e)}")
+        if not prepared:
+            return results
         
         try:
-            # Preprocesar imagen
-            image = self.preprocess_image(image_data)
+            start_time = time.perf_counter()
+            defects = self.detector.detect_batch([features for _, features, _, _ in prepared],
+                                                 [items[i][1] for i, _, _, _ in prepared])
+            # Cada imagen se lleva su parte de la detección por lote
+            detection_time = (time.perf_counter() - start_time) * 1000 / len(prepared)
+        except Exception as e:
+            error = HTTPException(status_code=500, detail=f"Error en análisis de imagen: {str(e)}")
+            for i, _, _, _ in prepared:
+                results[i] = error
+            return results
+        
+        for (i, features, original_size, timer), image_defects in zip(prepared, defects):
+            timer.add('detection', detection_time)
+            _, product_type, analysis_id = items[i]
+            try:
+                result = self.image_result(features, product_type, analysis_id, original_size, image_defects, timer)
+            except Exception as e:
+                results[i] = HTTPException(status_code=500, detail=f"Error en análisis de imagen: {str(e)}")
+                continue
+            result['processing_time'] = float(sum(timer.timings.values()))
+            result['timings'] = timer.timings
+            result['memory'] = timer.memory
+            results[i] = result
+        return results
+
+    def batch_features(self, images: List[np.ndarray]) -> List[ImageFeatures]:
+        """Contextos de N imágenes del mismo tamaño calculados con operaciones vectorizadas sobre el lote.
+        
+        El lote se apila por filas como una sola imagen de N·alto filas: conversiones de color,
+        desenfoque, umbral y morfología recorren las N imágenes en una llamada. Para los filtros
+        cada imagen lleva 2 filas de relleno con el mismo borde que OpenCV (ver `pad_batch_rows`),
+        así que el resultado es exacto imagen a imagen. Los umbrales de Otsu se calculan para todo
+        el lote a la vez; contornos, histogramas y medias enmascaradas se leen de vistas contiguas
+        de cada imagen, y el Laplaciano se calcula sobre el gris recortado de cada región, como en
+        `analyze_image`.
+        """
+        count = len(images)
+        height, width = images[0].shape[:2]
+        pad = BATCH_ROW_PADDING
+        
+        is_color = np.array([image.ndim == 3 for image in images])
+        bgr = np.stack([image if image.ndim == 3 else cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) for image in images])
+        rows = bgr.reshape(count * height, width, 3)
+        hsv = cv2.cvtColor(rows, cv2.COLOR_BGR2HSV)
+        gray = cv2.cvtColor(rows, cv2.COLOR_BGR2GRAY).reshape(count, height, width)
+        
+        # Segmentación (mismo criterio que segment_foreground): saturación o gris, desenfoque, Otsu, morfología
+        channel = hsv[:, :, 1].reshape(count, height, width)
+        if not is_color.all():
+            channel = np.where(is_color[:, None, None], channel, gray)
+        ratio = min(1.0, SEGMENTATION_MAX_SIDE / max(height, width))
+        if ratio < 1.0:
+            small_size = (max(1, int(width * ratio)), max(1, int(height * ratio)))
+            channel = np.stack([cv2.resize(c, small_size, interpolation=cv2.INTER_AREA) for c in channel])
+        small_height, small_width = channel.shape[1:]
+        padded = pad_batch_rows(channel, pad)
+        blurred = cv2.GaussianBlur(padded.reshape(-1, small_width), (5, 5), 0).reshape(padded.shape)
+        
+        # Otsu de todas las imágenes a la vez sobre sus histogramas (filas interiores, sin relleno)
+        inner = blurred[:, pad:-pad]
+        thresholds = batch_otsu_thresholds(batch_histograms(inner, 256))
+        # Polaridad por imagen a partir del borde del frame; la máscara queda en 0/1
+        border = np.concatenate([inner[:, 0], inner[:, -1], inner[:, :, 0], inner[:, :, -1]], axis=1)
+        invert = (border > thresholds[:, None]).sum(axis=1) > border.shape[1] / 2
+        binary = np.greater(blurred, thresholds[:, None, None])
+        np.not_equal(binary, invert[:, None, None], out=binary)
+        binary = binary.view(np.uint8)
+        
+        # Apertura y cierre como erode/dilate sueltos: el relleno imita el borde de cada operación
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+        for operation in (cv2.erode, cv2.dilate, cv2.dilate, cv2.erode):
+            binary[:, :pad] = binary[:, -pad:] = 1 if operation is cv2.erode else 0
+            binary = operation(binary.reshape(-1, small_width), kernel).reshape(padded.shape)
+        
+        features = []
+        masks = np.zeros((count, height, width), dtype=np.uint8)
+        for i, image in enumerate(images):
+            unit = ImageFeatures(image)
+            # Filas interiores de una imagen: vista contigua, sin copia
+            unit.__dict__['contours'] = foreground_contours(binary[i, pad:-pad], (height, width), unit.min_area_ratio)
+            x, y, w, h = unit.segmentation['bbox']
+            masks[i, y:y + h, x:x + w] = unit.mask if unit.mask is not None else 255
+            features.append(unit)
+        
+        # Estadísticas enmascaradas por imagen sobre vistas del lote
+        hsv = hsv.reshape(count, height, width, 3)
+        channel_stats = [cv2.meanStdDev(bgr[i], mask=masks[i]) for i in range(count)]
+        h_hists = batch_histograms(hsv, 180, masks, 0)
+        s_hists = batch_histograms(hsv, 256, masks, 1)
+        v_hists = batch_histograms(hsv, 256, masks, 2)
+        
+        for i, unit in enumerate(features):
+            mean, std = channel_stats[i]
+            channels = 3 if is_color[i] else 1
+            x, y, w, h = unit.segmentation['bbox']
+            unit.__dict__.update(
+                channel_mean_std=(mean.ravel()[:channels], std.ravel()[:channels]),
+                h_hist=h_hists[i], s_hist=s_hists[i], v_hist=v_hists[i],
+                # Vista del gris del lote; laplacian_var se calcula sobre ella bajo demanda
+                gray=gray[i, y:y + h, x:x + w]
+            )
+        return features
+
+    def analyze_batch(self, items: List[Tuple[Union[bytes, str], str, str]],
+                      batch_side: int = VISION_BATCH_SIDE) -> List[Union[Dict, HTTPException]]:
+        """Analizar un lote de (imagen, tipo de producto, analysis_id) con el kernel vectorizado.
+        
+        Las imágenes se llevan a una forma común (ver `batch_shape`) y se retornan los mismos
+        resultados que `analyze_image`, en el orden de entrada. Una imagen que no se puede
+        decodificar produce su HTTPException en su posición sin afectar al resto.
+        """
+        results: List[Union[Dict, HTTPException, None]] = [None] * len(items)
+        decoded = []
+        for i, (image_data, _, _) in enumerate(items):
+            timer = StageTimer()
+            try:
+                with timer.stage('image_decode'):
+                    image, original_size = self.preprocess_image(image_data, max_side=batch_side)
+                decoded.append((i, image, original_size, timer))
+            except HTTPException as e:
+                results[i] = e
+        if not decoded:
+            return results
+        
+        try:
+            # Kernel y detección del lote, repartidos entre sus imágenes
+            batch_timer = StageTimer()
+            with batch_timer.stage('features'):
+                height, width = batch_shape([image.shape[:2] for _, image, _, _ in decoded], batch_side)
+                images = [image if image.shape[:2] == (height, width)
+                          else cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+                          for _, image, _, _ in decoded]
+                features = self.batch_features(images)
+            with batch_timer.stage('detection'):
+                defects = self.detector.detect_batch(features, [items[i][1] for i, _, _, _ in decoded])
             
-            # Realizar análisis
-            defects = self.simulate_defect_detection(image, product_type)
-            size_measurements = self.measure_size(image)
-            color_analysis = self.analyze_color(image)
-            texture_analysis = self.analyze_texture(image)
+            for (i, _, original_size, timer), unit, image_defects in zip(decoded, features, defects):
+                for stage, elapsed in batch_timer.timings.items():
+                    timer.add(stage, elapsed / len(decoded))
+                _, product_type, analysis_id = items[i]
+                results[i] = self.image_result(unit, product_type, analysis_id, original_size, image_defects, timer)
+                results[i]['processing_time'] = float(sum(timer.timings.values()))
+                results[i]['timings'] = timer.timings
+                results[i]['memory'] = timer.memory
+        except Exception as e:
+            error = HTTPException(status_code=500, detail=f"Error en análisis vectorizado: {str(e)}")
+            for i, *_ in decoded:
+                results[i] = error
+        return results
+
+    def analyze_units(self, image_data: Union[bytes, str], product_type: str, analysis_id: str,
+                      min_area_ratio: float = UNIT_MIN_AREA_RATIO, max_side: Optional[int] = None) -> Dict:
+        """Analizar cada unidad de producto de un frame (bandeja, cinta) con un solo decode y una sola conversión de color"""
+        start_time = datetime.now()
+        timer = StageTimer()
+        
+        try:
+            with timer.stage('image_decode'):
+                image, original_size = self.preprocess_image(image_data, max_side)
+            frame = ImageFeatures(image, min_area_ratio=min_area_ratio)
             
-            # Calcular confianza general basada en los análisis
-            base_confidence = 0.85
-            if defects:
-                # Ajustar confianza basada en defectos detectados
-                avg_defect_confidence = np.mean([d['confidence'] for d in defects])
-                base_confidence = (base_confidence + avg_defect_confidence) / 2
+            units = []
+            with timer.stage('segmentation'):
+                frame_units = frame.units()
+            # Todas las unidades del frame en una sola llamada al detector
+            with timer.stage('detection'):
+                unit_defects = self.detector.detect_batch(frame_units, [product_type] * len(frame_units)) if frame_units else []
+            for i, (unit, defects) in enumerate(zip(frame_units, unit_defects)):
+                unit_result = self.analyze_region(unit, product_type, original_size, defects, timer)
+                units.append({
+                    'unit_index': i,
+                    'bbox': unit_result['size_measurements']['product_bbox'],
+                    **unit_result
+                })
             
-            # Calcular tiempo de procesamiento
+            diameters = [u['size_measurements']['diameter_mm'] for u in units]
+            total_defects = sum(len(u['defects']) for u in units)
             processing_time = (datetime.now() - start_time).total_seconds() * 1000
             
             return {
+                'analysis_id': analysis_id,
+                'units': units,
+                'frame_summary': {
+                    'unit_count': len(units),
+                    'total_defects': total_defects,
+                    'severe_defects': sum(1 for u in units for d in u['defects'] if d['severity'] == 'severe'),
+                    'defects_per_unit': total_defects / len(units) if units else 0.0,
+                    'units_with_defects': sum(1 for u in units if u['defects']),
+                    'average_diameter_mm': float(np.mean(diameters)) if diameters else 0.0,
+                    'diameter_std_mm': float(np.std(diameters)) if diameters else 0.0,
+                    'min_diameter_mm': float(min(diameters)) if diameters else 0.0,
+                    'max_diameter_mm': float(max(diameters)) if diameters else 0.0,
+                    'average_confidence': float(np.mean([u['confidence_score'] for u in units])) if units else 0.0
+                },
+                'processing_time': float(processing_time),
+                'timings': timer.timings,
+                'memory': timer.memory,
+                'image_dimensions': {'width': int(original_size[0]), 'height': int(original_size[1])},
+                'analysis_resolution': {'width': int(image.shape[1]), 'height': int(image.shape[0])},
+                'product_type': product_type,
+                'analysis_timestamp': datetime.now().isoformat()
+            }
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error en análisis de unidades: {str(e)}")
+
+    def analyze_tiled(self, image_data: Union[bytes, str], product_type: str, analysis_id: str,
+                      memory_budget_mb: float = VISION_TILE_MEMORY_MB,
+                      overlap: int = VISION_TILE_OVERLAP) -> Dict:
+        """Analizar a resolución completa por tiles solapados con memoria de trabajo acotada.
+        
+        Pensado para tiras line-scan: la imagen nunca se convierte completa a array/HSV/float.
+        Histogramas y varianzas se combinan de forma exacta entre tiles (solo se cuenta el
+        núcleo de cada tile; el solape da contexto al Laplaciano y la morfología). Los defectos
+        se detectan una sola vez sobre el frame reducido, así que no dependen del número de tiles.
+        """
+        start_time = datetime.now()
+        timer = StageTimer()
+        
+        try:
+            image_bytes = decode_image_data(image_data) if isinstance(image_data, str) else image_data
+            try:
+                with timer.stage('image_decode'):
+                    image = Image.open(BytesIO(image_bytes))
+                    image.load()
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Error procesando imagen: {str(e)}")
+            width, height = image.size
+            is_color = image.mode != 'L'
+            
+            def to_array(pil_image: Image.Image) -> np.ndarray:
+                if pil_image.mode not in ('RGB', 'L'):
+                    pil_image = pil_image.convert('RGB')
+                array = np.asarray(pil_image)
+                return cv2.cvtColor(array, cv2.COLOR_RGB2BGR) if array.ndim == 3 else array
+            
+            # Umbral global y contorno del producto sobre una versión reducida (cabe en memoria)
+            segmentation_start = time.perf_counter()
+            ratio = min(1.0, np.sqrt(TILED_SEGMENTATION_PIXELS / (width * height)))
+            small_size = (max(1, int(width * ratio)), max(1, int(height * ratio)))
+            small = to_array(image.resize(small_size, Image.BILINEAR) if ratio < 1.0 else image)
+            threshold, invert = foreground_threshold(small)
+            small_binary = segment_foreground(small, threshold, invert)
+            contours, _ = cv2.findContours(small_binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            contours = [c for c in contours if cv2.contourArea(c) >= SEGMENTATION_MIN_AREA_RATIO * small_binary.size]
+            found = bool(contours)
+            timer.add('segmentation', (time.perf_counter() - segmentation_start) * 1000)
+            
+            # Defectos sobre la región del producto en el frame reducido, llevados a resolución completa
+            with timer.stage('detection'):
+                small_features = ImageFeatures(small, segment=found)
+                if found:
+                    small_features.__dict__['segmentation'] = small_features._segmentation_from_contour(
+                        max(contours, key=cv2.contourArea))
+                defects = self.detector.detect_batch([small_features], [product_type])[0]
+                defects = self.scale_defects(defects, small.shape[:2], (width, height))
+            del small, small_binary, small_features
+            
+            # Geometría de tiles según el presupuesto de memoria
+            tile_pixels = max(64 * 64, int(memory_budget_mb * 1024 * 1024 / TILE_BYTES_PER_PIXEL))
+            if (height + 2 * overlap) * 256 <= tile_pixels:
+                core_height = height  # tiras: tiles de altura completa
+            else:
+                core_height = max(64, int(np.sqrt(tile_pixels)) - 2 * overlap)
+            core_width = max(64, tile_pixels // (core_height + 2 * overlap) - 2 * overlap)
+            
+            channels = 3 if is_color else 1
+            zeros = np.zeros(channels)
+            color_moments = (0, zeros, zeros)
+            laplacian_moments = (0, np.zeros(1), np.zeros(1))
+            h_hist = np.zeros(180, np.float64)
+            s_hist = np.zeros(256, np.float64)
+            v_hist = np.zeros(256, np.float64)
+            product_pixels = 0
+            tiles = 0
+            erode_kernel = np.ones((3, 3), np.uint8)
+            tiles_start = time.perf_counter()
+            
+            for core_y in range(0, height, core_height):
+                for core_x in range(0, width, core_width):
+                    core_x1, core_y1 = min(width, core_x + core_width), min(height, core_y + core_height)
+                    x0, y0 = max(0, core_x - overlap), max(0, core_y - overlap)
+                    x1, y1 = min(width, core_x1 + overlap), min(height, core_y1 + overlap)
+                    tile = to_array(image.crop((x0, y0, x1, y1)))
+                    core = (slice(core_y - y0, core_y1 - y0), slice(core_x - x0, core_x1 - x0))
+                    tiles += 1
+                    
+                    tile_mask = segment_foreground(tile, threshold, invert) if found else None
+                    core_mask = tile_mask[core] if found else None
+                    core_image = tile[core]
+                    
+                    # Estadísticas por canal del núcleo (máscara del producto)
+                    n = cv2.countNonZero(core_mask) if found else core_image.shape[0] * core_image.shape[1]
+                    if n:
+                        mean, std = cv2.meanStdDev(core_image, mask=core_mask)
+                        color_moments = merge_moments(color_moments, (n, mean.ravel(), std.ravel() ** 2 * n))
+                        product_pixels += n
+                    
+                    if is_color:
+                        core_hsv = cv2.cvtColor(core_image, cv2.COLOR_BGR2HSV)
+                        h_hist += cv2.calcHist([core_hsv], [0], core_mask, [180], [0, 180]).ravel()
+                        s_hist += cv2.calcHist([core_hsv], [1], core_mask, [256], [0, 256]).ravel()
+                        v_hist += cv2.calcHist([core_hsv], [2], core_mask, [256], [0, 256]).ravel()
+                        del core_hsv
+                    
+                    # Laplaciano sobre el tile con solape (mismo resultado que sobre la imagen completa)
+                    gray = cv2.cvtColor(tile, cv2.COLOR_BGR2GRAY) if is_color else tile
+                    laplacian = cv2.Laplacian(gray, cv2.CV_32F)[core]
+                    laplacian_mask = cv2.erode(tile_mask, erode_kernel)[core] if found else None
+                    n = cv2.countNonZero(laplacian_mask) if found else laplacian.size
+                    if n:
+                        mean, std = cv2.meanStdDev(laplacian, mask=laplacian_mask)
+                        laplacian_moments = merge_moments(laplacian_moments, (n, mean.ravel(), std.ravel() ** 2 * n))
+                    del gray, laplacian, tile, tile_mask
+            
+            image.close()
+            # Estadísticas por tile (color, textura, máscara)
+            timer.add('tiles', (time.perf_counter() - tiles_start) * 1000)
+            
+            # Contexto con las estadísticas combinadas para reutilizar las etapas normales
+            n, means, m2 = color_moments
+            _, _, laplacian_m2 = laplacian_moments
+            if found:
+                contour = max(contours, key=cv2.contourArea)
+                scale = np.array([width / small_size[0], height / small_size[1]])
+                contour = (contour.reshape(-1, 2) * scale).astype(np.int32)
+                _, radius = cv2.minEnclosingCircle(contour)
+                segmentation = {'found': True, 'bbox': cv2.boundingRect(contour), 'mask': None,
+                                'area_pixels': float(product_pixels), 'diameter_pixels': float(2 * radius)}
+            else:
+                segmentation = {'found': False, 'bbox': (0, 0, width, height), 'mask': None,
+                                'area_pixels': float(width * height), 'diameter_pixels': float(min(width, height))}
+            features = ImageFeatures.from_statistics(
+                (height, width, 3) if is_color else (height, width),
+                segmentation=segmentation,
+                channel_mean_std=(means, np.sqrt(m2 / n) if n else zeros),
+                h_hist=h_hist, s_hist=s_hist, v_hist=v_hist,
+                laplacian_var=float(laplacian_m2[0] / laplacian_moments[0]) if laplacian_moments[0] else 0.0
+            )
+            
+            with timer.stage('size'):
+                size_measurements = self.measure_size(features, product_type, (width, height))
+            with timer.stage('color'):
+                color_analysis = self.analyze_color(features)
+            with timer.stage('texture'):
+                texture_analysis = self.analyze_texture(features)
+            base_confidence = 0.85
+            if defects:
+                base_confidence = (base_confidence + np.mean([d['confidence'] for d in defects])) / 2
+            result = {
                 'analysis_id': analysis_id,
                 'defects': defects,
                 'size_measurements': size_measurements,
                 'color_analysis': color_analysis,
                 'texture_analysis': texture_analysis,
                 'confidence_score': float(base_confidence),
-                'processing_time': float(processing_time),
+                'processing_time': 0.0,
+                'timings': timer.timings,
+                'memory': timer.memory,
                 'total_area': size_measurements['total_area_pixels'],
-                'image_dimensions': {
-                    'width': size_measurements['width_pixels'],
-                    'height': size_measurements['height_pixels']
+                'image_dimensions': {'width': int(width), 'height': int(height)},
+                'analysis_resolution': {'width': int(width), 'height': int(height)},
+                'tiling': {
+                    'tiles': tiles,
+                    'tile_core_size': {'width': int(min(core_width, width)), 'height': int(min(core_height, height))},
+                    'overlap': overlap,
+                    'memory_budget_mb': memory_budget_mb
                 },
                 'product_type': product_type,
                 'analysis_timestamp': datetime.now().isoformat()
             }
+            with timer.stage('scoring'):
+                result.update(self.scorer.score(result))
+            result['processing_time'] = float((datetime.now() - start_time).total_seconds() * 1000)
+            return result
+        except HTTPException:
+            raise
         except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error en análisis de imagen: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Error en análisis por tiles: {str(e)}")
 
 # Instancia global del analizador
 vision_ai = AgriculturalVisionAI()
 
-@app.post("/analyze-image", response_model=ImageAnalysisResponse)
-async def analyze_image(request: ImageAnalysisRequest):
+# Configuración de ejecución (0 workers = hilo único en el proceso principal)
+VISION_WORKERS = int(os.getenv("VISION_WORKERS", str(os.cpu_count() or 1)))
+VISION_MAX_QUEUE = int(os.getenv("VISION_MAX_QUEUE", str(max(1, VISION_WORKERS) * 4)))
+VISION_QUEUE_TIMEOUT = float(os.getenv("VISION_QUEUE_TIMEOUT", "30"))
+VISION_BATCH_CONCURRENCY = int(os.getenv("VISION_BATCH_CONCURRENCY", str(max(1, VISION_WORKERS))))
+VISION_CACHE_MAX_ENTRIES = int(os.getenv("VISION_CACHE_MAX_ENTRIES", "1024"))  # 0 = caché desactivada
+VISION_CACHE_TTL = float(os.getenv("VISION_CACHE_TTL", "3600"))
+# Micro-lotes de /analyze-image hacia el detector (1 = desactivado)
+VISION_MICROBATCH_MAX_SIZE = int(os.getenv("VISION_MICROBATCH_MAX_SIZE", "8"))
+VISION_MICROBATCH_MAX_WAIT_MS = float(os.getenv("VISION_MICROBATCH_MAX_WAIT_MS", "5"))
+# Trabajos asíncronos: tamaño de la cola, trabajos simultáneos, retención de resultados y callbacks
+VISION_JOB_MAX_QUEUE = int(os.getenv("VISION_JOB_MAX_QUEUE", "100"))
+VISION_JOB_CONCURRENCY = int(os.getenv("VISION_JOB_CONCURRENCY", str(max(1, VISION_WORKERS))))
+VISION_JOB_TTL = float(os.getenv("VISION_JOB_TTL", "3600"))
+VISION_JOB_MAX_RETAINED = int(os.getenv("VISION_JOB_MAX_RETAINED", "1000"))
+VISION_JOB_CALLBACK_TIMEOUT = float(os.getenv("VISION_JOB_CALLBACK_TIMEOUT", "10"))
+VISION_JOB_CALLBACK_RETRIES = 3
+# Agregación por lote (batch_id): lotes retenidos y segundos desde su última imagen
+VISION_LOT_MAX_LOTS = int(os.getenv("VISION_LOT_MAX_LOTS", "1000"))
+VISION_LOT_TTL = float(os.getenv("VISION_LOT_TTL", "86400"))
+# Estado de deduplicación por lote: posiciones en un bytearray (un byte por unidad) y hashes en un LRU
+VISION_LOT_MAX_INDEXED_UNITS = int(os.getenv("VISION_LOT_MAX_INDEXED_UNITS", "100000"))
+VISION_LOT_MAX_HASHED_UNITS = int(os.getenv("VISION_LOT_MAX_HASHED_UNITS", "10000"))
+# Control de admisión del análisis síncrono: peticiones en curso y en espera (0 en curso = desactivado)
+VISION_ADMISSION_MAX_IN_FLIGHT = int(os.getenv(
+    "VISION_ADMISSION_MAX_IN_FLIGHT", str(max(1, VISION_WORKERS) * max(1, VISION_MICROBATCH_MAX_SIZE))))
+VISION_ADMISSION_MAX_QUEUE = int(os.getenv("VISION_ADMISSION_MAX_QUEUE", "64"))
+# Rutas bajo control de admisión (incluye /raw y /analyze-batch/...)
+ADMISSION_PATH_PREFIXES = ("/analyze-image", "/analyze-units", "/analyze-batch")
+# Semilla fija del simulador en cada worker (benchmarks reproducibles); vacío = aleatoria
+VISION_RANDOM_SEED = os.getenv("VISION_RANDOM_SEED", "")
+# Perfilado por petición: directorio de perfiles, fracción muestreada y límites del directorio
+VISION_PROFILE_DIR = os.getenv("VISION_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "vision-profiles"))
+VISION_PROFILE_SAMPLE_RATE = float(os.getenv("VISION_PROFILE_SAMPLE_RATE", "0"))
+VISION_PROFILE_MAX_MB = float(os.getenv("VISION_PROFILE_MAX_MB", "100"))
+VISION_PROFILE_MAX_FILES = int(os.getenv("VISION_PROFILE_MAX_FILES", "200"))
+VISION_PROFILE_RETENTION_HOURS = float(os.getenv("VISION_PROFILE_RETENTION_HOURS", "72"))
+
+def analysis_pixels(size: Tuple[int, int], image_format: Optional[str], max_side: int) -> Tuple[int, int]:
+    """Píxeles que decodifica preprocess_image y píxeles de la imagen de análisis resultante"""
+    width, height = size
+    target = (width, height)
+    if max_side and max(size) > max_side:
+        ratio = max_side / max(size)
+        target = (max(1, int(width * ratio)), max(1, int(height * ratio)))
+    decoded = (width, height)
+    if image_format == "JPEG" and target != decoded:
+        # draft(): mayor escala DCT (1/8, 1/4, 1/2) que no baja del tamaño pedido
+        for scale in (8, 4, 2):
+            if width // scale >= target[0] and height // scale >= target[1]:
+                decoded = (-(-width // scale), -(-height // scale))
+                break
+    return decoded[0] * decoded[1], target[0] * target[1]
+
+def estimate_analysis_memory(size: Tuple[int, int], image_format: Optional[str], max_side: int,
+                             payload_bytes: int = 0) -> int:
+    """Memoria de trabajo estimada (bytes) para analizar una imagen con lado máximo `max_side`"""
+    decoded, analyzed = analysis_pixels(size, image_format, max_side)
+    # Imagen comprimida + buffer decodificado de PIL + contexto de análisis (BGR, HSV, gris, máscaras, Laplaciano)
+    return payload_bytes + decoded * DECODE_BYTES_PER_PIXEL + analyzed * TILE_BYTES_PER_PIXEL
+
+def memory_budget_max_side(size: Tuple[int, int], image_format: Optional[str], max_side: int,
+                           payload_bytes: int = 0) -> int:
+    """Lado máximo de análisis que cabe en VISION_REQUEST_MEMORY_MB.
+    
+    Retorna `max_side` si la imagen cabe; con la acción "downsample" un lado menor que quepa
+    (efectivo sobre todo en JPEG, que se decodifica ya reducido). Si no cabe, 413.
+    """
+    budget = int(VISION_REQUEST_MEMORY_MB * 1024 * 1024)
+    estimate = estimate_analysis_memory(size, image_format, max_side, payload_bytes)
+    if budget <= 0 or estimate <= budget:
+        return max_side
+    
+    if VISION_MEMORY_BUDGET_ACTION == "downsample":
+        side = min(max_side or max(size), max(size))
+        while side > MEMORY_BUDGET_MIN_SIDE:
+            side = max(MEMORY_BUDGET_MIN_SIDE, side // 2)
+            if estimate_analysis_memory(size, image_format, side, payload_bytes) <= budget:
+                vision_metrics.observe_memory_budget("downsample")
+                return side
+    
+    vision_metrics.observe_memory_budget("reject")
+    raise _memory_budget_error(size, estimate)
+
+def estimate_tiled_memory(size: Tuple[int, int], payload_bytes: int = 0,
+                          tile_memory_mb: float = VISION_TILE_MEMORY_MB) -> int:
+    """Memoria estimada (bytes) del modo por tiles: el frame se decodifica completo y cada tile se procesa aparte"""
+    pixels = size[0] * size[1]
+    return (payload_bytes + pixels * DECODE_BYTES_PER_PIXEL
+            + min(int(tile_memory_mb * 1024 * 1024), pixels * TILE_BYTES_PER_PIXEL))
+
+def check_tiled_memory(size: Tuple[int, int], payload_bytes: int = 0):
+    """413 si el frame decodificado y los tiles no caben en VISION_REQUEST_MEMORY_MB (tiled no reduce resolución)"""
+    budget = int(VISION_REQUEST_MEMORY_MB * 1024 * 1024)
+    estimate = estimate_tiled_memory(size, payload_bytes)
+    if budget > 0 and estimate > budget:
+        vision_metrics.observe_memory_budget("reject")
+        raise _memory_budget_error(size, estimate)
+
+def _memory_budget_error(size: Tuple[int, int], estimate: int) -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=(f"Imagen de {size[0]}x{size[1]} requiere ~{estimate / 1024 / 1024:.0f} MB, supera el presupuesto "
+                f"de {VISION_REQUEST_MEMORY_MB:g} MB por petición")
+    )
+
+def check_declared_size(width: Optional[int], height: Optional[int], tiled: bool = False):
+    """Rechazar antes de leer/decodificar el cuerpo si X-Image-Width/X-Image-Height no caben en el presupuesto"""
+    if not width or not height or VISION_REQUEST_MEMORY_MB <= 0:
+        return
+    if tiled:
+        check_tiled_memory((width, height))
+        return
+    # Sin conocer el formato se asume el mejor caso (JPEG reducido al decodificar);
+    # la cabecera real de la imagen se comprueba después en run_analysis
+    memory_budget_max_side((width, height), "JPEG", vision_ai.analysis_max_side)
+
+def image_header(image_bytes: bytes) -> Optional[Tuple[Tuple[int, int], str]]:
+    """Tamaño y formato leídos de la cabecera de la imagen, sin decodificar píxeles"""
+    try:
+        with Image.open(BytesIO(image_bytes)) as image:
+            return image.size, image.format
+    except Exception:
+        # Imagen inválida: el worker responde el 400 habitual
+        return None
+
+class AnalysisError(Exception):
+    """Error de análisis serializable entre procesos (HTTPException no lo es)"""
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+class ProfileStore:
+    """Directorio de perfiles por analysis_id con límite de tamaño, de archivos y de antigüedad"""
+    def __init__(self, directory: str, max_mb: float, max_files: int, retention_hours: float):
+        self.directory = directory
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_files = max_files
+        self.retention_seconds = retention_hours * 3600
+
+    def path_for(self, analysis_id: str, extension: str) -> str:
+        # analysis_id llega del cliente: solo caracteres seguros para un nombre de archivo
+        safe_id = re.sub(r"[^A-Za-z0-9_.-]", "_", analysis_id)[:100]
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f"{safe_id}_{int(time.time() * 1000)}.{extension}")
+
+    def list(self) -> List[Dict]:
+        """Perfiles guardados, del más reciente al más antiguo"""
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue  # borrado por otro worker
+            entries.append({"file": name, "size_bytes": stat.st_size, "modified": stat.st_mtime})
+        return sorted(entries, key=lambda entry: entry["modified"], reverse=True)
+
+    def enforce_limits(self):
+        """Borrar perfiles caducados y, después, los más antiguos hasta cumplir los límites"""
+        now = time.time()
+        total = 0
+        for index, entry in enumerate(self.list()):
+            total += entry["size_bytes"]
+            if (now - entry["modified"] > self.retention_seconds or total > self.max_bytes
+                    or index >= self.max_files):
+                try:
+                    os.remove(os.path.join(self.directory, entry["file"]))
+                except FileNotFoundError:
+                    pass
+
+    def run(self, analysis_id: str, fn, *args):
+        """Ejecutar fn(*args) bajo el perfilador; retorna (resultado, nombre del perfil)"""
+        try:
+            if SamplingProfiler is not None:
+                profiler = SamplingProfiler()
+                profiler.start()
+                try:
+                    result = fn(*args)
+                finally:
+                    profiler.stop()
+                    path = self.path_for(analysis_id, "html")
+                    with open(path, "w", encoding="utf-8") as f:
+                        f.write(profiler.output_html())
+            else:
+                profiler = cProfile.Profile()
+                try:
+                    result = profiler.runcall(fn, *args)
+                finally:
+                    # Se guarda también si el análisis falla: suele ser el caso interesante
+                    path = self.path_for(analysis_id, "prof")
+                    profiler.dump_stats(path)
+        finally:
+            # Los perfiles de análisis fallidos también cuentan para los límites del directorio
+            self.enforce_limits()
+        return result, os.path.basename(path)
+
+profile_store = ProfileStore(VISION_PROFILE_DIR, VISION_PROFILE_MAX_MB, VISION_PROFILE_MAX_FILES,
+                             VISION_PROFILE_RETENTION_HOURS)
+
+def profile_requested(x_profile: Optional[str]) -> bool:
+    """Header X-Profile: "1", "true", "yes" u "on" activan el perfilado de la petición"""
+    return (x_profile or "").strip().lower() in ("1", "true", "yes", "on")
+
+# Analizador propio de cada worker, creado una sola vez al arrancar el proceso
+_worker_ai: Optional[AgriculturalVisionAI] = None
+
+def _init_worker():
+    """Inicializar el analizador del worker"""
+    global _worker_ai
+    # Los workers creados con fork heredan el mismo estado del RNG: re-sembrar
+    np.random.seed(int(VISION_RANDOM_SEED) if VISION_RANDOM_SEED else None)
+    if VISION_MEMORY_TRACKING == "tracemalloc" and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    stage_memory.active = True
+    _worker_ai = AgriculturalVisionAI()
+
+def _analyze_in_worker(image_data: Union[bytes, str], product_type: str, analysis_id: str,
+                       mode: str = "image", profile: bool = False, max_side: Optional[int] = None) -> Dict:
+    """Ejecutar el análisis dentro de un worker del pool (mode: "image", "units" o "tiled").
+    
+    Con `profile` el análisis corre bajo el perfilador y el resultado indica el archivo en `profile_file`.
+    `max_side` reduce la resolución de análisis (presupuesto de memoria).
+    """
+    if mode == "units":
+        analyze = partial(_worker_ai.analyze_units, max_side=max_side)
+    elif mode == "tiled":
+        analyze = _worker_ai.analyze_tiled
+    else:
+        analyze = partial(_worker_ai.analyze_image, max_side=max_side)
+    try:
+        if profile:
+            result, profile_file = profile_store.run(analysis_id, analyze, image_data, product_type, analysis_id)
+            result['profile_file'] = profile_file
+            return result
+        return analyze(image_data, product_type, analysis_id)
+    except HTTPException as e:
+        raise AnalysisError(e.status_code, str(e.detail))
+
+def _portable_results(results: List[Union[Dict, HTTPException]]) -> List[Union[Dict, AnalysisError]]:
+    # Los errores por imagen viajan al proceso principal como AnalysisError
+    return [AnalysisError(r.status_code, str(r.detail)) if isinstance(r, HTTPException) else r for r in results]
+
+def _analyze_batch_in_worker(items: List[Tuple[bytes, str, str]]) -> List[Union[Dict, AnalysisError]]:
+    """Kernel vectorizado dentro de un worker"""
+    return _portable_results(_worker_ai.analyze_batch(items))
+
+def _analyze_images_in_worker(items: List[Tuple[bytes, str, str]]) -> List[Union[Dict, AnalysisError]]:
+    """Micro-lote de imágenes independientes (una llamada al detector) dentro de un worker"""
+    return _portable_results(_worker_ai.analyze_images(items))
+
+class AnalysisExecutor:
+    """Pool de procesos para el análisis CPU-bound con cola acotada (backpressure)"""
+    def __init__(self, workers: int, max_queue: int, queue_timeout: float):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._pool = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._in_flight = 0
+        self._waiting = 0
+
+    def start(self):
+        """Crear el pool y los cupos de la cola"""
+        if self._pool is not None:
+            return
+        self._pool = self._create_pool()
+        # Cupos = workers ocupados + peticiones en espera
+        self._slots = asyncio.Semaphore(max(1, self.workers) + self.max_queue)
+
+    def _create_pool(self):
+        if self.workers > 0:
+            return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+        return ThreadPoolExecutor(max_workers=1, initializer=_init_worker)
+
+    def shutdown(self):
+        """Cerrar el pool esperando los análisis en curso"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+            self._slots = None
+
+    async def run(self, fn, *args):
+        """Ejecutar fn(*args) en el pool; 503 si la cola está llena durante queue_timeout"""
+        self.start()
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=503,
+                detail="Servidor de visión saturado, reintente más tarde",
+                headers={"Retry-After": str(int(self.queue_timeout))}
+            )
+        finally:
+            self._waiting -= 1
+        
+        self._in_flight += 1
+        pool = self._pool
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(pool, fn, *args)
+        except AnalysisError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        except BrokenProcessPool:
+            # Un worker murió (p.ej. OOM): cerrar el pool roto y recrearlo para las siguientes peticiones
+            # (una sola vez aunque fallen varias peticiones del mismo pool)
+            if self._pool is pool:
+                print("❌ Pool de análisis roto, reiniciando workers")
+                pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = self._create_pool()
+            raise HTTPException(status_code=500, detail="Worker de análisis terminó inesperadamente")
+        finally:
+            self._in_flight -= 1
+            self._slots.release()
+
+    def stats(self) -> Dict:
+        """Estado actual del pool"""
+        return {
+            "workers": self.workers,
+            "mode": "process" if self.workers > 0 else "thread",
+            "max_queue": self.max_queue,
+            "in_flight": self._in_flight,
+            "waiting": self._waiting
+        }
+
+analysis_executor = AnalysisExecutor(VISION_WORKERS, VISION_MAX_QUEUE, VISION_QUEUE_TIMEOUT)
+
+class MicroBatchScheduler:
+    """Agrupa peticiones concurrentes de análisis de imagen en micro-lotes para el detector.
+    
+    Con algún worker libre la petición se despacha sin esperar. Con todos ocupados las peticiones
+    se acumulan y el lote sale al llenarse (max_batch_size), al terminar otro lote o cuando vence
+    max_wait_ms desde que se abrió. Cada lote es una sola tarea del pool, sujeta a la cola acotada
+    del AnalysisExecutor.
+    """
+    def __init__(self, executor: AnalysisExecutor, max_batch_size: int, max_wait_ms: float):
+        self.executor = executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max_wait_ms
+        self._pending: List[Tuple[Tuple[bytes, str, str], asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._in_flight = 0
+        self.batches = 0
+        self.items = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_batch_size > 1
+
+    async def submit(self, image_data: bytes, product_type: str, analysis_id: str) -> Dict:
+        """Encolar una imagen y esperar su resultado"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(((image_data, product_type, analysis_id), future))
+        if len(self._pending) >= self.max_batch_size or self._in_flight < max(1, self.executor.workers):
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait_ms / 1000, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            self._in_flight += 1
+            asyncio.ensure_future(self._dispatch(batch))
+
+    async def _dispatch(self, batch: List[Tuple[Tuple[bytes, str, str], asyncio.Future]]):
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            outputs = await self.executor.run(_analyze_images_in_worker, [item for item, _ in batch])
+        except Exception as e:
+            # Cola llena (503), pool roto, etc.: el error es el mismo para todo el lote
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._in_flight -= 1
+            # Un worker quedó libre: despachar lo acumulado sin esperar al temporizador
+            if self._pending:
+                self._flush()
+        
+        for (_, future), output in zip(batch, outputs):
+            if future.done():
+                # Petición cancelada mientras se analizaba (cliente desconectado)
+                continue
+            if isinstance(output, AnalysisError):
+                future.set_exception(HTTPException(status_code=output.status_code, detail=output.detail))
+            else:
+                future.set_result(output)
+
+    def stats(self) -> Dict:
+        """Tamaño configurado y tamaño medio real de los micro-lotes"""
+        return {
+            "enabled": self.enabled,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_ms,
+            "batches": self.batches,
+            "items": self.items,
+            "average_batch_size": self.items / self.batches if self.batches else 0.0,
+            "pending": len(self._pending),
+            "in_flight": self._in_flight
+        }
+
+microbatch_scheduler = MicroBatchScheduler(analysis_executor, VISION_MICROBATCH_MAX_SIZE, VISION_MICROBATCH_MAX_WAIT_MS)
+
+class ResultCache:
+    """Caché LRU con TTL de resultados de análisis, indexada por el contenido de la imagen"""
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @staticmethod
+    def key(image_bytes: bytes, product_type: str, mode: str = "image") -> str:
+        """Hash de los bytes de la imagen + tipo de producto (+ modo de análisis)"""
+        digest = hashlib.sha256(image_bytes)
+        digest.update(b"\x00" + product_type.encode("utf-8") + b"\x00" + mode.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        stored_at, result = entry
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return copy.deepcopy(result)
+
+    def put(self, key: str, result: Dict):
+        self._entries[key] = (time.monotonic(), copy.deepcopy(result))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+class BatchSummary:
+    """Resumen incremental de un lote (memoria constante, no guarda resultados)"""
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.completed = 0
+        self.errors = 0
+        self.total_defects = 0
+        self.confidence_sum = 0.0
+        self.processing_time_total = 0.0
+        self._wall_start = time.perf_counter()
+
+    def add(self, result: Dict):
+        self.completed += 1
+        self.total_defects += len(result['defects'])
+        self.confidence_sum += result['confidence_score']
+        self.processing_time_total += result['processing_time']
+
+    def add_error(self):
+        self.errors += 1
+
+    def as_dict(self) -> Dict:
+        wall_clock_time = (time.perf_counter() - self._wall_start) * 1000
+        return {
+            "total_defects": self.total_defects,
+            "average_confidence": self.confidence_sum / self.completed if self.completed else 0.0,
+            "processing_time_total": self.processing_time_total,
+            "wall_clock_time": wall_clock_time,
+            "speedup": self.processing_time_total / wall_clock_time if wall_clock_time > 0 else 1.0,
+            "concurrency": self.concurrency,
+            "errors": self.errors
+        }
+
+class RunningStats:
+    """Media y varianza incrementales (Welford), con mínimo y máximo"""
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self._m2 / self.count) if self.count else 0.0
+
+# Estado de una unidad del lote
+UNIT_FAILED, UNIT_ANALYZED = 1, 2
+
+class LotStatistics:
+    """Agregados de un lote (batch_id) actualizados imagen a imagen.
+    
+    Solo guarda contadores por grado, tamaño y tipo de defecto (conjuntos acotados por los
+    estándares) y medias/varianzas de Welford, nunca los resultados individuales. Cada unidad
+    se identifica (posición en el lote o hash del contenido) para que los reintentos, las
+    respuestas en caché y los sub-lotes repetidos no la cuenten dos veces: las posiciones
+    ocupan un byte cada una hasta `VISION_LOT_MAX_INDEXED_UNITS` y los hashes van a un LRU de
+    `VISION_LOT_MAX_HASHED_UNITS` entradas (un reintento de una unidad ya expulsada del LRU
+    se vuelve a contar).
+    """
+    def __init__(self, batch_id: str, product_type: str, total_units: Optional[int] = None,
+                 expected_images: Optional[int] = None):
+        self.batch_id = batch_id
+        self.product_type = product_type
+        self.total_units = total_units
+        # Imágenes que completan el lote, si difieren de las unidades declaradas
+        self.expected_images = expected_images
+        self.analyzed_units = 0
+        self.failed_units = 0
+        self.duplicate_units = 0
+        # Unidad -> UNIT_FAILED / UNIT_ANALYZED (0 = sin ver en el bytearray)
+        self.indexed_units = bytearray()
+        self.hashed_units: "OrderedDict[Union[int, str], int]" = OrderedDict()
+        self.quality_scores = RunningStats()
+        self.diameters = RunningStats()
+        self.quality_distribution = {grade: 0 for _, grade in GRADE_THRESHOLDS}
+        self.quality_distribution[REJECTED_GRADE] = 0
+        self.size_distribution = {category: 0 for category in
+                                  vision_ai.scorer.standards_for(product_type)['size_categories']}
+        self.defect_types: Dict[str, int] = {}
+        self.total_defects = 0
+        self.severe_defects = 0
+        self.units_with_defects = 0
+        self.compliant_units = 0
+        self.started_at = time.time()
+        self.updated_at = self.started_at
+        self.completed_at: Optional[float] = None
+        # La primera respuesta tras completarse lo informa con completed_now
+        self.completion_reported = False
+
+    @property
+    def expected(self) -> Optional[int]:
+        return self.expected_images or self.total_units
+
+    @property
+    def complete(self) -> bool:
+        return bool(self.expected) and self.analyzed_units + self.failed_units >= self.expected
+
+    def _touch(self):
+        self.updated_at = time.time()
+        if self.completed_at is None and self.complete:
+            self.completed_at = self.updated_at
+
+    def _count(self, unit: Union[int, str], analyzed: bool) -> bool:
+        """Registrar la unidad; False si ya estaba contada (una fallida sí puede pasar a analizada)"""
+        indexed_size = min(self.expected or 0, VISION_LOT_MAX_INDEXED_UNITS)
+        indexed = isinstance(unit, int) and 0 <= unit < indexed_size
+        if indexed and len(self.indexed_units) < indexed_size:
+            self.indexed_units.extend(bytes(indexed_size - len(self.indexed_units)))
+            # Posiciones vistas antes de conocer total_units
+            for key in [key for key in self.hashed_units if isinstance(key, int) and 0 <= key < indexed_size]:
+                self.indexed_units[key] = self.hashed_units.pop(key)
+        previous = self.indexed_units[unit] if indexed else self.hashed_units.get(unit, 0)
+        if previous == UNIT_ANALYZED or (previous == UNIT_FAILED and not analyzed):
+            self.duplicate_units += 1
+            return False
+        if previous == UNIT_FAILED:
+            self.failed_units -= 1
+        state = UNIT_ANALYZED if analyzed else UNIT_FAILED
+        if indexed:
+            self.indexed_units[unit] = state
+        else:
+            self.hashed_units[unit] = state
+            self.hashed_units.move_to_end(unit)
+            while len(self.hashed_units) > VISION_LOT_MAX_HASHED_UNITS:
+                self.hashed_units.popitem(last=False)
+        return True
+
+    def add(self, result: Dict, unit: Union[int, str]):
+        """Sumar el resultado puntuado de una imagen"""
+        if not self._count(unit, True):
+            return
+        score = result['quality_score']
+        self.analyzed_units += 1
+        self.quality_scores.add(score)
+        self.diameters.add(result['measured_diameter'])
+        self.quality_distribution[result['quality_grade']] = self.quality_distribution.get(result['quality_grade'], 0) + 1
+        self.size_distribution[result['size_category']] = self.size_distribution.get(result['size_category'], 0) + 1
+        defects = result['defects']
+        for defect in defects:
+            self.defect_types[defect['type']] = self.defect_types.get(defect['type'], 0) + 1
+        self.total_defects += len(defects)
+        self.severe_defects += result['severe_defects']
+        self.units_with_defects += int(bool(defects))
+        min_score = vision_ai.scorer.standards_for(self.product_type).get('min_quality_score', GRADE_THRESHOLDS[-1][0])
+        self.compliant_units += int(score >= min_score)
+        self._touch()
+
+    def add_error(self, unit: Union[int, str]):
+        """Contar una imagen del lote que no se pudo analizar"""
+        if not self._count(unit, False):
+            return
+        self.failed_units += 1
+        self._touch()
+
+    def summary(self, claim: bool = False) -> Dict:
+        """Resumen del lote (formato `batch_analysis` del workflow de n8n).
+        
+        Con `claim`, `completed_now` es True solo en el primer resumen pedido tras completarse.
+        """
+        completed_now = claim and self.complete and not self.completion_reported
+        self.completion_reported = self.completion_reported or completed_now
+        
+        def iso(timestamp: Optional[float]) -> Optional[str]:
+            return datetime.fromtimestamp(timestamp).isoformat() if timestamp else None
+        
+        analyzed = self.analyzed_units
+        common_defects = sorted(self.defect_types.items(), key=lambda item: -item[1])[:3]
+        return {
+            "batch_id": self.batch_id,
+            "product_type": self.product_type,
+            "total_units": self.total_units or analyzed + self.failed_units,
+            "expected_images": self.expected,
+            "analyzed_units": analyzed,
+            "failed_units": self.failed_units,
+            "duplicate_units": self.duplicate_units,
+            "complete": self.complete,
+            "completed_now": completed_now,
+            "quality_distribution": dict(self.quality_distribution),
+            "defect_statistics": {
+                "total_defects": self.total_defects,
+                "defects_per_unit": self.total_defects / analyzed if analyzed else 0.0,
+                "severe_defects": self.severe_defects,
+                "units_with_defects": self.units_with_defects,
+                "common_defect_types": [defect_type for defect_type, _ in common_defects],
+                "defect_type_counts": dict(self.defect_types)
+            },
+            "size_distribution": dict(self.size_distribution),
+            "quality_grade": quality_grade(self.quality_scores.mean) if analyzed else None,
+            "size_category": max(self.size_distribution, key=self.size_distribution.get) if analyzed else None,
+            "average_quality_score": self.quality_scores.mean,
+            "quality_score_std": self.quality_scores.std,
+            "quality_score_min": self.quality_scores.min,
+            "quality_score_max": self.quality_scores.max,
+            "average_diameter_mm": self.diameters.mean,
+            "diameter_std_mm": self.diameters.std,
+            "compliance_rate": self.compliant_units / analyzed if analyzed else 0.0,
+            "rejection_rate": self.quality_distribution[REJECTED_GRADE] / analyzed if analyzed else 0.0,
+            "started_at": iso(self.started_at),
+            "updated_at": iso(self.updated_at),
+            "completed_at": iso(self.completed_at)
+        }
+
+class LotAggregator:
+    """Lotes en curso por batch_id (LRU con TTL desde la última imagen)"""
+    def __init__(self, max_lots: int, ttl_seconds: float):
+        self.max_lots = max_lots
+        self.ttl_seconds = ttl_seconds
+        self._lots: "OrderedDict[str, LotStatistics]" = OrderedDict()
+        self.evictions = 0
+
+    def _lot(self, batch_id: str, product_type: str, total_units: Optional[int],
+             expected_images: Optional[int] = None) -> LotStatistics:
+        self._purge()
+        lot = self._lots.get(batch_id)
+        if lot is None:
+            lot = self._lots[batch_id] = LotStatistics(batch_id, product_type, total_units, expected_images)
+            while len(self._lots) > self.max_lots:
+                self._lots.popitem(last=False)
+                self.evictions += 1
+        else:
+            if total_units:
+                lot.total_units = max(lot.total_units or 0, total_units)
+            if expected_images:
+                lot.expected_images = max(lot.expected_images or 0, expected_images)
+        self._lots.move_to_end(batch_id)
+        return lot
+
+    def _purge(self):
+        now = time.time()
+        while self._lots:
+            batch_id, lot = next(iter(self._lots.items()))
+            if now - lot.updated_at <= self.ttl_seconds:
+                break
+            del self._lots[batch_id]
+
+    def add(self, batch_id: str, product_type: str, result: Dict, unit: Union[int, str],
+            total_units: Optional[int] = None, expected_images: Optional[int] = None):
+        self._lot(batch_id, product_type, total_units, expected_images).add(result, unit)
+
+    def add_error(self, batch_id: str, product_type: str, unit: Union[int, str], total_units: Optional[int] = None,
+                  expected_images: Optional[int] = None):
+        self._lot(batch_id, product_type, total_units, expected_images).add_error(unit)
+
+    def summary(self, batch_id: str, product_type: Optional[str] = None, total_units: Optional[int] = None,
+                expected_images: Optional[int] = None, claim: bool = False) -> Dict:
+        """Resumen del lote; si aún no tiene unidades, 404 o (con `product_type`) un resumen vacío.
+        
+        Las respuestas de análisis pasan `claim` para que solo una informe `completed_now`.
+        """
+        self._purge()
+        lot = self._lots.get(batch_id)
+        if lot is None:
+            if product_type is None:
+                raise HTTPException(status_code=404, detail=f"Lote {batch_id} no encontrado o expirado")
+            return LotStatistics(batch_id, product_type, total_units, expected_images).summary()
+        return lot.summary(claim)
+
+    def stats(self) -> Dict:
+        self._purge()
+        return {
+            "lots": len(self._lots),
+            "complete": sum(1 for lot in self._lots.values() if lot.complete),
+            "max_lots": self.max_lots,
+            "ttl_seconds": self.ttl_seconds,
+            "evictions": self.evictions
+        }
+
+def lot_unit_key(image_data: Union[bytes, str]) -> str:
+    """Identificador de una unidad del lote por su contenido, cuando no se conoce su posición"""
+    return hashlib.sha256(image_data.encode("utf-8") if isinstance(image_data, str) else image_data).hexdigest()
+
+result_cache = ResultCache(VISION_CACHE_MAX_ENTRIES, VISION_CACHE_TTL)
+lot_aggregator = LotAggregator(VISION_LOT_MAX_LOTS, VISION_LOT_TTL)
+
+# Límites de los buckets de latencia (segundos) y de tamaño de imagen (bytes)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PAYLOAD_BUCKETS = (16_000, 64_000, 256_000, 1_000_000, 4_000_000, 16_000_000, 64_000_000)
+MEMORY_BUCKETS = (1_000_000, 4_000_000, 16_000_000, 64_000_000, 256_000_000, 1_000_000_000, 4_000_000_000)
+
+class Histogram:
+    """Histograma acumulativo con buckets fijos (semántica `le` de Prometheus)"""
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> List[str]:
+        sep = "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum:.6f}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+def _labels(**labels: str) -> str:
+    return ",".join(f'{key}="{value}"' for key, value in labels.items())
+
+class VisionMetrics:
+    """Métricas del proceso principal (latencias por etapa, peticiones, payloads, errores)"""
+    def __init__(self, product_types: List[str]):
+        # product_type llega del cliente: fuera de la lista conocida se agrupa en "other"
+        self.product_types = set(product_types)
+        self.stage_durations: Dict[Tuple[str, str], Histogram] = {}
+        self.stage_memory: Dict[Tuple[str, str], Histogram] = {}
+        self.memory_budget: Dict[str, int] = {}
+        self.analysis_durations: Dict[Tuple[str, str], Histogram] = {}
+        self.request_durations: Dict[Tuple[str, str], Histogram] = {}
+        self.requests: Dict[Tuple[str, str, str], int] = {}
+        self.payload_sizes: Dict[str, Histogram] = {}
+        self.errors: Dict[Tuple[str, str], int] = {}
+        self.in_flight = 0
+        self.profiles = 0
+
+    def _product(self, product_type: str) -> str:
+        return product_type if product_type in self.product_types else "other"
+
+    @staticmethod
+    def _histogram(histograms: Dict, key, buckets: Tuple[float, ...]) -> Histogram:
+        if key not in histograms:
+            histograms[key] = Histogram(buckets)
+        return histograms[key]
+
+    def observe_analysis(self, mode: str, product_type: str, timings: Dict[str, float], total_ms: float,
+                         memory: Optional[Dict[str, int]] = None):
+        """Registrar las etapas (ms), sus picos de memoria (bytes) y la latencia total de un análisis"""
+        product = self._product(product_type)
+        for stage, elapsed in timings.items():
+            self._histogram(self.stage_durations, (stage, product), LATENCY_BUCKETS).observe(elapsed / 1000)
+        for stage, peak in (memory or {}).items():
+            self._histogram(self.stage_memory, (stage, product), MEMORY_BUCKETS).observe(peak)
+        self._histogram(self.analysis_durations, (mode, product), LATENCY_BUCKETS).observe(total_ms / 1000)
+
+    def observe_payload(self, mode: str, size: int):
+        self._histogram(self.payload_sizes, mode, PAYLOAD_BUCKETS).observe(size)
+
+    def observe_memory_budget(self, action: str):
+        self.memory_budget[action] = self.memory_budget.get(action, 0) + 1
+
+    def observe_error(self, mode: str, status_code: int):
+        key = (mode, str(status_code))
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def observe_request(self, method: str, path: str, status_code: int, elapsed: float):
+        key = (method, path, str(status_code))
+        self.requests[key] = self.requests.get(key, 0) + 1
+        self._histogram(self.request_durations, (method, path), LATENCY_BUCKETS).observe(elapsed)
+
+    def render(self) -> str:
+        """Exposición en formato de texto de Prometheus (0.0.4)"""
+        lines = []
+        
+        def family(name: str, kind: str, help_text: str):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+        
+        family("vision_requests_total", "counter", "Peticiones HTTP por método, ruta y estado")
+        for (method, path, status), count in sorted(self.requests.items()):
+            lines.append(f"vision_requests_total{{{_labels(method=method, path=path, status=status)}}} {count}")
+        family("vision_requests_in_flight", "gauge", "Peticiones HTTP en curso")
+        lines.append(f"vision_requests_in_flight {self.in_flight}")
+        family("vision_request_duration_seconds", "histogram", "Latencia HTTP por método y ruta")
+        for (method, path), histogram in sorted(self.request_durations.items()):
+            lines.extend(histogram.render("vision_request_duration_seconds", _labels(method=method, path=path)))
+        family("vision_analysis_duration_seconds", "histogram", "Latencia de análisis por modo y producto")
+        for (mode, product), histogram in sorted(self.analysis_durations.items()):
+            lines.extend(histogram.render("vision_analysis_duration_seconds", _labels(mode=mode, product_type=product)))
+        family("vision_stage_duration_seconds", "histogram", "Duración de cada etapa del análisis por producto")
+        for (stage, product), histogram in sorted(self.stage_durations.items()):
+            lines.extend(histogram.render("vision_stage_duration_seconds", _labels(stage=stage, product_type=product)))
+        family("vision_stage_peak_memory_bytes", "histogram",
+               "Pico de memoria de cada etapa por producto (VISION_MEMORY_TRACKING)")
+        for (stage, product), histogram in sorted(self.stage_memory.items()):
+            lines.extend(histogram.render("vision_stage_peak_memory_bytes", _labels(stage=stage, product_type=product)))
+        family("vision_memory_budget_total", "counter", "Imágenes rechazadas o reducidas por el presupuesto de memoria")
+        for action, count in sorted(self.memory_budget.items()):
+            lines.append(f"vision_memory_budget_total{{{_labels(action=action)}}} {count}")
+        if os.path.exists("/proc/self/status"):
+            family("vision_process_resident_memory_bytes", "gauge", "RSS del proceso principal")
+            lines.append(f"vision_process_resident_memory_bytes {_proc_status_bytes('VmRSS')}")
+        family("vision_payload_bytes", "histogram", "Tamaño de las imágenes recibidas por modo")
+        for mode, histogram in sorted(self.payload_sizes.items()):
+            lines.extend(histogram.render("vision_payload_bytes", _labels(mode=mode)))
+        family("vision_analysis_errors_total", "counter", "Errores de análisis por modo y estado")
+        for (mode, status), count in sorted(self.errors.items()):
+            lines.append(f"vision_analysis_errors_total{{{_labels(mode=mode, status=status)}}} {count}")
+        
+        family("vision_profiles_total", "counter", "Análisis ejecutados bajo el perfilador")
+        lines.append(f"vision_profiles_total {self.profiles}")
+        
+        admission = admission_controller.stats()
+        family("vision_admission_in_flight", "gauge", "Peticiones de análisis admitidas en curso")
+        lines.append(f"vision_admission_in_flight {admission['in_flight']}")
+        family("vision_admission_queued", "gauge", "Peticiones de análisis esperando admisión")
+        lines.append(f"vision_admission_queued {admission['queued']}")
+        family("vision_admission_rejected_total", "counter", "Peticiones rechazadas con 429 por motivo y prioridad")
+        for (reason, priority), count in sorted(admission_controller.rejected.items()):
+            lines.append(f"vision_admission_rejected_total{{{_labels(reason=reason, priority=priority)}}} {count}")
+        
+        executor = analysis_executor.stats()
+        family("vision_executor_in_flight", "gauge", "Análisis ejecutándose en el pool")
+        lines.append(f"vision_executor_in_flight {executor['in_flight']}")
+        family("vision_executor_waiting", "gauge", "Análisis esperando un cupo del pool")
+        lines.append(f"vision_executor_waiting {executor['waiting']}")
+        cache = result_cache.stats()
+        family("vision_cache_lookups_total", "counter", "Consultas a la caché de resultados")
+        lines.append(f'vision_cache_lookups_total{{result="hit"}} {cache["hits"]}')
+        lines.append(f'vision_cache_lookups_total{{result="miss"}} {cache["misses"]}')
+        return "\n".join(lines) + "\n"
+
+vision_metrics = VisionMetrics(list(vision_ai.defect_categories.keys()))
+
+class MetricsMiddleware:
+    """Middleware ASGI: cuenta peticiones HTTP por ruta (plantilla) y estado, y las peticiones en curso"""
+    def __init__(self, app):
+        self.app = app
+        self._paths: Dict = {}
+
+    def _path(self, scope) -> str:
+        # Plantilla de la ruta (/jobs/{id}) para no crear una serie por cada URL
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "other"
+        if endpoint not in self._paths:
+            self._paths[endpoint] = next((route.path for route in app.routes
+                                          if getattr(route, "endpoint", None) is endpoint), "other")
+        return self._paths[endpoint]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        status = {"code": 500}
+        
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+        
+        start = time.perf_counter()
+        vision_metrics.in_flight += 1
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            vision_metrics.in_flight -= 1
+            vision_metrics.observe_request(scope["method"], self._path(scope), status["code"],
+                                           time.perf_counter() - start)
+
+class AdmissionWaiter:
+    """Petición en espera de admisión"""
+    def __init__(self, client: str, priority: str, sequence: int):
+        self.client = client
+        self.priority = priority
+        self.rank = PRIORITY_CLASSES[priority]
+        self.sequence = sequence
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+class AdmissionController:
+    """Control de admisión delante del análisis: peticiones en curso y en espera acotadas.
+    
+    Al liberarse un cupo entra primero la prioridad más alta y, dentro de ella, el cliente con
+    menos peticiones en curso (reparto justo por operador o API key). Con la cola llena una
+    petición prioritaria desplaza a la más reciente de menor prioridad; si no, 429 inmediato con
+    Retry-After estimado a partir del tiempo de servicio observado por imagen (EWMA).
+    """
+    def __init__(self, max_in_flight: int, max_queue: int, queue_timeout: float):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._client_in_flight: Dict[str, int] = {}
+        self._waiting: List[AdmissionWaiter] = []
+        self._sequence = 0
+        self._service_seconds: Optional[float] = None
+        self.admitted = 0
+        self.rejected: Dict[Tuple[str, str], int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_in_flight > 0
+
+    def retry_after(self) -> int:
+        """Segundos estimados hasta que se vacíe la cola actual"""
+        service = self._service_seconds or 1.0
+        return max(1, math.ceil(service * (len(self._waiting) + 1) / self.max_in_flight))
+
+    def _reject(self, reason: str, priority: str) -> HTTPException:
+        key = (reason, priority)
+        self.rejected[key] = self.rejected.get(key, 0) + 1
+        return HTTPException(
+            status_code=429,
+            detail=f"Servidor de visión ocupado ({reason}), reintente más tarde",
+            headers={"Retry-After": str(self.retry_after())}
+        )
+
+    def _start(self, client: str):
+        self.in_flight += 1
+        self._client_in_flight[client] = self._client_in_flight.get(client, 0) + 1
+        self.admitted += 1
+
+    async def acquire(self, client: str, priority: str):
+        """Esperar un cupo; HTTPException 429 si no hay sitio en la cola o la espera caduca"""
+        if self.in_flight < self.max_in_flight and not self._waiting:
+            self._start(client)
+            return
+        
+        rank = PRIORITY_CLASSES[priority]
+        if len(self._waiting) >= self.max_queue:
+            # Cola llena: desplazar a la espera más reciente de menor prioridad, si la hay
+            lower = [w for w in self._waiting if w.rank > rank]
+            if not lower:
+                raise self._reject("queue_full", priority)
+            victim = max(lower, key=lambda w: (w.rank, w.sequence))
+            self._waiting.remove(victim)
+            victim.future.set_exception(self._reject("shed", victim.priority))
+        else:
+            # Ningún cliente ocupa más que su parte de la cola (salvo al desplazar trabajo de menor prioridad)
+            clients = {w.client for w in self._waiting} | {client}
+            if sum(1 for w in self._waiting if w.client == client) >= max(1, self.max_queue // len(clients)):
+                raise self._reject("client_share", priority)
+        
+        self._sequence += 1
+        waiter = AdmissionWaiter(client, priority, self._sequence)
+        self._waiting.append(waiter)
+        try:
+            await asyncio.wait_for(waiter.future, timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter in self._waiting:
+                self._waiting.remove(waiter)
+            raise self._reject("timeout", priority)
+        except asyncio.CancelledError:
+            # Cliente desconectado: dejar la cola o devolver el cupo ya concedido
+            if waiter in self._waiting:
+                self._waiting.remove(waiter)
+            elif waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                self.release(client)
+            raise
+
+    def observe_service(self, service_seconds: float):
+        """Sumar al EWMA el tiempo de servicio de una imagen (no de la petición: un lote trae muchas)"""
+        self._service_seconds = (service_seconds if self._service_seconds is None
+                                 else 0.8 * self._service_seconds + 0.2 * service_seconds)
+
+    def release(self, client: str):
+        """Liberar el cupo de `client` y conceder los cupos libres a las peticiones en espera"""
+        self.in_flight -= 1
+        self._client_in_flight[client] -= 1
+        if not self._client_in_flight[client]:
+            del self._client_in_flight[client]
+        
+        while self._waiting and self.in_flight < self.max_in_flight:
+            waiter = min(self._waiting, key=lambda w: (w.rank, self._client_in_flight.get(w.client, 0), w.sequence))
+            self._waiting.remove(waiter)
+            if waiter.future.done():
+                continue  # ya caducada
+            self._start(waiter.client)
+            waiter.future.set_result(None)
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queued": len(self._waiting),
+            "clients_in_flight": len(self._client_in_flight),
+            "admitted": self.admitted,
+            "rejected": sum(self.rejected.values()),
+            "average_service_seconds": self._service_seconds
+        }
+
+admission_controller = AdmissionController(VISION_ADMISSION_MAX_IN_FLIGHT, VISION_ADMISSION_MAX_QUEUE,
+                                           VISION_QUEUE_TIMEOUT)
+
+def admission_client(headers: Dict[str, str], scope) -> str:
+    """Clave de reparto justo: operador, API key (hasheada, nunca en claro) o IP del cliente"""
+    if headers.get("x-operator-id"):
+        return f"operator:{headers['x-operator-id']}"
+    if headers.get("x-api-key"):
+        return "key:" + hashlib.sha256(headers["x-api-key"].encode("utf-8")).hexdigest()[:12]
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'desconocido'}"
+
+class AdmissionMiddleware:
+    """Middleware ASGI: control de admisión de las rutas de análisis síncrono (X-Priority, X-Operator-Id, X-API-Key)"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or not admission_controller.enabled
+                or not scope["path"].startswith(ADMISSION_PATH_PREFIXES)):
+            await self.app(scope, receive, send)
+            return
+        
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        client = admission_client(headers, scope)
+        priority = headers.get("x-priority", "normal").lower()
+        if priority not in PRIORITY_CLASSES:
+            priority = "normal"
+        try:
+            await admission_controller.acquire(client, priority)
+        except HTTPException as e:
+            response = JSONResponse(status_code=e.status_code, content={"detail": e.detail}, headers=e.headers)
+            await response(scope, receive, send)
+            return
+        
+        # El cupo se mantiene hasta terminar de enviar la respuesta (incluido NDJSON en streaming)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission_controller.release(client)
+
+# Orden: métricas por fuera para contar también los 429 de admisión
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+async def run_analysis(image_data: Union[bytes, str], product_type: str, analysis_id: str,
+                       bypass_cache: bool = False, mode: str = "image", include_timings: bool = False,
+                       profile: bool = False, batch_id: Optional[str] = None,
+                       total_units: Optional[int] = None, unit: Optional[Union[int, str]] = None,
+                       cache_store: bool = True, expected_images: Optional[int] = None) -> Dict:
+    """Analizar una imagen pasando por la caché de resultados y el pool de workers.
+    
+    - **bypass_cache**: No leer la caché (el resultado nuevo sí se guarda)
+    - **cache_store**: Guardar el resultado en la caché (`False` con `bypass_cache` ni la consulta)
+    - **include_timings**: Devolver la duración de cada etapa (ms) en `timings`
+    - **profile**: Analizar bajo el perfilador; el archivo se informa en `profile_file`
+    - **batch_id**: Sumar el resultado a los agregados del lote
+    - **unit**: Posición de la imagen en el lote (por defecto, el hash de su contenido)
+    - **total_units**: Unidades declaradas del lote
+    - **expected_images**: Imágenes que completan el lote (por defecto `total_units`)
+    """
+    profile = profile or (VISION_PROFILE_SAMPLE_RATE > 0 and random.random() < VISION_PROFILE_SAMPLE_RATE)
+    start = time.perf_counter()
+    timer = StageTimer()
+    try:
+        if isinstance(image_data, str):
+            try:
+                with timer.stage('base64_decode'):
+                    image_data = decode_image_data(image_data)
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Error procesando imagen: {str(e)}")
+        vision_metrics.observe_payload(mode, len(image_data))
+        
+        # Presupuesto de memoria según la cabecera real de la imagen, antes de enviarla al worker
+        max_side = None
+        if mode == "tiled" and VISION_REQUEST_MEMORY_MB > 0:
+            header = image_header(image_data)
+            if header is not None:
+                check_tiled_memory(header[0], len(image_data))
+        elif VISION_REQUEST_MEMORY_MB > 0:
+            header = image_header(image_data)
+            if header is not None:
+                side = memory_budget_max_side(header[0], header[1], vision_ai.analysis_max_side, len(image_data))
+                if side != vision_ai.analysis_max_side:
+                    print(f"📉 {analysis_id}: {header[0][0]}x{header[0][1]} reducida a lado {side} por presupuesto de memoria")
+                    max_side = side
+        
+        cache_key = None
+        result = None
+        if result_cache.enabled and (cache_store or not bypass_cache):
+            with timer.stage('cache_lookup'):
+                cache_key = ResultCache.key(image_data, product_type, mode)
+                result = _cached_result(cache_key, analysis_id, bypass_cache or profile)
+        
+        if result is None:
+            dispatched = time.perf_counter()
+            if profile or max_side is not None:
+                # Análisis individual: el perfil no debe mezclar otras peticiones del micro-lote
+                vision_metrics.profiles += int(profile)
+                result = await analysis_executor.run(_analyze_in_worker, image_data, product_type, analysis_id,
+                                                     mode, profile, max_side)
+            elif mode == "image" and microbatch_scheduler.enabled:
+                # Peticiones concurrentes comparten una llamada al detector
+                result = await microbatch_scheduler.submit(image_data, product_type, analysis_id)
+            else:
+                result = await analysis_executor.run(_analyze_in_worker, image_data, product_type, analysis_id, mode)
+            round_trip = (time.perf_counter() - dispatched) * 1000
+            _merge_worker_timings(timer, result, round_trip)
+            profile_file = result.pop('profile_file', None)
+            if cache_key is not None and cache_store:
+                result_cache.put(cache_key, result)
+            result['cache_hit'] = False
+            if profile_file is not None:
+                print(f"🔬 Perfil de {analysis_id} guardado en {profile_file}")
+                result['profile_file'] = profile_file
+    except HTTPException as e:
+        vision_metrics.observe_error(mode, e.status_code)
+        # Imagen inválida o rechazada: cuenta como unidad fallida (los 5xx se reintentan)
+        if batch_id and e.status_code < 500:
+            lot_aggregator.add_error(batch_id, product_type, lot_unit_key(image_data) if unit is None else unit,
+                                     total_units, expected_images)
+        raise
+    
+    elapsed = time.perf_counter() - start
+    vision_metrics.observe_analysis(mode, product_type, timer.timings, elapsed * 1000, timer.memory)
+    admission_controller.observe_service(elapsed)
+    if batch_id and mode != "units":
+        lot_aggregator.add(batch_id, product_type, result, lot_unit_key(image_data) if unit is None else unit,
+                           total_units, expected_images)
+    if include_timings:
+        result['timings'] = timer.timings
+        if timer.memory:
+            result['memory'] = timer.memory
+    return result
+
+def _merge_worker_timings(timer: StageTimer, result: Dict, round_trip: float):
+    """Sumar las etapas medidas en el worker; el resto del viaje al pool es espera en cola"""
+    for stage, elapsed in result.pop('timings', {}).items():
+        timer.add(stage, elapsed)
+    for stage, peak in result.pop('memory', {}).items():
+        timer.add_memory(stage, peak)
+    timer.add('queue_wait', max(0.0, round_trip - result['processing_time']))
+
+def _cached_result(cache_key: str, analysis_id: str, bypass_cache: bool) -> Optional[Dict]:
+    """Resultado en caché con el ID y la marca de tiempo de la petición actual"""
+    # bypass_cache no lee la caché pero sí la refresca con el nuevo resultado
+    cached = None if bypass_cache else result_cache.get(cache_key)
+    if cached is not None:
+        # Mismos bytes y producto: solo cambian el ID y las marcas de tiempo
+        cached['analysis_id'] = analysis_id
+        cached['analysis_timestamp'] = datetime.now().isoformat()
+        cached['cache_hit'] = True
+    return cached
+
+async def run_batch_analysis(items: List[Tuple[bytes, str, str]], bypass_cache: bool = False,
+                             include_timings: bool = False, batch_id: Optional[str] = None,
+                             total_units: Optional[int] = None) -> List[Union[Dict, HTTPException]]:
+    """Analizar (imagen, tipo de producto, analysis_id) con el kernel vectorizado en una sola tarea del pool.
+    
+    Las imágenes en caché no se envían al worker. Retorna, en orden, el resultado o la
+    HTTPException de cada imagen; con `batch_id` cada una se suma a los agregados del lote.
+    """
+    start = time.perf_counter()
+    results: List[Union[Dict, HTTPException, None]] = [None] * len(items)
+    timers = [StageTimer() for _ in items]
+    cache_keys: List[Optional[str]] = [None] * len(items)
+    pending = []
+    for i, (image_data, product_type, analysis_id) in enumerate(items):
+        vision_metrics.observe_payload("vectorized", len(image_data))
+        if result_cache.enabled:
+            with timers[i].stage('cache_lookup'):
+                cache_keys[i] = ResultCache.key(image_data, product_type, "vectorized")
+                results[i] = _cached_result(cache_keys[i], analysis_id, bypass_cache)
+        if results[i] is None and VISION_REQUEST_MEMORY_MB > 0:
+            header = image_header(image_data)
+            try:
+                if header is not None:
+                    memory_budget_max_side(header[0], header[1], VISION_BATCH_SIDE, len(image_data))
+            except HTTPException as e:
+                vision_metrics.observe_error("vectorized", e.status_code)
+                results[i] = e
+        if results[i] is None:
+            pending.append(i)
+    
+    if pending:
+        dispatched = time.perf_counter()
+        try:
+            outputs = await analysis_executor.run(_analyze_batch_in_worker, [items[i] for i in pending])
+        except HTTPException as e:
+            vision_metrics.observe_error("vectorized", e.status_code)
+            raise
+        round_trip = (time.perf_counter() - dispatched) * 1000
+        for i, output in zip(pending, outputs):
+            if isinstance(output, AnalysisError):
+                vision_metrics.observe_error("vectorized", output.status_code)
+                results[i] = HTTPException(status_code=output.status_code, detail=output.detail)
+                continue
+            # El viaje al pool es común a todo el grupo
+            _merge_worker_timings(timers[i], output, round_trip / len(pending))
+            if cache_keys[i] is not None:
+                result_cache.put(cache_keys[i], output)
+            output['cache_hit'] = False
+            results[i] = output
+    
+    elapsed = (time.perf_counter() - start) * 1000 / len(items)
+    admission_controller.observe_service(elapsed / 1000)
+    for (image_data, product_type, _), result, timer in zip(items, results, timers):
+        if isinstance(result, HTTPException):
+            if batch_id and result.status_code < 500:
+                lot_aggregator.add_error(batch_id, product_type, lot_unit_key(image_data), total_units)
+            continue
+        vision_metrics.observe_analysis("vectorized", product_type, timer.timings, elapsed, timer.memory)
+        if batch_id:
+            lot_aggregator.add(batch_id, product_type, result, lot_unit_key(image_data), total_units)
+        if include_timings:
+            result['timings'] = timer.timings
+            if timer.memory:
+                result['memory'] = timer.memory
+    return results
+
+class AnalysisJob:
+    """Trabajo de análisis asíncrono: una o varias imágenes, estado, progreso y resultado"""
+    def __init__(self, job_id: str, request: JobRequest):
+        self.id = job_id
+        self.images = [request.image_data] if request.image_data else list(request.images)
+        # Las imágenes se liberan al terminar; el estado solo necesita cuántas eran
+        self.total_images = len(self.images)
+        self.product_type = request.product_type
+        self.analysis_id = request.analysis_id or job_id
+        self.mode = request.mode
+        self.priority = request.priority
+        self.callback_url = request.callback_url
+        self.bypass_cache = request.bypass_cache
+        self.batch_id = request.batch_id
+        self.total_units = request.total_units
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.completed = 0
+        self.errors = 0
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.error_status: Optional[int] = None
+        self.callback: Optional[Dict] = None
+        self.sequence = 0
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "failed")
+
+    def status_dict(self, position: Optional[int] = None) -> Dict:
+        def iso(timestamp: Optional[float]) -> Optional[str]:
+            return datetime.fromtimestamp(timestamp).isoformat() if timestamp else None
+        
+        status = {
+            "job_id": self.id,
+            "analysis_id": self.analysis_id,
+            "status": self.status,
+            "priority": self.priority,
+            "mode": self.mode,
+            "total_images": self.total_images,
+            "completed_images": self.completed,
+            "failed_images": self.errors,
+            "created_at": iso(self.created_at),
+            "started_at": iso(self.started_at),
+            "finished_at": iso(self.finished_at),
+            "status_url": f"/jobs/{self.id}",
+            "result_url": f"/jobs/{self.id}/result"
+        }
+        if position is not None:
+            status["queue_position"] = position
+        if self.error:
+            status["error"] = self.error
+        if self.callback:
+            status["callback"] = self.callback
+        return status
+
+def _post_json(url: str, payload: Dict, timeout: float) -> int:
+    """POST JSON con la librería estándar (se ejecuta en un hilo)"""
+    body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.status
+
+class JobQueue:
+    """Cola de trabajos en proceso: acotada, por prioridad, con retención de resultados (TTL) y callbacks"""
+    def __init__(self, max_queue: int, concurrency: int, ttl_seconds: float, max_retained: int):
+        self.max_queue = max_queue
+        self.concurrency = max(1, concurrency)
+        self.ttl_seconds = ttl_seconds
+        self.max_retained = max_retained
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._runners: List[asyncio.Task] = []
+        self._jobs: "OrderedDict[str, AnalysisJob]" = OrderedDict()
+        self._sequence = 0
+        self._job_seconds: Optional[float] = None  # EWMA de la duración de un trabajo
+        self.submitted = 0
+        self.rejected = 0
+
+    def start(self):
+        """Crear la cola y las tareas que ejecutan trabajos (en el event loop actual)"""
+        if self._queue is not None:
+            return
+        self._queue = asyncio.PriorityQueue(maxsize=self.max_queue)
+        self._runners = [asyncio.ensure_future(self._runner()) for _ in range(self.concurrency)]
+
+    def shutdown(self):
+        for runner in self._runners:
+            runner.cancel()
+        self._runners = []
+        self._queue = None
+
+    def submit(self, request: JobRequest) -> Tuple[AnalysisJob, int]:
+        """Encolar un trabajo; 503 con Retry-After si la cola está llena"""
+        self.start()
+        self._purge()
+        job = AnalysisJob(f"job_{uuid.uuid4().hex}", request)
+        self._sequence += 1
+        try:
+            # Menor rango primero; a igual prioridad, orden de llegada
+            self._queue.put_nowait((PRIORITY_CLASSES[job.priority], self._sequence, job))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            retry_after = max(1, int(self._job_seconds or VISION_QUEUE_TIMEOUT))
+            raise HTTPException(
+                status_code=503,
+                detail="Cola de trabajos llena, reintente más tarde",
+                headers={"Retry-After": str(retry_after)}
+            )
+        job.sequence = self._sequence
+        self._jobs[job.id] = job
+        self.submitted += 1
+        return job, self.position(job)
+
+    def get(self, job_id: str) -> AnalysisJob:
+        self._purge()
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Trabajo no encontrado o expirado: {job_id}")
+        return job
+
+    def position(self, job: AnalysisJob) -> Optional[int]:
+        """Trabajos en cola por delante de `job` (None si ya no está en cola)"""
+        if job.status != "queued":
+            return None
+        key = (PRIORITY_CLASSES[job.priority], job.sequence)
+        return sum(1 for other in self._jobs.values()
+                   if other.status == "queued" and (PRIORITY_CLASSES[other.priority], other.sequence) < key)
+
+    def _purge(self):
+        """Eliminar resultados caducados y, si sobran, los trabajos terminados más antiguos"""
+        now = time.time()
+        finished = [job for job in self._jobs.values() if job.finished]
+        excess = len(finished) - self.max_retained
+        for job in finished:
+            if now - job.finished_at > self.ttl_seconds or excess > 0:
+                del self._jobs[job.id]
+                excess -= 1
+
+    async def _runner(self):
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                await self._run(job)
+            except Exception as e:
+                job.status, job.error, job.error_status = "failed", str(e), 500
+                job.finished_at = time.time()
+            finally:
+                # Los payloads base64 no se retienen mientras el trabajo espera su TTL
+                job.images = []
+                self._queue.task_done()
+            if job.callback_url:
+                await self._deliver_callback(job)
+
+    async def _run(self, job: AnalysisJob):
+        job.status = "running"
+        job.started_at = time.time()
+        print(f"🗂️ Trabajo {job.id} iniciado: {job.total_images} imágenes ({job.priority})")
+        semaphore = asyncio.Semaphore(max(1, VISION_BATCH_CONCURRENCY))
+        summary = BatchSummary(VISION_BATCH_CONCURRENCY)
+        single = job.total_images == 1
+        
+        async def analyze(i: int, image_data: str) -> Dict:
+            async with semaphore:
+                try:
+                    result = await run_analysis(image_data, job.product_type,
+                                                job.analysis_id if single else f"{job.analysis_id}_{i}",
+                                                bypass_cache=job.bypass_cache, mode=job.mode,
+                                                batch_id=job.batch_id, total_units=job.total_units)
+                except HTTPException as e:
+                    job.errors += 1
+                    if single:
+                        job.error, job.error_status = str(e.detail), e.status_code
+                    summary.add_error()
+                    return {"index": i, "error": str(e.detail), "status_code": e.status_code}
+                job.completed += 1
+                if job.mode == "image":
+                    summary.add(result)
+                return result
+        
+        results = await asyncio.gather(*(analyze(i, image) for i, image in enumerate(job.images)))
+        job.finished_at = time.time()
+        elapsed = job.finished_at - job.started_at
+        self._job_seconds = elapsed if self._job_seconds is None else 0.8 * self._job_seconds + 0.2 * elapsed
+        
+        if single and job.error:
+            job.status = "failed"
+        else:
+            job.status = "completed"
+            job.result = results[0] if single else {
+                "batch_id": job.batch_id or job.analysis_id,
+                "total_images": job.total_images,
+                "results": results,
+                "summary": summary.as_dict() if job.mode == "image" else {"errors": job.errors}
+            }
+            if job.batch_id and job.mode == "image":
+                job.result["lot"] = lot_aggregator.summary(job.batch_id, job.product_type, job.total_units,
+                                                           claim=True)
+        print(f"✅ Trabajo {job.id} {job.status} en {elapsed:.1f} s")
+
+    async def _deliver_callback(self, job: AnalysisJob):
+        """POST del estado final al callback_url, con reintentos y espera exponencial"""
+        payload = {**job.status_dict(), "result": job.result}
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, VISION_JOB_CALLBACK_RETRIES + 1):
+            try:
+                status = await loop.run_in_executor(None, _post_json, job.callback_url, payload,
+                                                    VISION_JOB_CALLBACK_TIMEOUT)
+                job.callback = {"delivered": True, "attempts": attempt, "status_code": status}
+                return
+            except Exception as e:
+                job.callback = {"delivered": False, "attempts": attempt, "error": str(e)}
+                if attempt < VISION_JOB_CALLBACK_RETRIES:
+                    await asyncio.sleep(2 ** (attempt - 1))
+        print(f"⚠️ Callback de {job.id} no entregado: {job.callback['error']}")
+
+    def stats(self) -> Dict:
+        counts: Dict[str, int] = {}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            "max_queue": self.max_queue,
+            "concurrency": self.concurrency,
+            "ttl_seconds": self.ttl_seconds,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "average_job_seconds": self._job_seconds,
+            **{status: counts.get(status, 0) for status in ("queued", "running", "completed", "failed")}
+        }
+
+job_queue = JobQueue(VISION_JOB_MAX_QUEUE, VISION_JOB_CONCURRENCY, VISION_JOB_TTL, VISION_JOB_MAX_RETAINED)
+
+@app.on_event("startup")
+async def start_analysis_executor():
+    # Un backend de detección mal definido falla al arrancar, no en la primera imagen
+    detector_class(VISION_DETECTOR_BACKEND)
+    analysis_executor.start()
+    job_queue.start()
+    # Estándares de calidad (lectura bloqueante de Supabase) cargados en un hilo, no en el event loop
+    await asyncio.get_running_loop().run_in_executor(None, lambda: vision_ai.scorer)
+
+@app.on_event("shutdown")
+async def stop_analysis_executor():
+    job_queue.shutdown()
+    analysis_executor.shutdown()
+
+@app.post("/analyze-image", response_model=ImageAnalysisResponse, response_model_exclude_none=True)
+async def analyze_image(request: ImageAnalysisRequest, x_profile: Optional[str] = Header(None),
+                        x_image_width: Optional[int] = Header(None), x_image_height: Optional[int] = Header(None)):
     """
     Analizar una imagen de producto agrícola para control de calidad
     
     - **image_data**: Imagen en formato base64
     - **product_type**: Tipo de producto (Manzana, Naranja, Tomate, Papa)
     - **analysis_id**: ID único para el análisis
+    - **bypass_cache**: Ignorar la caché de resultados y forzar un análisis nuevo
+    - **include_timings**: Incluir la duración de cada etapa (ms) en el campo `timings`
+    - **batch_id**: Sumar el resultado a los agregados del lote y devolverlos en `lot` (opcional)
+    - **total_units**: Unidades esperadas en el lote, para marcarlo completo (opcional)
+    - **X-Profile**: Header opcional; analizar bajo el perfilador y devolver el perfil en `profile_file`
+    - **X-Image-Width / X-Image-Height**: Headers opcionales; rechazar (413) antes de decodificar si la
+      imagen no cabe en el presupuesto de memoria por petición
     """
+    check_declared_size(x_image_width, x_image_height)
     try:
         print(f"🔍 Iniciando análisis para {request.product_type} - ID: {request.analysis_id}")
         
-        result = vision_ai.analyze_image(
+        result = await run_analysis(
             request.image_data,
             request.product_type,
-            request.analysis_id
+            request.analysis_id,
+            bypass_cache=request.bypass_cache,
+            include_timings=request.include_timings,
+            profile=profile_requested(x_profile),
+            batch_id=request.batch_id,
+            total_units=request.total_units
         )
         
         print(f"✅ Análisis completado: {len(result['defects'])} defectos encontrados")
+        if request.batch_id:
+            result['lot'] = lot_aggregator.summary(request.batch_id, request.product_type, request.total_units,
+                                                   claim=True)
         return ImageAnalysisResponse(**result)
     except HTTPException:
         raise
@@ -317,39 +2910,533 @@ async def analyze_image(request: ImageAnalysisRequest):
         print(f"❌ Error en análisis: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error en análisis de imagen: {str(e)}")
 
-@app.post("/analyze-batch")
-async def analyze_batch(images: List[UploadFile] = File(...)):
-    """Endpoint para análisis por lote de múltiples imágenes"""
-    results = []
+@app.post(
+    "/analyze-image/raw",
+    response_model=ImageAnalysisResponse,
+    response_model_exclude_none=True,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/octet-stream": {"schema": {"type": "string", "format": "binary"}}}
+        }
+    }
+)
+async def analyze_image_raw(
+    request: Request,
+    product_type: Optional[str] = Query(None),
+    analysis_id: Optional[str] = Query(None),
+    x_product_type: Optional[str] = Header(None),
+    x_analysis_id: Optional[str] = Header(None),
+    bypass_cache: bool = Query(False),
+    tiled: bool = Query(False),
+    include_timings: bool = Query(False),
+    batch_id: Optional[str] = Query(None),
+    total_units: Optional[int] = Query(None),
+    x_batch_id: Optional[str] = Header(None),
+    x_profile: Optional[str] = Header(None),
+    x_image_width: Optional[int] = Header(None),
+    x_image_height: Optional[int] = Header(None)
+):
+    """
+    Analizar una imagen enviada como binario crudo (sin base64)
+    
+    - **body**: Bytes de la imagen (application/octet-stream, image/jpeg, image/png)
+    - **product_type**: Query param o header `X-Product-Type`
+    - **analysis_id**: Query param o header `X-Analysis-Id` (opcional)
+    - **bypass_cache**: Ignorar la caché de resultados y forzar un análisis nuevo
+    - **tiled**: Analizar a resolución completa por tiles con memoria acotada (imágenes line-scan)
+    - **include_timings**: Incluir la duración de cada etapa (ms) en el campo `timings`
+    - **batch_id**: Query param o header `X-Batch-Id`; sumar el resultado a los agregados del lote (`lot`)
+    - **total_units**: Unidades esperadas en el lote (opcional)
+    - **X-Profile**: Header opcional; analizar bajo el perfilador y devolver el perfil en `profile_file`
+    - **X-Image-Width / X-Image-Height**: Headers opcionales; rechazar (413) antes de leer el cuerpo si la
+      imagen no cabe en el presupuesto de memoria por petición (con `tiled`, el frame completo y sus tiles)
+    """
+    product_type = product_type or x_product_type
+    batch_id = batch_id or x_batch_id
+    analysis_id = analysis_id or x_analysis_id or f"raw_{datetime.now().timestamp()}"
+    if not product_type:
+        raise HTTPException(status_code=400, detail="product_type requerido (query param o header X-Product-Type)")
+    check_declared_size(x_image_width, x_image_height, tiled)
+    
+    image_bytes = await request.body()
+    if not image_bytes:
+        raise HTTPException(status_code=400, detail="Cuerpo de la petición vacío")
     
     try:
-        for i, image in enumerate(images):
+        print(f"🔍 Iniciando análisis binario para {product_type} - ID: {analysis_id} ({len(image_bytes)} bytes)")
+        
+        result = await run_analysis(image_bytes, product_type, analysis_id, bypass_cache=bypass_cache,
+                                    mode="tiled" if tiled else "image", include_timings=include_timings,
+                                    profile=profile_requested(x_profile), batch_id=batch_id, total_units=total_units)
+        
+        print(f"✅ Análisis completado: {len(result['defects'])} defectos encontrados")
+        if batch_id:
+            result['lot'] = lot_aggregator.summary(batch_id, product_type, total_units, claim=True)
+        return ImageAnalysisResponse(**result)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"❌ Error en análisis: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error en análisis de imagen: {str(e)}")
+
+@app.post("/analyze-units")
+async def analyze_units(request: ImageAnalysisRequest, x_profile: Optional[str] = Header(None),
+                        x_image_width: Optional[int] = Header(None), x_image_height: Optional[int] = Header(None)):
+    """
+    Analizar todas las unidades de producto de un mismo frame (bandeja o cinta)
+    
+    Retorna un resultado por unidad (`units`) y los agregados del frame (`frame_summary`).
+    """
+    check_declared_size(x_image_width, x_image_height)
+    print(f"🍎 Iniciando análisis multi-unidad para {request.product_type} - ID: {request.analysis_id}")
+    result = await run_analysis(request.image_data, request.product_type, request.analysis_id,
+                                bypass_cache=request.bypass_cache, mode="units",
+                                include_timings=request.include_timings, profile=profile_requested(x_profile))
+    print(f"✅ Análisis completado: {result['frame_summary']['unit_count']} unidades encontradas")
+    return result
+
+@app.post(
+    "/analyze-units/raw",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/octet-stream": {"schema": {"type": "string", "format": "binary"}}}
+        }
+    }
+)
+async def analyze_units_raw(
+    request: Request,
+    product_type: Optional[str] = Query(None),
+    analysis_id: Optional[str] = Query(None),
+    x_product_type: Optional[str] = Header(None),
+    x_analysis_id: Optional[str] = Header(None),
+    bypass_cache: bool = Query(False),
+    include_timings: bool = Query(False),
+    x_profile: Optional[str] = Header(None),
+    x_image_width: Optional[int] = Header(None),
+    x_image_height: Optional[int] = Header(None)
+):
+    """Analizar todas las unidades de un frame enviado como binario crudo (ver `/analyze-image/raw`)"""
+    product_type = product_type or x_product_type
+    analysis_id = analysis_id or x_analysis_id or f"units_{datetime.now().timestamp()}"
+    if not product_type:
+        raise HTTPException(status_code=400, detail="product_type requerido (query param o header X-Product-Type)")
+    check_declared_size(x_image_width, x_image_height)
+    
+    image_bytes = await request.body()
+    if not image_bytes:
+        raise HTTPException(status_code=400, detail="Cuerpo de la petición vacío")
+    
+    print(f"🍎 Iniciando análisis multi-unidad para {product_type} - ID: {analysis_id} ({len(image_bytes)} bytes)")
+    result = await run_analysis(image_bytes, product_type, analysis_id, bypass_cache=bypass_cache, mode="units",
+                                include_timings=include_timings, profile=profile_requested(x_profile))
+    print(f"✅ Análisis completado: {result['frame_summary']['unit_count']} unidades encontradas")
+    return result
+
+@app.post("/analyze-batch")
+async def analyze_batch(
+    images: List[UploadFile] = File(...),
+    product_types: List[str] = Form([]),
+    analysis_ids: List[str] = Form([]),
+    product_type: str = Form("Manzana"),
+    max_concurrency: Optional[int] = Form(None),
+    bypass_cache: bool = Form(False),
+    vectorized: bool = Form(False),
+    include_timings: bool = Form(False),
+    batch_id: Optional[str] = Form(None),
+    total_units: Optional[int] = Form(None),
+    stream: bool = Query(False)
+):
+    """
+    Endpoint para análisis por lote de múltiples imágenes
+    
+    - **images**: Archivos de imagen
+    - **product_types**: Tipo de producto por imagen (mismo orden que `images`); si se omite se usa `product_type`
+    - **analysis_ids**: ID de análisis por imagen (opcional, mismo orden que `images`)
+    - **max_concurrency**: Imágenes analizadas en paralelo (limitado por VISION_BATCH_CONCURRENCY)
+    - **bypass_cache**: Ignorar la caché de resultados y forzar un análisis nuevo
+    - **vectorized**: Analizar por grupos con el kernel vectorizado (una tarea del pool por grupo de
+      hasta VISION_BATCH_KERNEL_SIZE imágenes, forma común de lado VISION_BATCH_SIDE). Experimental:
+      se ignora salvo con VISION_BATCH_VECTORIZED habilitado
+    - **include_timings**: Incluir la duración de cada etapa (ms) en el campo `timings` de cada resultado
+    - **batch_id**: Lote al que se suman los resultados (varias peticiones pueden compartirlo); si se
+      omite se genera uno. Los agregados del lote se devuelven en `lot` y en `GET /lots/{batch_id}`
+    - **total_units**: Unidades esperadas en el lote (por defecto, las imágenes de esta petición si no hay `batch_id`)
+    - **stream**: Responder en NDJSON, una línea por imagen según terminan y una línea final con el resumen
+    
+    Una imagen inválida no falla el lote: su resultado es `{"index", "error", "status_code"}`.
+    """
+    if product_types and len(product_types) != len(images):
+        raise HTTPException(status_code=400, detail="product_types debe tener un elemento por imagen")
+    if analysis_ids and len(analysis_ids) != len(images):
+        raise HTTPException(status_code=400, detail="analysis_ids debe tener un elemento por imagen")
+    
+    batch_timestamp = datetime.now().timestamp()
+    if not batch_id:
+        batch_id = f"batch_{batch_timestamp}"
+        total_units = total_units or len(images)
+    concurrency = min(max_concurrency or VISION_BATCH_CONCURRENCY, VISION_BATCH_CONCURRENCY)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    
+    async def analyze_item(i: int, image: UploadFile) -> Dict:
+        async with semaphore:
             print(f"📦 Procesando imagen {i+1}/{len(images)}")
             
-            # Convertir imagen a base64
-            image_data = base64.b64encode(await image.read()).decode("utf-8")
+            # Los bytes del archivo van directo al decodificador
+            image_bytes = await image.read()
             
-            # Analizar cada imagen
-            result = vision_ai.analyze_image(
-                image_data,
-                "Manzana",  # Tipo por defecto para batch
-                f"batch_{datetime.now().timestamp()}_{i}"
+            return await run_analysis(
+                image_bytes,
+                product_types[i] if product_types else product_type,
+                analysis_ids[i] if analysis_ids else f"batch_{batch_timestamp}_{i}",
+                bypass_cache=bypass_cache,
+                include_timings=include_timings,
+                batch_id=batch_id,
+                total_units=total_units
             )
-            results.append(result)
+    
+    if vectorized and VISION_BATCH_VECTORIZED:
+        # Grupos de hasta VISION_BATCH_KERNEL_SIZE, repartidos entre los workers disponibles
+        group_size = max(1, min(VISION_BATCH_KERNEL_SIZE, -(-len(images) // max(1, concurrency))))
+        analyze_item = _vectorized_items(images, product_types, analysis_ids, product_type, batch_timestamp,
+                                         bypass_cache, semaphore, group_size, include_timings, batch_id, total_units)
+    
+    lot_product = product_types[0] if product_types else product_type
+    if stream:
+        return StreamingResponse(
+            _stream_batch(batch_id, images, analyze_item, BatchSummary(concurrency), lot_product, total_units),
+            media_type="application/x-ndjson"
+        )
+    
+    summary = BatchSummary(concurrency)
+    
+    async def analyze_or_error(i: int, image: UploadFile) -> Dict:
+        # Una imagen inválida no falla el lote: su resultado es {"index", "error", "status_code"}
+        try:
+            result = await analyze_item(i, image)
+        except HTTPException as e:
+            summary.add_error()
+            return {"index": i, "error": str(e.detail), "status_code": e.status_code}
+        summary.add(result)
+        return result
+    
+    try:
+        # gather conserva el orden de entrada
+        results = await asyncio.gather(*(analyze_or_error(i, image) for i, image in enumerate(images)))
         
         return {
-            "batch_id": f"batch_{datetime.now().timestamp()}",
+            "batch_id": batch_id,
             "total_images": len(images),
             "results": results,
-            "summary": {
-                "total_defects": sum(len(r['defects']) for r in results),
-                "average_confidence": np.mean([r['confidence_score'] for r in results]),
-                "processing_time_total": sum(r['processing_time'] for r in results)
-            }
+            "summary": summary.as_dict(),
+            "lot": lot_aggregator.summary(batch_id, lot_product, total_units, claim=True)
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error en análisis por lote: {str(e)}")
 
+def _vectorized_items(images: List[UploadFile], product_types: List[str], analysis_ids: List[str],
+                      product_type: str, batch_timestamp: float, bypass_cache: bool,
+                      semaphore: asyncio.Semaphore, group_size: int, include_timings: bool = False,
+                      batch_id: Optional[str] = None, total_units: Optional[int] = None):
+    """`analyze_item` del modo vectorizado: cada imagen espera el resultado de su grupo del kernel"""
+    groups: Dict[int, asyncio.Future] = {}
+    
+    async def analyze_group(start: int) -> List[Union[Dict, HTTPException]]:
+        async with semaphore:
+            end = min(start + group_size, len(images))
+            print(f"📦 Procesando imágenes {start+1}-{end}/{len(images)} (vectorizado)")
+            items = []
+            for i in range(start, end):
+                items.append((
+                    await images[i].read(),
+                    product_types[i] if product_types else product_type,
+                    analysis_ids[i] if analysis_ids else f"batch_{batch_timestamp}_{i}"
+                ))
+            return await run_batch_analysis(items, bypass_cache=bypass_cache, include_timings=include_timings,
+                                            batch_id=batch_id, total_units=total_units)
+    
+    async def analyze_item(i: int, image: UploadFile) -> Dict:
+        start = i - i % group_size
+        if start not in groups:
+            groups[start] = asyncio.ensure_future(analyze_group(start))
+        result = (await groups[start])[i - start]
+        if isinstance(result, HTTPException):
+            raise result
+        return result
+    
+    return analyze_item
+
+async def _stream_batch(batch_id: str, images: List[UploadFile], analyze_item, summary: BatchSummary,
+                        product_type: str, total_units: Optional[int] = None):
+    """Emitir cada resultado como una línea NDJSON en cuanto termina, y el resumen al final"""
+    async def indexed(i: int, image: UploadFile):
+        try:
+            return i, await analyze_item(i, image), None
+        except HTTPException as e:
+            return i, None, str(e.detail)
+        except Exception as e:
+            return i, None, str(e)
+    
+    tasks = [asyncio.ensure_future(indexed(i, image)) for i, image in enumerate(images)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            i, result, error = await next_done
+            if error is None:
+                summary.add(result)
+                line = {"type": "result", "batch_id": batch_id, "index": i, "result": result}
+            else:
+                summary.add_error()
+                line = {"type": "error", "batch_id": batch_id, "index": i, "detail": error}
+            yield json.dumps(line, ensure_ascii=False) + "\n"
+        
+        yield json.dumps({
+            "type": "summary",
+            "batch_id": batch_id,
+            "total_images": len(images),
+            "summary": summary.as_dict(),
+            "lot": lot_aggregator.summary(batch_id, product_type, total_units, claim=True)
+        }, ensure_ascii=False) + "\n"
+    finally:
+        # Cliente desconectado: no seguir analizando imágenes que nadie leerá
+        for task in tasks:
+            task.cancel()
+
+@app.post("/analyze-batch/json")
+async def analyze_batch_json(request: BatchAnalysisRequest):
+    """
+    Analizar un sub-lote de imágenes base64 (JSON) y sumarlas al lote `batch_id`
+    
+    Pensado para el fan-out de n8n: cada sub-lote de tamaño acotado es una petición y todas
+    comparten `batch_id`, de modo que el último en terminar devuelve en `lot` el lote completo.
+    
+    - **images**: Imágenes en base64
+    - **product_type**, **batch_id**: Producto y lote (obligatorios)
+    - **total_units**: Unidades declaradas por el operador (se informan tal cual en `lot`)
+    - **expected_images**: Imágenes de todo el lote, para marcarlo completo (por defecto `total_units`)
+    - **start_index**: Posición de la primera imagen de este sub-lote dentro del lote
+    - **analysis_id**: Prefijo de los IDs por imagen (por defecto `batch_id`)
+    - **max_concurrency**, **bypass_cache**, **include_timings**: Como en `/analyze-batch`
+    
+    Una imagen inválida no falla el sub-lote: su resultado es `{"index", "error", "status_code"}`.
+    """
+    if not request.images:
+        raise HTTPException(status_code=400, detail="Se requiere al menos una imagen")
+    
+    prefix = request.analysis_id or request.batch_id
+    concurrency = min(request.max_concurrency or VISION_BATCH_CONCURRENCY, VISION_BATCH_CONCURRENCY)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    summary = BatchSummary(concurrency)
+    
+    async def analyze_item(i: int, image_data: str) -> Dict:
+        index = request.start_index + i
+        async with semaphore:
+            try:
+                result = await run_analysis(image_data, request.product_type, f"{prefix}_{index}",
+                                            bypass_cache=request.bypass_cache,
+                                            include_timings=request.include_timings,
+                                            batch_id=request.batch_id, total_units=request.total_units,
+                                            unit=index, expected_images=request.expected_images)
+            except HTTPException as e:
+                summary.add_error()
+                return {"index": index, "error": str(e.detail), "status_code": e.status_code}
+        summary.add(result)
+        result['index'] = index
+        return result
+    
+    print(f"📦 Sub-lote de {len(request.images)} imágenes para {request.batch_id} (desde {request.start_index})")
+    results = await asyncio.gather(*(analyze_item(i, image) for i, image in enumerate(request.images)))
+    return {
+        "batch_id": request.batch_id,
+        "start_index": request.start_index,
+        "total_images": len(request.images),
+        "results": results,
+        "summary": summary.as_dict(),
+        "lot": lot_aggregator.summary(request.batch_id, request.product_type, request.total_units,
+                                      request.expected_images, claim=True)
+    }
+
+@app.post("/jobs", status_code=202)
+async def submit_job(request: JobRequest):
+    """
+    Encolar un análisis asíncrono y responder de inmediato con el ID del trabajo
+    
+    - **image_data** o **images**: Una imagen base64 o una lista (lote)
+    - **product_type**, **analysis_id**: Como en `/analyze-image` (analysis_id por defecto = ID del trabajo)
+    - **mode**: `image` (por defecto) o `units`
+    - **priority**: `critical`, `normal` (por defecto) o `bulk`
+    - **callback_url**: URL opcional que recibe un POST con el estado y el resultado al terminar
+    - **batch_id**, **total_units**: Sumar cada imagen a los agregados del lote (solo `mode=image`)
+    
+    El estado se consulta en `GET /jobs/{job_id}` y el resultado en `GET /jobs/{job_id}/result`.
+    """
+    if not request.image_data and not request.images:
+        raise HTTPException(status_code=400, detail="image_data o images requerido")
+    if request.mode not in ("image", "units"):
+        raise HTTPException(status_code=400, detail="mode debe ser 'image' o 'units'")
+    if request.priority not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail=f"priority debe ser una de: {', '.join(PRIORITY_CLASSES)}")
+    if request.callback_url and urllib.parse.urlparse(request.callback_url).scheme not in ("http", "https"):
+        raise HTTPException(status_code=400, detail="callback_url debe ser una URL http(s)")
+    
+    job, position = job_queue.submit(request)
+    print(f"🗂️ Trabajo {job.id} encolado: {job.total_images} imágenes de {job.product_type} "
+          f"(prioridad {job.priority}, posición {position})")
+    return job.status_dict(position)
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Estado y progreso de un trabajo (queued, running, completed, failed)"""
+    job = job_queue.get(job_id)
+    return job.status_dict(job_queue.position(job))
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """Resultado de un trabajo terminado; 202 con el estado si aún no termina"""
+    job = job_queue.get(job_id)
+    if job.status == "failed":
+        raise HTTPException(status_code=job.error_status or 500, detail=job.error)
+    if job.status != "completed":
+        # Sugerir el siguiente sondeo según la duración media de los trabajos
+        retry_after = max(1, int(job_queue.stats()["average_job_seconds"] or 1))
+        return JSONResponse(status_code=202, content=job.status_dict(job_queue.position(job)),
+                            headers={"Retry-After": str(retry_after)})
+    return job.result
+
+@app.get("/lots/{batch_id}")
+async def get_lot(batch_id: str):
+    """Agregados de un lote: distribuciones de calidad y tamaño, defectos, score medio y tasas"""
+    return lot_aggregator.summary(batch_id)
+
+class FrameStreamSession:
+    """Estado de una conexión de cámara: último frame pendiente y contadores"""
+    def __init__(self, websocket: WebSocket, product_type: str, stream_id: str):
+        self.websocket = websocket
+        self.product_type = product_type
+        self.stream_id = stream_id
+        self.received = 0
+        self.analyzed = 0
+        self.dropped = 0
+        self.errors = 0
+        self._pending: Optional[Tuple[int, bytes, str]] = None
+        self._frame_ready = asyncio.Event()
+
+    def submit(self, frame: bytes):
+        """Encolar un frame; si había uno esperando se descarta (gana el más reciente)"""
+        self.received += 1
+        if self._pending is not None:
+            self.dropped += 1
+        self._pending = (self.received, frame, self.product_type)
+        self._frame_ready.set()
+
+    async def reject(self, frame: bytes):
+        """Responder con error a un frame mayor que VISION_STREAM_MAX_FRAME_MB sin encolarlo"""
+        self.received += 1
+        self.errors += 1
+        await self.websocket.send_text(json.dumps({
+            "type": "error",
+            "frame_id": self.received,
+            "detail": f"Frame de {len(frame) / 1024 / 1024:.1f} MB supera el máximo de {VISION_STREAM_MAX_FRAME_MB:g} MB",
+            "stats": self.stats()
+        }, ensure_ascii=False))
+
+    def stats(self) -> Dict:
+        return {
+            "received": self.received,
+            "analyzed": self.analyzed,
+            "dropped": self.dropped,
+            "queued": 1 if self._pending is not None else 0,
+            "errors": self.errors
+        }
+
+    async def analyze_loop(self):
+        """Analizar siempre el frame más reciente y enviar su resultado.
+        
+        Un fallo de análisis se informa como error del frame; el bucle solo termina si no se
+        puede enviar al cliente.
+        """
+        while True:
+            await self._frame_ready.wait()
+            self._frame_ready.clear()
+            if self._pending is None:
+                continue
+            frame_id, frame, product_type = self._pending
+            self._pending = None
+            
+            try:
+                # Cada frame es distinto: ni se busca ni se guarda en la caché de resultados
+                result = await run_analysis(frame, product_type, f"{self.stream_id}_{frame_id}", bypass_cache=True,
+                                            cache_store=False)
+                self.analyzed += 1
+                message = {"type": "result", "frame_id": frame_id, "result": result}
+            except HTTPException as e:
+                self.errors += 1
+                message = {"type": "error", "frame_id": frame_id, "detail": str(e.detail)}
+            except Exception as e:
+                self.errors += 1
+                print(f"❌ Error analizando el frame {frame_id} de {self.stream_id}: {str(e)}")
+                message = {"type": "error", "frame_id": frame_id, "detail": f"Error en análisis: {str(e)}"}
+            message["stats"] = self.stats()
+            try:
+                await self.websocket.send_text(json.dumps(message, ensure_ascii=False))
+            except Exception as e:
+                print(f"❌ No se pudo enviar el frame {frame_id} de {self.stream_id}: {str(e)}")
+                return
+
+@app.websocket("/ws/frames")
+async def frame_stream(websocket: WebSocket, product_type: str = Query("Manzana"), stream_id: Optional[str] = Query(None)):
+    """
+    Stream continuo de frames de cámara (mensajes binarios = imágenes)
+    
+    - **product_type**: Tipo de producto inicial; se cambia enviando el texto `{"product_type": "Naranja"}`
+    - **stream_id**: Prefijo de los analysis_id de cada frame (opcional)
+    
+    Cada resultado incluye `stats` con frames recibidos, analizados, descartados y en cola.
+    Si el análisis va por detrás de la cámara solo se analiza el frame más reciente. Los frames
+    no pasan por la caché de resultados; los mayores que VISION_STREAM_MAX_FRAME_MB se rechazan
+    y el resto se somete al presupuesto de memoria por petición.
+    """
+    await websocket.accept()
+    session = FrameStreamSession(websocket, product_type, stream_id or f"stream_{datetime.now().timestamp()}")
+    print(f"📹 Stream de frames conectado: {session.stream_id} ({product_type})")
+    analyzer = asyncio.create_task(session.analyze_loop())
+    
+    try:
+        while True:
+            # Esperar el siguiente mensaje o el fin del bucle de análisis (que ya no puede responder)
+            receive = asyncio.ensure_future(websocket.receive())
+            await asyncio.wait({receive, analyzer}, return_when=asyncio.FIRST_COMPLETED)
+            if analyzer.done():
+                receive.cancel()
+                try:
+                    await websocket.close(code=1011)
+                except Exception:
+                    pass  # la conexión ya estaba cerrada
+                break
+            message = receive.result()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                if 0 < VISION_STREAM_MAX_FRAME_MB * 1024 * 1024 < len(message["bytes"]):
+                    await session.reject(message["bytes"])
+                else:
+                    session.submit(message["bytes"])
+            elif message.get("text") is not None:
+                try:
+                    control = json.loads(message["text"])
+                    session.product_type = control.get("product_type", session.product_type)
+                    await websocket.send_text(json.dumps({"type": "config", "product_type": session.product_type,
+                                                          "stats": session.stats()}, ensure_ascii=False))
+                except (ValueError, AttributeError):
+                    await websocket.send_text(json.dumps({"type": "error", "detail": "Mensaje de control inválido"}))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        analyzer.cancel()
+        print(f"📹 Stream {session.stream_id} cerrado: {session.stats()}")
+
 @app.get("/")
 async def root():
     """Endpoint raíz con información de la API"""
@@ -359,7 +3446,16 @@ async def root():
         "status": "active",
         "endpoints": {
             "analyze-image": "POST /analyze-image - Analizar imagen individual",
+            "analyze-image-raw": "POST /analyze-image/raw - Analizar imagen binaria (sin base64)",
+            "analyze-units": "POST /analyze-units - Analizar cada unidad de un frame con varias frutas",
             "analyze-batch": "POST /analyze-batch - Analizar lote de imágenes",
+            "analyze-batch-json": "POST /analyze-batch/json - Sub-lote base64 sumado a un batch_id (fan-out de n8n)",
+            "frame-stream": "WS /ws/frames - Stream de frames de cámara en vivo",
+            "jobs": "POST /jobs - Encolar análisis asíncrono (GET /jobs/{id}, GET /jobs/{id}/result)",
+            "lots": "GET /lots/{batch_id} - Agregados de calidad de un lote",
+            "cache-stats": "GET /cache/stats - Estadísticas de la caché de resultados",
+            "metrics": "GET /metrics - Métricas en formato Prometheus",
+            "profiles": "GET /profiles - Perfiles de análisis (header X-Profile o muestreo)",
             "docs": "GET /docs - Documentación interactiva"
         }
     }
@@ -370,9 +3466,49 @@ async def health_check():
     return {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
-        "service": "agricultural-vision-api"
+        "service": "agricultural-vision-api",
+        "executor": analysis_executor.stats(),
+        "microbatching": microbatch_scheduler.stats(),
+        "jobs": job_queue.stats(),
+        "admission": admission_controller.stats(),
+        "lots": lot_aggregator.stats(),
+        "detector_backend": VISION_DETECTOR_BACKEND or "simulated"
     }
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Latencias por etapa y producto, peticiones, payloads y errores en formato de texto de Prometheus"""
+    return PlainTextResponse(vision_metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/profiles")
+async def list_profiles():
+    """Perfiles guardados (header X-Profile o muestreo VISION_PROFILE_SAMPLE_RATE)"""
+    return {
+        "directory": profile_store.directory,
+        "profiler": "pyinstrument" if SamplingProfiler is not None else "cProfile",
+        "sample_rate": VISION_PROFILE_SAMPLE_RATE,
+        "profiles": profile_store.list()
+    }
+
+@app.get("/profiles/{profile_file}")
+async def get_profile(profile_file: str):
+    """Descargar un perfil (.prof de cProfile para pstats/snakeviz, o .html de pyinstrument)"""
+    # Solo archivos del propio directorio de perfiles
+    if profile_file not in {entry["file"] for entry in profile_store.list()}:
+        raise HTTPException(status_code=404, detail=f"Perfil no encontrado: {profile_file}")
+    return FileResponse(os.path.join(profile_store.directory, profile_file), filename=profile_file)
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """Estadísticas de la caché de resultados (aciertos, fallos, desalojos)"""
+    return result_cache.stats()
+
+@app.delete("/cache")
+async def clear_cache():
+    """Vaciar la caché de resultados"""
+    result_cache.clear()
+    return {"status": "cleared", **result_cache.stats()}
+
 @app.get("/supported-products")
 async def get_supported_products():
     """Obtener lista de productos soportados"""
@@ -385,6 +3521,9 @@ if __name__ == "__main__":
     print("🚀 Iniciando Servidor de Computer Vision...")
     print("📚 Documentación disponible en: http://localhost:8004/docs")
     print("🌱 Productos soportados:", list(vision_ai.defect_categories.keys()))
+    print(f"⚙️ Workers de análisis: {VISION_WORKERS} (cola máxima: {VISION_MAX_QUEUE})")
+    print(f"🧠 Detector: {VISION_DETECTOR_BACKEND or 'simulado'} (micro-lotes de hasta {VISION_MICROBATCH_MAX_SIZE}, "
+          f"espera máxima {VISION_MICROBATCH_MAX_WAIT_MS} ms)")
     
     uvicorn.run(
         app, 
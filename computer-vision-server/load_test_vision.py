@@ -0,0 +1,363 @@
+"""
+Generador de carga del servidor de visión con tráfico tipo n8n y Streamlit.
+
+Arranca el servidor con uvicorn en un subproceso (uno por cada número de workers) y reproduce
+una mezcla de peticiones: POST JSON base64 del nodo `Computer Vision AI` de n8n, lotes
+multipart a `/analyze-batch` y health checks. Funciona en lazo cerrado (`--concurrency`
+usuarios simultáneos) o abierto (`--rates` llegadas Poisson por segundo) y reporta p50/p95/p99,
+throughput, tasa de error y CPU del servidor (Linux, /proc). Con varias tasas por número de
+workers indica el punto de saturación.
+
+    python load_test_vision.py --workers 1,2,4 --rates 2,4,8,16 --duration 30
+    python load_test_vision.py --concurrency 8 --mix image=0.7,batch=0.2,health=0.1
+    python load_test_vision.py --url http://computer-vision:8004 --concurrency 4
+"""
+import argparse
+import base64
+import http.client
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from benchmark_vision import synthetic_fruit
+
+PRODUCT_TYPES = ["Manzana", "Naranja", "Tomate", "Papa"]
+SERVER_START_TIMEOUT = 60
+# Saturación: throughput < 90% de lo ofrecido, p95 por encima del SLO o más de 1% de errores
+SATURATION_THROUGHPUT_RATIO = 0.9
+SATURATION_ERROR_RATE = 0.01
+
+class TrafficMix:
+    """Peticiones pre-construidas (cuerpos y headers) y su proporción en la mezcla"""
+    def __init__(self, mix: Dict[str, float], image_size: Tuple[int, int], unique_images: int,
+                 batch_size: int, seed: int):
+        self.rng = random.Random(seed)
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        width, height = image_size
+        # Fotos distintas (cosecha real: sin aciertos de caché), en JPEG como las sube Streamlit
+        self.images = [synthetic_fruit(width, height, "RGB", "JPEG", PRODUCT_TYPES[i % len(PRODUCT_TYPES)], seed + i)
+                       for i in range(unique_images)]
+        self.data_uris = ["data:image/jpeg;base64," + base64.b64encode(image).decode("ascii") for image in self.images]
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+
+    def next_request(self) -> Tuple[str, str, str, Optional[bytes], Dict[str, str]]:
+        """(tipo, método, ruta, cuerpo, headers) de la siguiente petición de la mezcla"""
+        with self._lock:
+            kind = self.rng.choices(self.kinds, self.weights)[0]
+            index = self.rng.randrange(len(self.images))
+        product_type = PRODUCT_TYPES[index % len(PRODUCT_TYPES)]
+        if kind == "health":
+            return kind, "GET", "/health", None, {}
+        if kind == "batch":
+            body, content_type = self._multipart(index, product_type)
+            return kind, "POST", "/analyze-batch", body, {"Content-Type": content_type}
+        # Mismo cuerpo que el nodo HTTP Request "Computer Vision AI" de n8n
+        body = json.dumps({
+            "image_data": self.data_uris[index],
+            "product_type": product_type,
+            "analysis_id": f"load_{uuid.uuid4().hex[:12]}"
+        }).encode("utf-8")
+        return kind, "POST", "/analyze-image", body, {"Content-Type": "application/json"}
+
+    def _multipart(self, start: int, product_type: str) -> Tuple[bytes, str]:
+        boundary = uuid.uuid4().hex
+        parts = []
+        for i in range(self.batch_size):
+            image = self.images[(start + i) % len(self.images)]
+            parts.append((f'--{boundary}\r\nContent-Disposition: form-data; name="images"; filename="img_{i}.jpg"\r\n'
+                          f'Content-Type: image/jpeg\r\n\r\n').encode("ascii") + image + b"\r\n")
+        parts.append((f'--{boundary}\r\nContent-Disposition: form-data; name="product_type"\r\n\r\n'
+                      f'{product_type}\r\n--{boundary}--\r\n').encode("utf-8"))
+        return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+class LoadClient:
+    """Cliente HTTP de la librería estándar con una conexión keep-alive por hilo"""
+    def __init__(self, base_url: str, timeout: float):
+        parsed = urlparse(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def request(self, method: str, path: str, body: Optional[bytes], headers: Dict[str, str]) -> int:
+        """Enviar la petición y leer la respuesta completa; retorna el estado HTTP (0 = error de red)"""
+        for attempt in range(2):
+            connection = getattr(self._local, "connection", None)
+            if connection is None:
+                connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                self._local.connection = connection
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                return response.status
+            except (http.client.HTTPException, OSError):
+                # Conexión keep-alive cerrada por el servidor: reintentar una vez con una nueva
+                connection.close()
+                self._local.connection = None
+        return 0
+
+class ServerCPU:
+    """CPU (segundos) consumida por el proceso del servidor y sus workers, leída de /proc"""
+    def __init__(self, pid: Optional[int]):
+        self.pid = pid
+        self.clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def _stat(self, pid: int) -> Optional[List[str]]:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # El nombre del proceso va entre paréntesis y puede contener espacios
+                return f.read().rsplit(")", 1)[1].split()
+        except (FileNotFoundError, ProcessLookupError, IndexError, PermissionError):
+            return None
+
+    def seconds(self) -> Optional[float]:
+        if self.pid is None or not os.path.exists("/proc"):
+            return None
+        stat = self._stat(self.pid)
+        if stat is None:
+            return None
+        # utime + stime propios y de los hijos ya terminados (workers reiniciados)
+        ticks = sum(int(v) for v in stat[11:15])
+        for child in self._descendants():
+            child_stat = self._stat(child)
+            if child_stat is not None:
+                ticks += int(child_stat[11]) + int(child_stat[12])
+        return ticks / self.clock_ticks
+
+    def _descendants(self) -> List[int]:
+        parents: Dict[int, List[int]] = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                stat = self._stat(int(entry))
+                if stat is not None:
+                    parents.setdefault(int(stat[1]), []).append(int(entry))
+        found, pending = [], [self.pid]
+        while pending:
+            children = parents.get(pending.pop(), [])
+            found.extend(children)
+            pending.extend(children)
+        return found
+
+def start_server(workers: int, port: int, keep_cache: bool, extra_env: Dict[str, str]) -> subprocess.Popen:
+    """Arrancar computer_vision_server con uvicorn y esperar a que /health responda"""
+    env = dict(os.environ, VISION_WORKERS=str(workers), **extra_env)
+    if not keep_cache:
+        env["VISION_CACHE_MAX_ENTRIES"] = "0"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "computer_vision_server:app", "--host", "127.0.0.1",
+         "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    client = LoadClient(f"http://127.0.0.1:{port}", timeout=5)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"El servidor terminó al arrancar (código {server.returncode})")
+        if client.request("GET", "/health", None, {}) == 200:
+            return server
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f"El servidor no respondió en {SERVER_START_TIMEOUT} s")
+
+def stop_server(server: subprocess.Popen):
+    server.terminate()
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+def latency_stats(samples_ms: List[float]) -> Dict:
+    if not samples_ms:
+        return {"count": 0}
+    ordered = sorted(samples_ms)
+
+    def percentile(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered),
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "max_ms": ordered[-1]
+    }
+
+def run_phase(client: LoadClient, mix: TrafficMix, duration: float, concurrency: Optional[int],
+              rate: Optional[float], max_in_flight: int, cpu: ServerCPU, seed: int) -> Dict:
+    """Una fase de carga: lazo cerrado (concurrency) o abierto (rate, llegadas Poisson)"""
+    records: List[Tuple[str, int, float]] = []
+    lock = threading.Lock()
+
+    def send(scheduled: float):
+        kind, method, path, body, headers = mix.next_request()
+        status = client.request(method, path, body, headers)
+        # Latencia desde la llegada prevista (incluye la espera en el cliente: sin omisión coordinada)
+        with lock:
+            records.append((kind, status, (time.perf_counter() - scheduled) * 1000))
+
+    cpu_start = cpu.seconds()
+    start = time.perf_counter()
+    deadline = start + duration
+    if rate:
+        arrivals = random.Random(seed)
+        with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+            next_arrival = start
+            while next_arrival < deadline:
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(send, next_arrival)
+                next_arrival += arrivals.expovariate(rate)
+    else:
+        def user():
+            while time.perf_counter() < deadline:
+                send(time.perf_counter())
+
+        threads = [threading.Thread(target=user, daemon=True) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    wall = time.perf_counter() - start
+    cpu_end = cpu.seconds()
+
+    errors = [r for r in records if not 200 <= r[1] < 300]
+    statuses: Dict[str, int] = {}
+    for _, status, _ in records:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    images = sum(mix.batch_size if kind == "batch" else 1 for kind, status, _ in records
+                 if kind != "health" and 200 <= status < 300)
+    cpu_cores = (cpu_end - cpu_start) / wall if cpu_start is not None and cpu_end is not None else None
+
+    return {
+        "concurrency": concurrency,
+        "offered_rate": rate,
+        "duration_s": wall,
+        "requests": len(records),
+        "throughput_rps": len(records) / wall,
+        "images_per_second": images / wall,
+        "errors": len(errors),
+        "error_rate": len(errors) / len(records) if records else 0.0,
+        "status_codes": statuses,
+        "latency": latency_stats([r[2] for r in records]),
+        "latency_by_type": {kind: latency_stats([r[2] for r in records if r[0] == kind]) for kind in mix.kinds},
+        "server_cpu_cores": cpu_cores,
+        "server_cpu_percent": cpu_cores / (os.cpu_count() or 1) * 100 if cpu_cores is not None else None
+    }
+
+def saturated(phase: Dict, slo_ms: float) -> bool:
+    offered = phase["offered_rate"]
+    return ((offered is not None and phase["throughput_rps"] < SATURATION_THROUGHPUT_RATIO * offered)
+            or phase["latency"].get("p95_ms", 0) > slo_ms
+            or phase["error_rate"] > SATURATION_ERROR_RATE)
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for item in value.split(","):
+        kind, weight = item.split("=")
+        if kind not in ("image", "batch", "health"):
+            raise argparse.ArgumentTypeError(f"Tipo de petición desconocido: {kind}")
+        mix[kind] = float(weight)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga del servidor de visión")
+    parser.add_argument("--url", default=None, help="Servidor ya en marcha (no se arranca uno local)")
+    parser.add_argument("--port", type=int, default=8014, help="Puerto del servidor local")
+    parser.add_argument("--workers", default="1", help="VISION_WORKERS a probar, separados por coma")
+    parser.add_argument("--concurrency", type=int, default=None, help="Usuarios simultáneos (lazo cerrado)")
+    parser.add_argument("--rates", default=None, help="Llegadas por segundo a probar (lazo abierto), separadas por coma")
+    parser.add_argument("--duration", type=float, default=20, help="Segundos por fase")
+    parser.add_argument("--warmup", type=float, default=3, help="Segundos de calentamiento antes de cada número de workers")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("image=0.8,batch=0.1,health=0.1"),
+                        help="Proporción de peticiones image/batch/health")
+    parser.add_argument("--image-size", default="1280x960", help="Tamaño de las fotos (AnchoxAlto)")
+    parser.add_argument("--unique-images", type=int, default=32, help="Fotos distintas en rotación")
+    parser.add_argument("--batch-size", type=int, default=8, help="Imágenes por petición a /analyze-batch")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="Peticiones abiertas máximas en lazo abierto")
+    parser.add_argument("--timeout", type=float, default=120, help="Timeout por petición (s)")
+    parser.add_argument("--slo-ms", type=float, default=2000, help="p95 máximo aceptable para el punto de saturación")
+    parser.add_argument("--keep-cache", action="store_true", help="No desactivar la caché de resultados del servidor")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="load_test_results.json", help="Archivo JSON de salida")
+    args = parser.parse_args()
+    if args.concurrency is None and args.rates is None:
+        args.concurrency = 4
+
+    width, height = (int(v) for v in args.image_size.lower().split("x"))
+    print(f"🧪 Generando {args.unique_images} fotos sintéticas de {width}x{height}...")
+    mix = TrafficMix(args.mix, (width, height), args.unique_images, args.batch_size, args.seed)
+    loads = [(None, float(r)) for r in args.rates.split(",")] if args.rates else [(args.concurrency, None)]
+    worker_counts = [None] if args.url else [int(w) for w in args.workers.split(",")]
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "cpu_count": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k != "output"}
+        },
+        "runs": []
+    }
+    for workers in worker_counts:
+        server = None
+        if workers is not None:
+            print(f"🚀 Arrancando servidor con VISION_WORKERS={workers} en el puerto {args.port}...")
+            server = start_server(workers, args.port, args.keep_cache, {"VISION_RANDOM_SEED": str(args.seed)})
+        client = LoadClient(args.url or f"http://127.0.0.1:{args.port}", args.timeout)
+        cpu = ServerCPU(server.pid if server else None)
+        try:
+            if args.warmup > 0:
+                run_phase(client, mix, args.warmup, 1, None, args.max_in_flight, cpu, args.seed)
+            phases = []
+            for concurrency, rate in loads:
+                load = f"{rate:g} req/s" if rate else f"{concurrency} usuarios"
+                print(f"📈 workers={workers or 'remoto'} carga={load} durante {args.duration:g} s...")
+                phase = run_phase(client, mix, args.duration, concurrency, rate, args.max_in_flight, cpu, args.seed)
+                phase["saturated"] = saturated(phase, args.slo_ms)
+                phases.append(phase)
+                latency = phase["latency"]
+                cpu_text = f"{phase['server_cpu_percent']:.0f}%" if phase["server_cpu_percent"] is not None else "n/d"
+                print(f"   {phase['throughput_rps']:.1f} req/s ({phase['images_per_second']:.1f} img/s)  "
+                      f"p50 {latency.get('p50_ms', 0):.0f} ms  p95 {latency.get('p95_ms', 0):.0f} ms  "
+                      f"p99 {latency.get('p99_ms', 0):.0f} ms  errores {phase['error_rate']:.1%}  CPU {cpu_text}"
+                      f"{'  ⚠️ saturado' if phase['saturated'] else ''}")
+        finally:
+            if server is not None:
+                stop_server(server)
+
+        sustainable = [p for p in phases if not p["saturated"]]
+        best = max(sustainable, key=lambda p: p["throughput_rps"]) if sustainable else None
+        report["runs"].append({
+            "workers": workers,
+            "phases": phases,
+            "max_sustainable_rps": best["throughput_rps"] if best else None,
+            "saturation_rate": next((p["offered_rate"] for p in phases if p["saturated"]), None)
+        })
+
+    print("\n📊 Resumen")
+    for run in report["runs"]:
+        sustainable = f"{run['max_sustainable_rps']:.1f} req/s" if run["max_sustainable_rps"] else "ninguna"
+        saturation = f"{run['saturation_rate']:g} req/s" if run["saturation_rate"] else "no alcanzada"
+        print(f"   workers={run['workers'] or 'remoto'}: máximo sostenible {sustainable}, saturación a {saturation}")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"💾 Resultados guardados en {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Motor de puntuación de calidad: severidad de defectos, categoría de tamaño, score y grado.
+
+Reproduce la lógica que antes corría en los nodos de n8n `⚙️ Process Product Data` y
+`🔍 Defect Detection`. Los estándares por producto se leen una vez por proceso de la tabla
+`quality_standards` de Supabase (`SUPABASE_URL` / `SUPABASE_KEY`) y, si no está configurada
+o no responde, del archivo local `quality_standards.json`.
+
+    scorer = default_scorer()
+    result.update(scorer.score(result))           # un análisis
+    columns = scorer.score_many(results)          # miles de análisis con numpy
+"""
+import json
+import os
+import urllib.request
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+SUPABASE_URL = os.getenv("SUPABASE_URL", "")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY", "")
+VISION_QUALITY_STANDARDS_FILE = os.getenv(
+    "VISION_QUALITY_STANDARDS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "quality_standards.json"))
+QUALITY_STANDARDS_TIMEOUT = 5.0
+STANDARDS_COLUMNS = "product_type,size_categories,size_thresholds,defect_categories,max_defects_per_unit,min_quality_score"
+DEFAULT_PRODUCT = "Manzana"
+
+# Severidad por tipo de defecto (tipos no listados: leve)
+DEFECT_SEVERITY = {
+    'minor': ['Punto Negro', 'Mancha Leve'],
+    'moderate': ['Golpe', 'Corte Pequeño', 'Rajadura'],
+    'severe': ['Podredumbre', 'Daño Severo', 'Verde']
+}
+SEVERITY_PENALTIES = {'minor': 5, 'moderate': 15, 'severe': 40}
+# Penalización por tamaño fuera de estándar
+SMALL_SIZE_CATEGORY = 'Pequeña'
+SMALL_SIZE_PENALTY = 10
+BASE_SCORE = 100
+# Grados por score mínimo, de mayor a menor; por debajo del último: Rechazado
+GRADE_THRESHOLDS = [(90, 'Premium'), (75, 'Estándar'), (60, 'Comercial')]
+REJECTED_GRADE = 'Rechazado'
+
+def defect_severity(defect_type: str) -> str:
+    """Severidad de un tipo de defecto"""
+    for severity, types in DEFECT_SEVERITY.items():
+        if defect_type in types:
+            return severity
+    return 'minor'
+
+def quality_grade(score: float) -> str:
+    """Grado de calidad de un score"""
+    for threshold, grade in GRADE_THRESHOLDS:
+        if score >= threshold:
+            return grade
+    return REJECTED_GRADE
+
+def fetch_supabase_standards(url: str, key: str, timeout: float = QUALITY_STANDARDS_TIMEOUT) -> Dict[str, Dict]:
+    """Leer la tabla `quality_standards` por la API REST de Supabase"""
+    request = urllib.request.Request(
+        f"{url.rstrip('/')}/rest/v1/quality_standards?select={STANDARDS_COLUMNS}",
+        headers={"apikey": key, "Authorization": f"Bearer {key}", "Accept": "application/json"}
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        rows = json.loads(response.read().decode("utf-8"))
+    return {row.pop("product_type"): row for row in rows}
+
+def load_quality_standards(path: str = VISION_QUALITY_STANDARDS_FILE) -> Tuple[Dict[str, Dict], str]:
+    """Estándares por producto y su origen ("supabase" o la ruta del archivo local)"""
+    if SUPABASE_URL and SUPABASE_KEY:
+        try:
+            standards = fetch_supabase_standards(SUPABASE_URL, SUPABASE_KEY)
+            if standards:
+                print(f"✅ Estándares de calidad cargados de Supabase: {', '.join(sorted(standards))}")
+                return standards, "supabase"
+            print("⚠️ La tabla quality_standards está vacía, usando el archivo local")
+        except Exception as e:
+            print(f"⚠️ No se pudieron leer los estándares de Supabase ({e}), usando el archivo local")
+    with open(path, encoding="utf-8") as f:
+        return json.load(f), path
+
+class QualityScorer:
+    """Clasificación de defectos, categoría de tamaño, score y grado según los estándares por producto"""
+    def __init__(self, standards: Dict[str, Dict], source: str = "memoria"):
+        if DEFAULT_PRODUCT not in standards:
+            raise ValueError(f"Los estándares de calidad deben incluir {DEFAULT_PRODUCT!r}")
+        self.standards = standards
+        self.source = source
+
+    def standards_for(self, product_type: str) -> Dict:
+        """Estándares del producto (los de Manzana si no está configurado)"""
+        return self.standards.get(product_type, self.standards[DEFAULT_PRODUCT])
+
+    def classify_defects(self, defects: List[Dict], total_area: float) -> List[Dict]:
+        """Defectos con la severidad del estándar y el área en % de la imagen completa (`image_area_percentage`).
+
+        `area_percentage` se conserva tal como la reporta el detector (relativa a la región del producto).
+        """
+        return [{
+            **defect,
+            'severity': defect_severity(defect.get('type')),
+            'image_area_percentage': round(defect['area'] / total_area * 100, 2) if defect.get('area') and total_area else 0
+        } for defect in defects]
+
+    def size_category(self, diameter_mm: float, product_type: str) -> str:
+        """Categoría de tamaño: la del mayor umbral superado por el diámetro"""
+        standards = self.standards_for(product_type)
+        index = int(np.searchsorted(standards['size_thresholds'], diameter_mm, side='left'))
+        return standards['size_categories'][min(index, len(standards['size_categories']) - 1)]
+
+    def score(self, result: Dict) -> Dict:
+        """Campos de calidad de un resultado de análisis (se combinan sobre el resultado)"""
+        defects = self.classify_defects(result.get('defects') or [], result.get('total_area') or 0)
+        diameter = (result.get('size_measurements') or {}).get('diameter_mm') or 0
+        size_category = self.size_category(diameter, result.get('product_type'))
+
+        score = BASE_SCORE - sum(SEVERITY_PENALTIES[d['severity']] for d in defects)
+        if size_category == SMALL_SIZE_CATEGORY:
+            score -= SMALL_SIZE_PENALTY
+        score = max(0, score)
+
+        return {
+            'defects': defects,
+            'total_defects': len(defects),
+            'severe_defects': sum(1 for d in defects if d['severity'] == 'severe'),
+            'size_category': size_category,
+            'measured_diameter': float(diameter),
+            'quality_score': float(score),
+            'quality_grade': quality_grade(score)
+        }
+
+    def score_many(self, results: List[Dict]) -> Dict[str, np.ndarray]:
+        """Score de muchos análisis a la vez: columnas numpy alineadas con `results`.
+
+        Misma lógica que `score` sin copiar los defectos: las penalizaciones se suman por
+        análisis con bincount y las categorías de tamaño se buscan por producto con searchsorted.
+        """
+        n = len(results)
+        counts = np.fromiter((len(r.get('defects') or []) for r in results), np.int64, n)
+        types = np.array([d.get('type') or '' for r in results for d in (r.get('defects') or [])], dtype=object)
+        owner = np.repeat(np.arange(n), counts)
+
+        unique_types, inverse = np.unique(types, return_inverse=True)
+        severities = [defect_severity(t) for t in unique_types]
+        penalty = np.array([SEVERITY_PENALTIES[s] for s in severities], np.float64)[inverse]
+        severe = np.array([s == 'severe' for s in severities], np.float64)[inverse]
+        penalties = np.bincount(owner, weights=penalty, minlength=n)
+        severe_defects = np.bincount(owner, weights=severe, minlength=n).astype(np.int64)
+
+        diameters = np.fromiter(((r.get('size_measurements') or {}).get('diameter_mm') or 0 for r in results),
+                                np.float64, n)
+        products = np.array([r.get('product_type') if r.get('product_type') in self.standards else DEFAULT_PRODUCT
+                             for r in results], dtype=object)
+        size_categories = np.empty(n, dtype=object)
+        for product in np.unique(products):
+            mask = products == product
+            standards = self.standards[product]
+            categories = np.array(standards['size_categories'], dtype=object)
+            index = np.searchsorted(standards['size_thresholds'], diameters[mask], side='left')
+            size_categories[mask] = categories[np.minimum(index, len(categories) - 1)]
+
+        scores = BASE_SCORE - penalties - SMALL_SIZE_PENALTY * (size_categories == SMALL_SIZE_CATEGORY)
+        scores = np.maximum(0, scores)
+        grades = np.array([grade for _, grade in GRADE_THRESHOLDS] + [REJECTED_GRADE], dtype=object)
+        grade_index = sum((scores < threshold).astype(np.int64) for threshold, _ in GRADE_THRESHOLDS)
+
+        return {
+            'total_defects': counts,
+            'severe_defects': severe_defects,
+            'size_category': size_categories,
+            'measured_diameter': diameters,
+            'quality_score': scores,
+            'quality_grade': grades[grade_index]
+        }
+
+@lru_cache(maxsize=1)
+def default_scorer() -> QualityScorer:
+    """Motor de puntuación del proceso, con los estándares cargados una sola vez"""
+    return QualityScorer(*load_quality_standards())
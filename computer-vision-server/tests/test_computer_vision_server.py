@@ -0,0 +1,519 @@
+"""
+Pruebas del servidor de visión.
+
+    cd computer-vision-server && python -m pytest -q tests
+"""
+import base64
+import io
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import computer_vision_server as server  # noqa: E402
+
+
+def fruit_jpeg(width: int = 320, height: int = 240) -> bytes:
+    """Imagen sintética de una fruta sobre fondo gris, en JPEG"""
+    image = np.full((height, width, 3), (90, 90, 90), np.uint8)
+    radius = int(min(width, height) * 0.35)
+    cv2.ellipse(image, (width // 2, height // 2), (radius, int(radius * 0.9)), 0, 0, 360, (30, 40, 200), -1)
+    buffer = io.BytesIO()
+    Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def test_analyze_batch_kernel_error_marks_every_image(monkeypatch):
+    """Un fallo del kernel vectorizado se reporta como 500 en cada imagen decodificada"""
+    def broken_kernel(images):
+        raise RuntimeError("kernel roto")
+    monkeypatch.setattr(server.vision_ai, 'batch_features', broken_kernel)
+
+    items = [(fruit_jpeg(), 'Manzana', 'a'), (b'no es una imagen', 'Manzana', 'b'), (fruit_jpeg(), 'Naranja', 'c')]
+    results = server.vision_ai.analyze_batch(items)
+
+    assert all(isinstance(result, HTTPException) for result in results)
+    assert [result.status_code for result in results] == [500, 400, 500]
+    assert "kernel roto" in results[0].detail
+
+
+def test_vectorized_batch_matches_per_image_analysis():
+    """El kernel vectorizado da las mismas cifras de color y textura que analyze_image"""
+    gray = io.BytesIO()
+    Image.open(io.BytesIO(fruit_jpeg(256, 192))).convert('L').save(gray, 'PNG')
+    images = [fruit_jpeg(256, 192), gray.getvalue()]
+    batch = server.vision_ai.analyze_batch([(image, 'Manzana', f'v{i}') for i, image in enumerate(images)])
+
+    for i, image in enumerate(images):
+        single = server.vision_ai.analyze_image(image, 'Manzana', f'v{i}')
+        assert batch[i]['color_analysis'] == pytest.approx(single['color_analysis'], rel=1e-9)
+        assert batch[i]['texture_analysis'] == pytest.approx(single['texture_analysis'], rel=1e-9)
+        assert batch[i]['size_measurements'] == single['size_measurements']
+
+
+def test_lot_counts_each_unit_once(monkeypatch):
+    """Reenviar la misma imagen (caché, reintentos) no suma otra unidad al lote"""
+    monkeypatch.setattr(server, 'lot_aggregator', server.LotAggregator(10, 3600))
+    image = fruit_jpeg()
+    for attempt in range(3):
+        server.lot_aggregator.add('lote-1', 'Manzana', server.vision_ai.analyze_image(image, 'Manzana', f'a{attempt}'),
+                                  server.lot_unit_key(image), total_units=2)
+    server.lot_aggregator.add_error('lote-1', 'Manzana', 1, total_units=2)
+    server.lot_aggregator.add_error('lote-1', 'Manzana', 1, total_units=2)
+
+    lot = server.lot_aggregator.summary('lote-1')
+    assert (lot['analyzed_units'], lot['failed_units'], lot['duplicate_units']) == (1, 1, 3)
+    assert lot['complete']
+
+
+def test_lot_dedup_across_retried_requests(monkeypatch):
+    """Reintentar un sub-lote o reenviar una imagen (acierto de caché) no infla el lote"""
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(server, 'lot_aggregator', server.LotAggregator(10, 3600))
+    monkeypatch.setattr(server, 'result_cache', server.ResultCache(10, 3600))
+    client = TestClient(server.app)
+    image = base64.b64encode(fruit_jpeg()).decode('ascii')
+    body = {'product_type': 'Manzana', 'batch_id': 'lote-reintentos', 'total_units': 4, 'start_index': 0}
+    client.post('/analyze-batch/json', json={**body, 'images': [image, 'no es base64']})
+    # Reintento del sub-lote: la imagen inválida ahora llega bien y pasa de fallida a analizada
+    retried = client.post('/analyze-batch/json', json={**body, 'images': [image, image]}).json()['lot']
+    assert (retried['analyzed_units'], retried['failed_units'], retried['duplicate_units']) == (2, 0, 1)
+
+    raw = [client.post('/analyze-image/raw?product_type=Manzana&batch_id=lote-reintentos&total_units=4',
+                       content=fruit_jpeg(256, 192)).json() for _ in range(2)]
+    assert [response['cache_hit'] for response in raw] == [False, True]
+    assert (raw[-1]['lot']['analyzed_units'], raw[-1]['lot']['duplicate_units']) == (3, 2)
+
+
+def test_lot_dedup_state_is_bounded(monkeypatch):
+    """Posiciones en un byte por unidad (hasta total_units) y hashes en un LRU acotado"""
+    monkeypatch.setattr(server, 'VISION_LOT_MAX_HASHED_UNITS', 3)
+    lot = server.LotStatistics('lote-acotado', 'Manzana')
+    lot.add_error(1)
+    lot.total_units = 4
+    for unit in range(4):
+        lot.add_error(unit)
+    for key in ('a', 'b', 'c', 'd'):
+        lot.add_error(key)
+
+    assert len(lot.indexed_units) == 4
+    assert list(lot.hashed_units) == ['b', 'c', 'd']
+    assert (lot.failed_units, lot.duplicate_units) == (8, 1)
+
+
+def test_lot_summary_without_units(monkeypatch):
+    """Un lote sin unidades da 404 en GET /lots y un resumen vacío en las respuestas de análisis"""
+    monkeypatch.setattr(server, 'lot_aggregator', server.LotAggregator(10, 3600))
+    with pytest.raises(HTTPException) as error:
+        server.lot_aggregator.summary('vacío')
+    assert error.value.status_code == 404
+
+    lot = server.lot_aggregator.summary('vacío', 'Manzana', 4)
+    assert (lot['analyzed_units'], lot['total_units'], lot['complete']) == (0, 4, False)
+
+
+def test_lot_reports_completion_once_and_keeps_declared_units(monkeypatch):
+    """expected_images completa el lote sin pisar total_units; completed_now sale en una sola respuesta"""
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(server, 'lot_aggregator', server.LotAggregator(10, 3600))
+    monkeypatch.setattr(server, 'result_cache', server.ResultCache(10, 3600))
+    client = TestClient(server.app)
+    image = base64.b64encode(fruit_jpeg()).decode('ascii')
+    body = {'product_type': 'Manzana', 'batch_id': 'lote-n8n', 'total_units': 500, 'expected_images': 2}
+    lots = [client.post('/analyze-batch/json', json={**body, 'images': [image], 'start_index': start}).json()['lot']
+            for start in (0, 1, 1)]
+
+    assert [(lot['complete'], lot['completed_now']) for lot in lots] == [(False, False), (True, True), (True, False)]
+    assert (lots[-1]['total_units'], lots[-1]['expected_images'], lots[-1]['duplicate_units']) == (500, 2, 1)
+
+
+def test_admission_critical_request_displaces_bulk_despite_client_share():
+    """Una petición crítica con la cola llena desplaza a una bulk sin caer en el límite por cliente"""
+    import asyncio
+
+    async def scenario():
+        controller = server.AdmissionController(max_in_flight=1, max_queue=4, queue_timeout=5)
+        await controller.acquire('ocupado', 'normal')
+        waiters = [asyncio.ensure_future(controller.acquire(client, priority)) for client, priority in
+                   [('masivo', 'bulk'), ('operador', 'normal'), ('operador', 'normal'), ('masivo', 'bulk')]]
+        await asyncio.sleep(0)
+        critical = asyncio.ensure_future(controller.acquire('operador', 'critical'))
+        await asyncio.sleep(0.01)
+
+        shed = waiters[3]
+        assert shed.done() and shed.exception().status_code == 429
+        assert not critical.done()
+        controller.release('ocupado')
+        await asyncio.wait_for(critical, 1)
+        for waiter in waiters[:3]:
+            waiter.cancel()
+        await asyncio.gather(*waiters[:3], return_exceptions=True)
+        assert controller.rejected == {('shed', 'bulk'): 1}
+
+    asyncio.run(scenario())
+
+
+def test_admission_sheds_lower_priority_with_retry_after(monkeypatch):
+    """Con la cola llena una petición normal desplaza a una bulk (429) y otra normal recibe 429 con Retry-After"""
+    import asyncio
+    import httpx
+
+    release = asyncio.Event()
+
+    async def gated_analysis(image_data, product_type, analysis_id, **kwargs):
+        await release.wait()
+        return server.vision_ai.analyze_image(image_data, product_type, analysis_id)
+    monkeypatch.setattr(server, 'run_analysis', gated_analysis)
+    monkeypatch.setattr(server, 'admission_controller', server.AdmissionController(max_in_flight=1, max_queue=1,
+                                                                                   queue_timeout=5))
+    image = fruit_jpeg()
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            def post(operator, priority):
+                return asyncio.ensure_future(client.post('/analyze-image/raw?product_type=Manzana', content=image,
+                                                         headers={'X-Operator-Id': operator, 'X-Priority': priority}))
+            running = post('linea-1', 'normal')
+            await asyncio.sleep(0.01)
+            bulk = post('carga-masiva', 'bulk')
+            await asyncio.sleep(0.01)
+            normal = post('linea-2', 'normal')
+            await asyncio.sleep(0.01)
+            rejected = await post('linea-3', 'normal')
+            shed = await bulk
+            release.set()
+            return await running, shed, await normal, rejected
+
+    running, shed, normal, rejected = asyncio.run(scenario())
+    assert (running.status_code, normal.status_code) == (200, 200)
+    assert shed.status_code == 429 and 'shed' in shed.json()['detail']
+    assert rejected.status_code == 429 and 'queue_full' in rejected.json()['detail']
+    assert int(shed.headers['Retry-After']) >= 1 and int(rejected.headers['Retry-After']) >= 1
+    assert server.admission_controller.rejected == {('shed', 'bulk'): 1, ('queue_full', 'normal'): 1}
+
+
+def test_admission_retry_after_uses_per_image_service_time():
+    """El Retry-After se estima con el tiempo de servicio por imagen"""
+    controller = server.AdmissionController(max_in_flight=2, max_queue=4, queue_timeout=5)
+    for _ in range(10):
+        controller.observe_service(0.4)
+    assert controller.retry_after() == 1
+
+
+def test_analyze_image_response_keeps_result_fields():
+    """La respuesta de /analyze-image conserva resolución, dimensiones, textura y acierto de caché"""
+    from fastapi.testclient import TestClient
+
+    client = TestClient(server.app)
+    image = 'data:image/jpeg;base64,' + base64.b64encode(fruit_jpeg()).decode()
+    responses = [client.post('/analyze-image', json={'image_data': image, 'product_type': 'Manzana',
+                                                     'analysis_id': f'campos_{i}'}) for i in range(2)]
+
+    assert [response.status_code for response in responses] == [200, 200]
+    first, second = (response.json() for response in responses)
+    for field in ('texture_analysis', 'image_dimensions', 'analysis_resolution', 'cache_hit'):
+        assert field in first
+    assert first['image_dimensions'] == {'width': 320, 'height': 240}
+    if server.result_cache.enabled:
+        assert (first['cache_hit'], second['cache_hit']) == (False, True)
+
+    strip = client.post('/analyze-image/raw?product_type=Manzana&tiled=true', content=fruit_jpeg(960, 240))
+    assert strip.status_code == 200
+    assert strip.json()['tiling']['tiles'] >= 1
+
+
+def test_tiled_mode_counts_decoded_frame_in_memory_budget(monkeypatch):
+    """El modo por tiles decodifica el frame completo: cuenta para el presupuesto por petición"""
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(server, 'VISION_REQUEST_MEMORY_MB', 16)
+    client = TestClient(server.app)
+    response = client.post('/analyze-image/raw?product_type=Manzana&tiled=true', content=fruit_jpeg(4000, 1200))
+
+    assert response.status_code == 413
+    assert 'tiled' not in response.json()['detail']
+    declared = client.post('/analyze-image/raw?product_type=Manzana&tiled=true', content=b'x',
+                           headers={'X-Image-Width': '4000', 'X-Image-Height': '1200'})
+    assert declared.status_code == 413
+    assert client.post('/analyze-image/raw?product_type=Manzana&tiled=true', content=fruit_jpeg(960, 240)).status_code == 200
+
+
+
+@pytest.mark.parametrize('action', ['reject', 'downsample'])
+def test_memory_budget_rejects_or_downsamples_large_images(monkeypatch, action):
+    """Por encima de VISION_REQUEST_MEMORY_MB: 413 o análisis a menor resolución según la acción"""
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(server, 'VISION_REQUEST_MEMORY_MB', 16)
+    monkeypatch.setattr(server, 'VISION_MEMORY_BUDGET_ACTION', action)
+    client = TestClient(server.app)
+    response = client.post('/analyze-image/raw?product_type=Manzana&bypass_cache=true', content=fruit_jpeg(4000, 3000))
+
+    if action == 'reject':
+        assert response.status_code == 413
+        assert 'presupuesto de 16 MB' in response.json()['detail']
+    else:
+        assert response.status_code == 200
+        assert max(response.json()['analysis_resolution'].values()) < server.vision_ai.analysis_max_side
+        assert response.json()['image_dimensions'] == {'width': 4000, 'height': 3000}
+    small = client.post('/analyze-image/raw?product_type=Manzana&bypass_cache=true', content=fruit_jpeg())
+    assert small.status_code == 200
+
+
+def test_tiled_grade_does_not_depend_on_memory_budget():
+    """El número de tiles no cambia defectos ni grado: la detección corre una vez por región"""
+    strip = fruit_jpeg(3000, 400)
+    results = []
+    for budget in (2, 256):
+        np.random.seed(7)
+        results.append(server.vision_ai.analyze_tiled(strip, 'Manzana', f'tiled-{budget}', memory_budget_mb=budget))
+    small, large = results
+
+    assert small['tiling']['tiles'] > large['tiling']['tiles']
+    assert len(small['defects']) == len(large['defects'])
+    assert small['quality_grade'] == large['quality_grade']
+    assert small['quality_score'] == large['quality_score']
+    assert all(defect['area_percentage'] <= 100 for defect in small['defects'])
+
+
+def test_tiled_statistics_match_whole_image():
+    """Histogramas y varianzas combinados entre tiles = los de la imagen completa con la misma máscara"""
+    jpeg = fruit_jpeg(1200, 400)
+    tiled = server.vision_ai.analyze_tiled(jpeg, 'Manzana', 'tiled-exact', memory_budget_mb=2)
+
+    image = cv2.cvtColor(np.array(Image.open(io.BytesIO(jpeg))), cv2.COLOR_RGB2BGR)
+    mask = server.segment_foreground(image, *server.foreground_threshold(image))
+    features = server.ImageFeatures(image)
+    features.__dict__['segmentation'] = {'found': True, 'bbox': (0, 0, 1200, 400), 'mask': mask,
+                                         'area_pixels': 0, 'diameter_pixels': 0}
+    color = server.vision_ai.analyze_color(features)
+    texture = server.vision_ai.analyze_texture(features)
+
+    assert tiled['tiling']['tiles'] > 1
+    assert tiled['size_measurements']['product_area_pixels'] == cv2.countNonZero(mask)
+    for key in ('dominant_hue', 'average_saturation', 'average_value', 'color_variance'):
+        assert tiled['color_analysis'][key] == pytest.approx(color[key], rel=1e-6)
+    assert tiled['texture_analysis']['laplacian_variance'] == pytest.approx(texture['laplacian_variance'], rel=1e-6)
+
+
+@pytest.mark.parametrize('vectorized', ['false', 'true'])
+def test_analyze_batch_reports_invalid_image_per_index(monkeypatch, vectorized):
+    """Una imagen inválida en /analyze-batch no falla el lote: error en su posición"""
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(server, 'VISION_BATCH_VECTORIZED', True)
+    client = TestClient(server.app)
+    files = [('images', ('ok.jpg', fruit_jpeg(), 'image/jpeg')), ('images', ('mal.jpg', b'no es una imagen', 'image/jpeg'))]
+    response = client.post('/analyze-batch', files=files, data={'vectorized': vectorized, 'bypass_cache': 'true'})
+
+    assert response.status_code == 200
+    ok, error = response.json()['results']
+    assert 'quality_score' in ok
+    assert (error['index'], error['status_code']) == (1, 400)
+    assert response.json()['summary']['errors'] == 1
+
+
+def test_detector_backend_without_detect_batch_fails_when_loaded(tmp_path, monkeypatch):
+    """Un backend que no implementa detect_batch se rechaza al cargarlo, no en la primera imagen"""
+    (tmp_path / 'backend_incompleto.py').write_text(
+        'from computer_vision_server import DefectDetector\n\n'
+        'class SinDeteccion(DefectDetector):\n    name = "incompleto"\n\n'
+        'class NoEsDetector:\n    pass\n'
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    with pytest.raises(TypeError, match='detect_batch'):
+        server.load_detector('backend_incompleto:SinDeteccion', server.vision_ai)
+    with pytest.raises(TypeError, match='DefectDetector'):
+        server.load_detector('backend_incompleto:NoEsDetector', server.vision_ai)
+
+
+def test_microbatch_isolates_errors_per_request():
+    """Una imagen inválida dentro de un micro-lote falla solo su petición"""
+    import asyncio
+
+    async def scenario():
+        executor = server.AnalysisExecutor(workers=0, max_queue=4, queue_timeout=1)
+        executor.start()
+        scheduler = server.MicroBatchScheduler(executor, max_batch_size=4, max_wait_ms=50)
+        # La primera sale sola (worker libre); las otras dos se agrupan mientras se analiza
+        outputs = await asyncio.gather(scheduler.submit(fruit_jpeg(), 'Manzana', 'm0'),
+                                       scheduler.submit(b'no es una imagen', 'Manzana', 'm1'),
+                                       scheduler.submit(fruit_jpeg(), 'Naranja', 'm2'),
+                                       return_exceptions=True)
+        executor.shutdown()
+        return outputs, scheduler.stats()
+
+    (first, invalid, grouped), stats = asyncio.run(scenario())
+    assert (stats['batches'], stats['items']) == (2, 3)
+    assert first['analysis_id'] == 'm0'
+    assert isinstance(invalid, HTTPException) and invalid.status_code == 400
+    assert (grouped['analysis_id'], grouped['product_type']) == ('m2', 'Naranja')
+
+
+def test_job_releases_images_when_finished():
+    """Un trabajo terminado no retiene sus imágenes base64 y sigue informando cuántas eran"""
+    import asyncio
+
+    async def scenario():
+        queue = server.JobQueue(max_queue=4, concurrency=1, ttl_seconds=60, max_retained=10)
+        image = 'data:image/jpeg;base64,' + base64.b64encode(fruit_jpeg()).decode()
+        job, _ = queue.submit(server.JobRequest(images=[image, image], product_type='Manzana'))
+        await asyncio.wait_for(queue._queue.join(), 30)
+        queue.shutdown()
+        return job
+
+    job = asyncio.run(scenario())
+    assert job.status == 'completed'
+    assert job.images == []
+    assert job.status_dict()['total_images'] == 2
+    assert job.result['total_images'] == 2
+
+
+def test_job_lifecycle_and_full_queue(monkeypatch):
+    """POST /jobs responde 202; el resultado da 202 hasta terminar y la cola llena da 503"""
+    import asyncio
+    import httpx
+
+    release = asyncio.Event()
+
+    async def gated_analysis(image_data, product_type, analysis_id, **kwargs):
+        await release.wait()
+        return server.vision_ai.analyze_image(image_data, product_type, analysis_id)
+    monkeypatch.setattr(server, 'run_analysis', gated_analysis)
+    monkeypatch.setattr(server, 'job_queue', server.JobQueue(max_queue=1, concurrency=1, ttl_seconds=60, max_retained=10))
+    payload = {'image_data': base64.b64encode(fruit_jpeg()).decode('ascii'), 'product_type': 'Manzana'}
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            submitted = await client.post('/jobs', json=payload)
+            await asyncio.sleep(0.05)  # el runner toma el primero; el segundo ocupa la cola
+            queued = await client.post('/jobs', json=payload)
+            full = await client.post('/jobs', json=payload)
+            job_id = submitted.json()['job_id']
+            pending = await client.get(f'/jobs/{job_id}/result')
+            release.set()
+            await asyncio.wait_for(server.job_queue._queue.join(), 30)
+            status = await client.get(f'/jobs/{job_id}')
+            result = await client.get(f'/jobs/{job_id}/result')
+        server.job_queue.shutdown()
+        return submitted, queued, full, pending, status, result
+
+    submitted, queued, full, pending, status, result = asyncio.run(scenario())
+    assert (submitted.status_code, queued.status_code) == (202, 202)
+    assert full.status_code == 503 and int(full.headers['Retry-After']) >= 1
+    assert pending.status_code == 202 and pending.json()['status'] == 'running'
+    assert 'Retry-After' in pending.headers
+    assert status.json()['status'] == 'completed'
+    assert result.status_code == 200 and result.json()['analysis_id'] == submitted.json()['job_id']
+
+
+def test_frame_stream_skips_cache_and_rejects_large_frames(monkeypatch):
+    """Los frames de cámara no se guardan en la caché y los demasiado grandes se rechazan"""
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(server, 'result_cache', server.ResultCache(16, 3600))
+    monkeypatch.setattr(server, 'VISION_STREAM_MAX_FRAME_MB', 0.5)
+    client = TestClient(server.app)
+    with client.websocket_connect('/ws/frames?product_type=Manzana') as websocket:
+        websocket.send_bytes(fruit_jpeg())
+        result = websocket.receive_json()
+        websocket.send_bytes(b'\x00' * (1024 * 1024))
+        rejected = websocket.receive_json()
+
+    assert result['type'] == 'result'
+    assert server.result_cache.stats()['entries'] == 0
+    assert rejected['type'] == 'error' and 'supera el máximo' in rejected['detail']
+    assert rejected['stats']['errors'] == 1
+
+
+def test_frame_stream_survives_unexpected_analysis_errors(monkeypatch):
+    """Una excepción inesperada del análisis se informa en su frame y el stream sigue vivo"""
+    from fastapi.testclient import TestClient
+
+    real_analysis = server.run_analysis
+    calls = []
+
+    async def flaky_analysis(*args, **kwargs):
+        calls.append(args[2])
+        if len(calls) == 1:
+            raise RuntimeError("worker caído")
+        return await real_analysis(*args, **kwargs)
+    monkeypatch.setattr(server, 'run_analysis', flaky_analysis)
+    client = TestClient(server.app)
+    with client.websocket_connect('/ws/frames?product_type=Manzana') as websocket:
+        websocket.send_bytes(fruit_jpeg())
+        failed = websocket.receive_json()
+        websocket.send_bytes(fruit_jpeg())
+        result = websocket.receive_json()
+
+    assert failed['type'] == 'error' and 'worker caído' in failed['detail']
+    assert result['type'] == 'result'
+    assert result['stats']['errors'] == 1 and result['stats']['analyzed'] == 1
+
+
+def test_classify_defects_keeps_region_area_percentage():
+    """La severidad y el % de la imagen completa se suman sin perder el % relativo a la región"""
+    scorer = server.QualityScorer({'Manzana': {'size_categories': ['Pequeña', 'Grande'], 'size_thresholds': [60]}})
+    defect = {'type': 'Podredumbre', 'area': 500, 'area_percentage': 12.5}
+    classified, = scorer.classify_defects([defect], total_area=10000)
+
+    assert classified['area_percentage'] == 12.5
+    assert classified['image_area_percentage'] == 5.0
+    assert classified['severity'] == 'severe'
+
+
+def test_executor_replaces_broken_pool_once():
+    """Con el pool roto se cierra el anterior y se crea uno nuevo una sola vez"""
+    import asyncio
+    from concurrent.futures import Future
+    from concurrent.futures.process import BrokenProcessPool
+
+    class BrokenPool:
+        shutdowns = []
+
+        def submit(self, fn, *args):
+            future = Future()
+            future.set_exception(BrokenProcessPool("worker terminado"))
+            return future
+
+        def shutdown(self, wait=True, cancel_futures=False):
+            self.shutdowns.append((wait, cancel_futures))
+
+    async def scenario():
+        executor = server.AnalysisExecutor(workers=0, max_queue=4, queue_timeout=1)
+        executor.start()
+        executor._pool.shutdown()
+        executor._pool = broken = BrokenPool()
+        errors = await asyncio.gather(*(executor.run(len, b'') for _ in range(2)), return_exceptions=True)
+        replaced = executor._pool
+        executor.shutdown()
+        return errors, broken, replaced
+
+    errors, broken, replaced = asyncio.run(scenario())
+    assert [error.status_code for error in errors] == [500, 500]
+    assert BrokenPool.shutdowns == [(False, True)]
+    assert replaced is not broken
+
+
+def test_profile_store_enforces_limits_when_analysis_fails(tmp_path):
+    """Un análisis fallido bajo el perfilador también respeta el máximo de archivos del directorio"""
+    store = server.ProfileStore(str(tmp_path), max_mb=100, max_files=1, retention_hours=1)
+
+    def failing_analysis():
+        raise ValueError("imagen corrupta")
+
+    for i in range(3):
+        with pytest.raises(ValueError):
+            store.run(f'fallo_{i}', failing_analysis)
+    assert len(os.listdir(tmp_path)) == 1
@@ -21,6 +21,8 @@ CREATE TABLE quality_control (
 CREATE INDEX idx_quality_batch ON quality_control(batch_id);
 CREATE INDEX idx_quality_product ON quality_control(product_type);
 CREATE INDEX idx_quality_date ON quality_control(analyzed_at);
+-- Paginación por keyset del historial (analyzed_at, id) de más reciente a más antiguo
+CREATE INDEX idx_quality_date_id ON quality_control(analyzed_at DESC, id DESC);
 CREATE INDEX idx_quality_grade ON quality_control(quality_grade);
 CREATE INDEX idx_quality_score ON quality_control(quality_score);
 
@@ -49,6 +51,14 @@ CREATE TABLE quality_standards (
     updated_at TIMESTAMPTZ DEFAULT NOW()
 );
 
+-- Estándares iniciales (los lee el motor de puntuación del servidor de visión)
+INSERT INTO quality_standards (product_type, size_categories, size_thresholds, defect_categories, max_defects_per_unit, min_quality_score) VALUES
+    ('Manzana', ARRAY['Pequeña', 'Mediana', 'Grande', 'Extra Grande'], ARRAY[60, 75, 85], ARRAY['Punto Negro', 'Golpe', 'Podredumbre', 'Corte'], 2, 60.0),
+    ('Naranja', ARRAY['Pequeña', 'Mediana', 'Grande'], ARRAY[65, 80], ARRAY['Mancha', 'Piel Dañada', 'Podredumbre'], 3, 60.0),
+    ('Tomate', ARRAY['Cherry', 'Mediano', 'Grande'], ARRAY[40, 60], ARRAY['Rajadura', 'Golpe', 'Podredumbre'], 2, 60.0),
+    ('Papa', ARRAY['Pequeña', 'Mediana', 'Grande'], ARRAY[45, 65], ARRAY['Ojo Profundo', 'Verde', 'Daño Mecánico'], 4, 60.0)
+ON CONFLICT (product_type) DO NOTHING;
+
 -- Tabla para configuración de alertas
 CREATE TABLE alert_configuration (
     id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
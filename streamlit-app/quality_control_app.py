@@ -14,6 +14,8 @@ from PIL import Image
 import io
 import os
 import numpy as np  # Movido al inicio
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 # Configuración de página
 st.set_page_config(
@@ -147,6 +149,44 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# Imágenes por petición al webhook de n8n (lotes grandes se envían en varias peticiones)
+IMAGES_PER_REQUEST = 10
+# Peticiones enviadas a la vez (conexiones keep-alive reutilizadas de la sesión)
+UPLOAD_CONCURRENCY = 3
+# Las imágenes se reducen en el cliente a la resolución de análisis del servidor de visión
+ANALYSIS_MAX_SIDE = int(os.getenv("VISION_ANALYSIS_MAX_SIDE", "1024"))
+UPLOAD_JPEG_QUALITY = 85
+
+@st.cache_resource
+def get_http_session():
+    """Sesión HTTP compartida: pool de conexiones keep-alive hacia n8n"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=UPLOAD_CONCURRENCY)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def merge_chunk_results(chunk_results):
+    """Unir las respuestas de las peticiones de un mismo lote en un solo resultado"""
+    def analysis(result):
+        # La respuesta final de n8n trae el análisis completo en full_analysis
+        return result.get('full_analysis', result)
+    
+    def analyzed(result):
+        batch_analysis = analysis(result).get('batch_analysis') or {}
+        return batch_analysis.get('analyzed_units', 0) + batch_analysis.get('failed_units', 0)
+    
+    # La respuesta con más imágenes procesadas trae el estado del lote completo
+    merged = dict(max(chunk_results, key=analyzed))
+    merged_analysis = merged
+    if 'full_analysis' in merged:
+        merged_analysis = merged['full_analysis'] = dict(merged['full_analysis'])
+    merged_analysis['defects'] = [d for result in chunk_results for d in analysis(result).get('defects', [])]
+    merged_analysis['image_results'] = [image for result in chunk_results
+                                        for image in analysis(result).get('image_results', [])]
+    merged['requests'] = len(chunk_results)
+    return merged
+
 def trigger_quality_analysis(product_data):
     """Disparar análisis de calidad en n8n"""
     try:
@@ -202,18 +242,29 @@ def trigger_quality_analysis(product_data):
             }
             return True, demo_response
         
-        # Limitar el tamaño de las imágenes para evitar timeouts
-        if 'images' in product_data and len(product_data['images']) > 0:
-            # Tomar solo la primera imagen para la demo
-            product_data['images'] = [product_data['images'][0]]
+        # Enviar todas las imágenes en peticiones de tamaño acotado con el mismo batch_id;
+        # el servidor de visión agrega el lote completo
+        images = product_data.get('images', [])
+        session = get_http_session()
         
-        # Agregar timeout más corto para desarrollo
-        response = requests.post(n8n_webhook_url, json=product_data, timeout=30)
+        def post_chunk(start):
+            chunk_data = {
+                **product_data,
+                "images": images[start:start + IMAGES_PER_REQUEST],
+                "total_images": len(images),
+                "start_index": start
+            }
+            return session.post(n8n_webhook_url, json=chunk_data, timeout=30)
         
-        if response.status_code == 200:
-            return True, response.json()
-        else:
-            return False, f"Error del servidor: {response.status_code} - {response.text}"
+        # Varias peticiones en paralelo sobre las mismas conexiones
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as pool:
+            responses = list(pool.map(post_chunk, range(0, len(images), IMAGES_PER_REQUEST)))
+        
+        for response in responses:
+            if response.status_code != 200:
+                return False, f"Error del servidor: {response.status_code} - {response.text}"
+        
+        return True, merge_chunk_results([response.json() for response in responses])
             
     except requests.exceptions.Timeout:
         st.warning("⏰ n8n timeout - Usando modo demo")
@@ -257,27 +308,76 @@ def trigger_quality_analysis(product_data):
     except Exception as e:
         return False, f"Error inesperado: {str(e)}"
 
-def fetch_quality_history(batch_id=None):
-    """Obtener historial de controles de calidad"""
+# Historial: solo las columnas escalares que muestra la vista (sin los JSONB de defectos y lote)
+HISTORY_COLUMNS = "id,analyzed_at,batch_id,product_type,quality_grade,quality_score,size_category"
+HISTORY_PAGE_SIZE = 200
+HISTORY_CACHE_TTL = 300  # segundos
+
+@st.cache_data(ttl=HISTORY_CACHE_TTL, show_spinner=False)
+def query_quality_history(columns, batch_id=None, cursor=None, page_size=HISTORY_PAGE_SIZE):
+    """Página del historial, de más reciente a más antiguo (en caché; los errores no se cachean).
+    
+    Paginación por keyset: `cursor` es el (analyzed_at, id) de la última fila de la página
+    anterior, así cada página es una búsqueda por índice y no un OFFSET creciente.
+    """
     supabase = init_supabase()
     if not supabase:
-        return pd.DataFrame()
+        return []
     
+    query = (supabase.table('quality_control').select(columns)
+             .order('analyzed_at', desc=True).order('id', desc=True))
+    if batch_id:
+        query = query.eq('batch_id', batch_id)
+    if cursor:
+        analyzed_at, row_id = cursor
+        query = query.or_(f'analyzed_at.lt."{analyzed_at}",'
+                          f'and(analyzed_at.eq."{analyzed_at}",id.lt.{row_id})')
+    return query.limit(page_size).execute().data or []
+
+def fetch_quality_history(batch_id=None, cursor=None, columns=HISTORY_COLUMNS, page_size=HISTORY_PAGE_SIZE):
+    """Obtener una página del historial de controles de calidad"""
     try:
-        query = supabase.table('quality_control').select('*').order('analyzed_at', desc=True)
-        if batch_id:
-            query = query.eq('batch_id', batch_id)
-        
-        response = query.limit(50).execute()
-        return pd.DataFrame(response.data) if response.data else pd.DataFrame()
+        rows = query_quality_history(columns, batch_id, cursor, page_size)
+        return pd.DataFrame(rows) if rows else pd.DataFrame()
     except Exception as e:
         st.error(f"Error fetching quality history: {e}")
         return pd.DataFrame()
 
+def history_cursor(page, page_size=HISTORY_PAGE_SIZE):
+    """Cursor de la página siguiente, o None si esta fue la última"""
+    if len(page) < page_size:
+        return None
+    last = page.iloc[-1]
+    return (last['analyzed_at'], last['id'])
+
+def latest_per_lot(history):
+    """Una fila por lote: la más reciente de cada batch_id (el historial viene de más reciente a más antiguo)"""
+    if 'batch_id' not in history.columns:
+        return history
+    return history.drop_duplicates(subset='batch_id', keep='first').reset_index(drop=True)
+
 def image_to_base64(image_file):
-    """Convertir imagen a base64"""
+    """Convertir imagen a base64 (data URI), reducida a la resolución de análisis.
+    
+    Los JPEG que ya caben en ANALYSIS_MAX_SIDE se envían tal cual; el resto (incluidos PNG,
+    mucho más pesados para fotos) se reduce y recodifica como JPEG, declarando el tamaño
+    original en un comentario (`vision-source-size=AnchoxAlto`) para que el servidor mida
+    en píxeles de la captura.
+    """
     try:
         image_bytes = image_file.getvalue()
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            source_size = image.size
+            if max(source_size) > ANALYSIS_MAX_SIDE or image.format != "JPEG":
+                # JPEG: el decoder reduce en el dominio DCT, sin decodificar a resolución completa
+                image.draft(image.mode, (ANALYSIS_MAX_SIDE, ANALYSIS_MAX_SIDE))
+                image.thumbnail((ANALYSIS_MAX_SIDE, ANALYSIS_MAX_SIDE), Image.BILINEAR)
+                if image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                buffer = io.BytesIO()
+                image.save(buffer, format="JPEG", quality=UPLOAD_JPEG_QUALITY,
+                           comment=f"vision-source-size={source_size[0]}x{source_size[1]}".encode("ascii"))
+                image_bytes = buffer.getvalue()
         base64_str = base64.b64encode(image_bytes).decode('utf-8')
         return f"data:image/jpeg;base64,{base64_str}"
     except Exception as e:
@@ -481,6 +581,8 @@ def main():
         st.session_state.last_analysis = None
     if 'quality_history' not in st.session_state:
         st.session_state.quality_history = None
+    if 'history_cursor' not in st.session_state:
+        st.session_state.history_cursor = None
     if 'current_batch' not in st.session_state:
         st.session_state.current_batch = None
     
@@ -537,6 +639,8 @@ def main():
                             success, result = trigger_quality_analysis(product_data)
                         
                         if success:
+                            # El historial en caché ya no incluye este análisis
+                            query_quality_history.clear()
                             st.session_state.last_analysis = result
                             st.session_state.current_batch = batch_id
                             st.success("✅ Análisis de calidad completado!")
@@ -552,7 +656,9 @@ def main():
         st.header("📊 Historial de Calidad")
         if st.button("🔄 Actualizar Historial", use_container_width=True):
             with st.spinner("Cargando historial..."):
-                st.session_state.quality_history = fetch_quality_history()
+                history = fetch_quality_history()
+                st.session_state.quality_history = history
+                st.session_state.history_cursor = history_cursor(history)
     
     # Contenido principal
     tab1, tab2, tab3, tab4, tab5 = st.tabs(["📊 Dashboard", "🔍 Análisis", "📈 Estadísticas", "⚠️ Alertas", "📄 Reportes"])
@@ -886,7 +992,8 @@ def main():
             st.markdown("## 📋 Historial de Controles")
             
             if st.session_state.quality_history is not None and not st.session_state.quality_history.empty:
-                df = st.session_state.quality_history
+                # Lotes anteriores a guardar solo el lote completo pueden tener una fila por petición
+                df = latest_per_lot(st.session_state.quality_history)
                 
                 # Métricas del historial
                 col1, col2, col3, col4 = st.columns(4)
@@ -936,6 +1043,18 @@ def main():
                         },
                         use_container_width=True
                     )
+                
+                # Siguiente página por keyset, sin volver a descargar las anteriores
+                if st.session_state.history_cursor is not None:
+                    if st.button(f"📥 Cargar {HISTORY_PAGE_SIZE} controles más antiguos", use_container_width=True):
+                        with st.spinner("Cargando historial..."):
+                            page = fetch_quality_history(cursor=st.session_state.history_cursor)
+                            st.session_state.history_cursor = history_cursor(page)
+                            if 'analyzed_at' in page.columns:
+                                page['analyzed_at'] = pd.to_datetime(page['analyzed_at'])
+                            st.session_state.quality_history = pd.concat([st.session_state.quality_history, page],
+                                                                         ignore_index=True)
+                        st.rerun()
             else:
                 st.info("No hay historial disponible o no se ha cargado el historial")
             